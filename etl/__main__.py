@@ -8,7 +8,7 @@ import json
 from datetime import timedelta
 import logging
 
-from pypasar.db.utils import postgres, final_statistics
+from pypasar.db.utils import postgres, final_statistics, scheduler, bulk_load, shadow_load
 
 # Get LOGLEVEL from env and sets logger log level, defaults to ERROR
 logging.basicConfig(level=os.getenv("LOGLEVEL", "ERROR"))
@@ -16,8 +16,8 @@ logging.basicConfig(level=os.getenv("LOGLEVEL", "ERROR"))
 # Load environment variables from the .env file
 load_dotenv()
 
-# Ingestion will proceed in the order defined wherein dependencies will be populated first
-# CAUTION!! Advisable to not change the order below, unless necessary!!!
+# Default OMOP tables, ingestion is scheduled from the dependencies declared by each entity class
+# Entities selected after care_site wait for it, its Truncate CASCADE would TRUNCATE them otherwise!!
 omop_entities_to_ingest = [
     'concept',
     'concept_ancestor',
@@ -68,58 +68,120 @@ def db(option):
                     "Db argument must be either create_omop_schema or drop_omop_schema")
 
 
-def etl(tables):
+def etl(tables, resume=False, incremental=False, bulk=False, exact=None, shadow=False):
     global omop_entities_to_ingest
     if tables is not None:
         omop_entities_to_ingest = [table.strip() for table in tables.split(',')]
     print(f"OMOP tables to be executed: {omop_entities_to_ingest}")
+    if shadow and (resume or incremental or bulk):
+        raise ValueError("--shadow loads empty shadow tables, it cannot be combined with --resume, --incremental or --bulk")
 
-    table_etl_ingestion_time_dict = {}
+    omop_classes = {omop_entity: getattr(import_module(f'pypasar.omop.{omop_entity}'), omop_entity)
+                    for omop_entity in omop_entities_to_ingest}
+    dependencies = {omop_entity: getattr(omop_class, "dependencies", [])
+                    for omop_entity, omop_class in omop_classes.items()}
+    if resume:
+        # Other entities would run a full load, care_site's TRUNCATE CASCADE would also empty the checkpointed tables
+        not_resumable = [omop_entity for omop_entity, omop_class in omop_classes.items() if not hasattr(omop_class, "resume")]
+        if len(not_resumable) > 0:
+            raise ValueError(f"{not_resumable} do not support --resume, resume the interrupted table on its own, e.g. python . etl measurement --resume")
+    if incremental:
+        # A full reload of the others (and care_site's TRUNCATE CASCADE) would leave only the new rows in the incremental tables
+        not_incremental = [omop_entity for omop_entity, omop_class in omop_classes.items() if not hasattr(omop_class, "incremental")]
+        if len(not_incremental) > 0:
+            raise ValueError(f"{not_incremental} do not support --incremental, only the measurement append is incremental, e.g. python . etl measurement --incremental")
+    truncate_cascade = [omop_entity for omop_entity, omop_class in omop_classes.items()
+                        if getattr(omop_class, "truncate_cascade", False)]
+    etl_scheduler = scheduler.scheduler()
+    # One engine shared by all entities, sized for a few connections (fetch, ingest, helpers) per running entity
+    engine = postgres.postgres(pool_size=3 * etl_scheduler.parallelism).get_engine()
+    shadow_engine = None # Engine of the entities during a shadow load, its sessions default to the shadow schema
+
+    statement_statistics = {} # Per statement timings of the entities running SQL scripts
+
+    def run_entity(omop_entity):
+        # Entities are instantiated in the scheduler thread running them, so idle entities hold no engine
+        omop_class = omop_classes[omop_entity](engine=engine if shadow_engine is None else shadow_engine)
+        if resume:
+            omop_class.resume = True # Continue from the checkpoints of a previous run
+        if incremental:
+            omop_class.incremental = True # Load only the source rows above the watermark of the previous run
+        print(f"Begin execution for {omop_entity}..")
+        start_time = time.monotonic()
+        omop_class.execute()
+        if hasattr(omop_class, "sql_runner"):
+            statement_statistics[omop_entity] = omop_class.sql_runner.statistics
+        print(f"Completed execution for {omop_entity}: {time.monotonic() - start_time}s")
+        print()
 
     # Start ETL for OMOP Tables
     try:
-        total_time_taken = 0.0
-        for omop_entity in omop_entities_to_ingest:
-            print(f"Import {omop_entity}..")
-            omop_module = import_module(f'pypasar.omop.{omop_entity}')
-            omop_class = getattr(omop_module, omop_entity)()
-            print(f"Begin execution for {omop_entity}..")
-            start_time = time.monotonic()
-            omop_class.execute()
-            td = timedelta(seconds=time.monotonic() - start_time)
-            total_time_taken += td.total_seconds()
-            table_etl_ingestion_time_dict[omop_entity] = {"time_taken": f"{td.total_seconds()}s"}
-            print(f"Completed execution for {omop_entity}: {td.total_seconds()}s")
-            print()
+        start_time = time.monotonic()
+        if bulk:
+            # Load without foreign keys and indices.sql indexes, rebuilt once every table is loaded
+            bulk_loader = bulk_load.bulk_load(engine, omop_entities_to_ingest)
+            bulk_loader.prepare()
+        if shadow:
+            shadow_loader = shadow_load.shadow_load(engine, omop_entities_to_ingest)
+            shadow_loader.prepare()
+            # Entities (and their worker processes) read and write POSTGRES_OMOP_SCHEMA, the shadow schema until the swap
+            os.environ["POSTGRES_OMOP_SCHEMA"] = shadow_loader.shadow_schema
+            try:
+                shadow_engine = postgres.postgres(pool_size=3 * etl_scheduler.parallelism).get_engine()
+                time_taken = etl_scheduler.run(omop_entities_to_ingest, dependencies, run_entity, truncate_cascade)
+            finally:
+                os.environ["POSTGRES_OMOP_SCHEMA"] = shadow_loader.omop_schema
+            shadow_loader.finish()
+        else:
+            try:
+                time_taken = etl_scheduler.run(omop_entities_to_ingest, dependencies, run_entity, truncate_cascade)
+            finally:
+                if bulk:
+                    # Also after a failed entity, the schema is not left without its indexes and foreign keys
+                    bulk_loader.finish()
+        # Entities overlap, total is the wall clock time of the run rather than the sum of the entities
+        total_time_taken = timedelta(seconds=time.monotonic() - start_time).total_seconds()
 
+        table_etl_ingestion_time_dict = {omop_entity: {"time_taken": f"{timedelta(seconds=time_taken[omop_entity]).total_seconds()}s"}
+                                         for omop_entity in omop_entities_to_ingest}
+        for omop_entity, statistics in statement_statistics.items():
+            table_etl_ingestion_time_dict[omop_entity]["statements"] = statistics
         table_etl_ingestion_time_dict["total"] = {"time_taken": f"{total_time_taken}s"}
-        table_count_dict = collect_statistics(omop_entities_to_ingest)
+        table_count_dict = collect_statistics(omop_entities_to_ingest, engine=engine, exact=exact)
         final_statistic_dict =  {k: v | table_count_dict[k] for k, v in table_etl_ingestion_time_dict.items()}
         print(json.dumps(final_statistic_dict, indent=3))
     except Exception as err:
         raise err
+    finally:
+        if shadow_engine is not None:
+            shadow_engine.dispose()
+        engine.dispose()
 
-def collect_statistics(omop_entities_to_ingest, printStatistics=False):
+def collect_statistics(omop_entities_to_ingest, printStatistics=False, engine=None, exact=None):
     print(f"Begin collecting final_statistics..")
-    collect_statistics = final_statistics.final_statistics()
+    collect_statistics = final_statistics.final_statistics(engine, exact=exact)
     final_statistic_dict = collect_statistics.execute(omop_entities_to_ingest)
     if printStatistics:
         print(json.dumps(final_statistic_dict, indent=3))
     return final_statistic_dict
 
-# Entrypoint
-try:
-    entrypoint = sys.argv[1]
-    match entrypoint:
-        case "db":
-            options = None if len(sys.argv) <= 2 else sys.argv[2]
-            db(options)
-        case "etl":
-            tables = None if len(sys.argv) <= 2 else sys.argv[2]
-            etl(tables)
-        case "stats":
-            collect_statistics(omop_entities_to_ingest, True)
-        case _:
-            print("Entrypoint must be either db / etl / stats")
-except Exception as err:
-    traceback.print_exc()
+# Entrypoint, guarded so worker processes can import this module
+if __name__ == "__main__":
+    try:
+        entrypoint = sys.argv[1]
+        match entrypoint:
+            case "db":
+                options = None if len(sys.argv) <= 2 else sys.argv[2]
+                db(options)
+            case "etl":
+                args = [arg for arg in sys.argv[2:] if not arg.startswith("--")]
+                tables = None if len(args) == 0 else args[0]
+                etl(tables, resume="--resume" in sys.argv[2:], incremental="--incremental" in sys.argv[2:], bulk="--bulk" in sys.argv[2:],
+                    exact=True if "--exact" in sys.argv[2:] else None, shadow="--shadow" in sys.argv[2:])
+            case "stats":
+                # Default estimates unless --exact (or STATISTICS_EXACT_COUNTS=1), exact counts run in parallel
+                collect_statistics(omop_entities_to_ingest, True, exact=True if "--exact" in sys.argv[2:] else None)
+            case _:
+                print("Entrypoint must be either db / etl / stats")
+    except Exception as err:
+        traceback.print_exc()
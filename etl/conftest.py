@@ -0,0 +1 @@
+# Puts the etl directory on sys.path, tests import pypasar like the etl entrypoint does
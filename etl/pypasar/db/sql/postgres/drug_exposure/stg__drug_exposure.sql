@@ -32,5 +32,6 @@ from combined
 left join {OMOP_SCHEMA}.person p
 on p.person_source_value = combined.anon_case_no
 
-left join {OMOP_SCHEMA}.visit_occurrence vo
-on combined.session_id = (left(vo.visit_occurrence_id::text, length(visit_occurrence_id::text) - 2))::int
\ No newline at end of file
+-- primary visit_occurrence_id of the session
+left join {OMOP_SCHEMA}.int__session_visit_occurrence vo
+on combined.session_id = vo.session_id
\ No newline at end of file
@@ -6,16 +6,12 @@
 -- DATE        VERS  INITIAL  CHANGE DESCRIPTION
 -- ----------  ----  -------  ----------------------------------------
 -- 2024-10-10  1.00           Initial create
+-- 2026-10-18  2.00           Join the session_id lookup instead of converting visit_occurrence_id back to session_id
 -- *******************************************************************
 
 -- Create the staging view for the procedure_occurrence table, assigning a unique procedure_occurrence_id
 CREATE OR REPLACE VIEW {OMOP_SCHEMA}.stg__procedure_occurrence AS 
-    -- Convert visit_occurrence_id back to session_id
-    WITH sessionIDs AS (
-        SELECT CAST(LEFT(CAST(visit_occurrence_id AS TEXT), LENGTH(CAST(visit_occurrence_id AS TEXT)) - 2) AS INTEGER) AS session_id, *
-        FROM {OMOP_SCHEMA}.visit_occurrence
-    ), 
-    intra_op__operation AS (
+    WITH intra_op__operation AS (
         SELECT ROW_NUMBER() OVER (ORDER BY procedure_date asc) AS procedure_occurence_id, temp.*
         FROM (
             SELECT DISTINCT
@@ -44,7 +40,7 @@ CREATE OR REPLACE VIEW {OMOP_SCHEMA}.stg__procedure_occurrence AS
                 ON
             (provider.provider_source_value = operation.anon_surgeon_name or provider.provider_source_value = operation.anon_plan_anaesthetist_1_name or provider.provider_source_value = operation.anon_plan_anaesthetist_2_name)
             -- Join with the Visit_occurrence table
-            LEFT JOIN sessionIDs AS vo
+            LEFT JOIN {OMOP_SCHEMA}.int__session_visit_occurrence AS vo
                 ON operation.session_id = vo.session_id
             LEFT JOIN {OMOP_SCHEMA}.source_to_concept_map AS stcm
                 ON operation.procedure_code = stcm.source_code
@@ -126,7 +122,7 @@ CREATE OR REPLACE VIEW {OMOP_SCHEMA}.stg__procedure_occurrence AS
                 JOIN {OMOP_SCHEMA}.person AS person
                      ON person.person_source_value = radiology.anon_case_no
                 -- Join with the Visit_occurrence table
-                LEFT JOIN sessionIDs AS vo
+                LEFT JOIN {OMOP_SCHEMA}.int__session_visit_occurrence AS vo
                     ON radiology.session_id = vo.session_id
                 LEFT JOIN {OMOP_SCHEMA}.source_to_concept_map AS stcm
                     ON radiology.procedure_name = stcm.source_code
@@ -7,17 +7,20 @@
 -- ----------  ----  -------  ----------------------------------------
 -- 2024-09-18  1.00           Initial create
 -- 2024-10-01  2.00           Remove the mapping with the provider table
+-- 2026-10-18  3.00           Join the session_id lookup instead of converting visit_occurrence_id back to session_id
 -- *******************************************************************
 -- Create the intermediate view for the visit_detail table
 CREATE OR REPLACE VIEW {OMOP_SCHEMA}.int__visit_detail AS
-    -- Convert visit_occurrence_id back to session_id
+    -- Primary visit_occurrence of each session
 WITH sessionIDs AS (
     SELECT
-        CAST(LEFT(CAST(visit_occurrence_id AS TEXT), LENGTH(CAST(visit_occurrence_id AS TEXT)) - 2) AS INTEGER) AS session_id,
-        visit_occurrence_id,
-        visit_start_date,
-        visit_end_date
-    FROM {OMOP_SCHEMA}.visit_occurrence
+        svo.session_id,
+        vo.visit_occurrence_id,
+        vo.visit_start_date,
+        vo.visit_end_date
+    FROM {OMOP_SCHEMA}.int__session_visit_occurrence AS svo
+    JOIN {OMOP_SCHEMA}.visit_occurrence AS vo
+        ON vo.visit_occurrence_id = svo.visit_occurrence_id
 ),
 final AS (
     SELECT
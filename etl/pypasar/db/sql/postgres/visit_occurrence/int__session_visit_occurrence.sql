@@ -0,0 +1,26 @@
+-- *******************************************************************
+-- NAME: int__session_visit_occurrence.sql
+-- DESC: Create the intermediate lookup table - session_id to primary visit_occurrence_id
+-- *******************************************************************
+-- CHANGE LOG:
+-- DATE        VERS  INITIAL  CHANGE DESCRIPTION
+-- ----------  ----  -------  ----------------------------------------
+-- 2026-10-18  1.00           Initial create
+-- *******************************************************************
+
+-- visit_occurrence_id is the session_id followed by a 2 digit suffix, so integer division gives back the session_id.
+-- The visit with the lowest suffix is the primary visit of the session.
+-- Built once per run, downstream entities join on session_id instead of string casting visit_occurrence_id.
+-- CASCADE drops the downstream views built on top of it, they are recreated by their own entity
+DROP TABLE IF EXISTS {OMOP_SCHEMA}.int__session_visit_occurrence CASCADE;
+
+CREATE TABLE {OMOP_SCHEMA}.int__session_visit_occurrence AS
+    SELECT
+        visit_occurrence_id / 100 AS session_id,
+        MIN(visit_occurrence_id) AS visit_occurrence_id
+    FROM {OMOP_SCHEMA}.visit_occurrence
+    GROUP BY visit_occurrence_id / 100;
+
+ALTER TABLE {OMOP_SCHEMA}.int__session_visit_occurrence ADD PRIMARY KEY (session_id);
+
+ANALYZE {OMOP_SCHEMA}.int__session_visit_occurrence;
@@ -0,0 +1,120 @@
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from dotenv import load_dotenv
+from .sql_runner import split_statements, strip_comments
+
+# Load environment variables from the .env file
+load_dotenv()
+
+FOREIGN_KEY = re.compile(r"ALTER TABLE\s+(?P<table>\w+)\s+ADD CONSTRAINT\s+(?P<name>\w+)\s+(?P<definition>FOREIGN KEY\s*\(\w+\)\s*REFERENCES\s+(?P<referenced>\w+)\s*\(\w+\))", re.I)
+DROPPED_CONSTRAINT = re.compile(r"ALTER TABLE\s+\w+\s+DROP CONSTRAINT\s+(?P<name>\w+)", re.I)
+CREATE_INDEX = re.compile(r"CREATE INDEX\s+(?P<name>\w+)\s+ON\s+(?P<table>\w+)", re.I)
+CLUSTER = re.compile(r"CLUSTER\s+(?P<table>\w+)\s+USING\s+\w+", re.I)
+
+
+class bulk_load:
+    '''
+    etl --bulk: loads the OMOP tables without their foreign keys and indices.sql indexes, then rebuilds them.
+    prepare() drops the constraints.sql foreign keys touching the loaded tables and their indices.sql indexes.
+    finish() builds the indexes and CLUSTERs table by table on workers connections at a time (BULK_LOAD_WORKERS env),
+    then adds the foreign keys back NOT VALID and validates them, again concurrently across tables.
+    Foreign keys dropped for good by drop_constraints.sql are not added back.
+    The statements run with search_path set to schema, the OMOP schema by default.
+    '''
+
+    def __init__(self, engine, tables, base_path=None, workers=None, schema=None):
+        self.engine = engine
+        self.tables = {table.lower() for table in tables}
+        self.schema = os.getenv("POSTGRES_OMOP_SCHEMA") if schema is None else schema
+        self.base_path = os.getenv("BASE_PATH") if base_path is None else base_path
+        self.workers = int(os.getenv("BULK_LOAD_WORKERS", 4)) if workers is None else workers
+        self.foreign_keys = self.load_foreign_keys()
+        self.index_statements = self.load_index_statements()
+
+    def read_statements(self, file_name):
+        with open(os.path.join(self.base_path, file_name), 'r') as file:
+            return [strip_comments(statement) for statement in split_statements(file.read())]
+
+    def load_foreign_keys(self):
+        # Foreign keys of constraints.sql from or to a loaded table, both sides are checked row by row while loading
+        dropped = {match.group("name").lower() for match in map(DROPPED_CONSTRAINT.match, self.read_statements("drop_constraints.sql")) if match}
+        foreign_keys = []
+        for match in map(FOREIGN_KEY.match, self.read_statements("constraints.sql")):
+            if match is None or match.group("name").lower() in dropped:
+                continue
+            if match.group("table").lower() in self.tables or match.group("referenced").lower() in self.tables:
+                foreign_keys.append({"table": match.group("table").lower(), "name": match.group("name"), "definition": match.group("definition")})
+        return foreign_keys
+
+    def load_index_statements(self):
+        # indices.sql statements of the loaded tables grouped by table, CLUSTER stays after the index it uses
+        index_statements = {}
+        for statement in self.read_statements("indices.sql"):
+            match = CREATE_INDEX.match(statement) or CLUSTER.match(statement)
+            if match is not None and match.group("table").lower() in self.tables:
+                index_statements.setdefault(match.group("table").lower(), []).append(statement)
+        return index_statements
+
+    def prepare(self):
+        start_time = time.monotonic()
+        with self.engine.connect() as connection:
+            with connection.begin():
+                connection.execute(text(f"SET LOCAL search_path TO {self.schema}"))
+                for foreign_key in self.foreign_keys:
+                    connection.execute(text(f"ALTER TABLE {foreign_key['table']} DROP CONSTRAINT IF EXISTS {foreign_key['name']}"))
+                for statements in self.index_statements.values():
+                    for statement in statements:
+                        match = CREATE_INDEX.match(statement)
+                        if match is not None:
+                            connection.execute(text(f"DROP INDEX IF EXISTS {match.group('name')}"))
+        print(f"Bulk load dropped {len(self.foreign_keys)} foreign keys and the indexes of {len(self.index_statements)} tables: {time.monotonic() - start_time}s")
+
+    def finish(self):
+        self.build_indexes()
+        self.add_foreign_keys()
+
+    def build_indexes(self):
+        start_time = time.monotonic()
+        failures = self.run_per_table(self.index_statements, stop_on_error=False)
+        print(f"Bulk load built indexes of {len(self.index_statements)} tables: {time.monotonic() - start_time}s")
+        for table, errors in failures.items():
+            for err in errors:
+                print(f"Index statement of {table} failed, still to be rebuilt from indices.sql: {err}")
+
+    def add_foreign_keys(self):
+        start_time = time.monotonic()
+        foreign_key_statements = {}
+        for foreign_key in self.foreign_keys:
+            # NOT VALID adds the constraint without a scan, VALIDATE then checks the rows under a lighter lock
+            foreign_key_statements.setdefault(foreign_key["table"], []).extend([
+                f"ALTER TABLE {foreign_key['table']} ADD CONSTRAINT {foreign_key['name']} {foreign_key['definition']} NOT VALID",
+                f"ALTER TABLE {foreign_key['table']} VALIDATE CONSTRAINT {foreign_key['name']}"])
+        failures = self.run_per_table(foreign_key_statements, stop_on_error=False)
+        print(f"Bulk load validated {len(self.foreign_keys)} foreign keys: {time.monotonic() - start_time}s")
+        for table, errors in failures.items():
+            for err in errors:
+                print(f"Foreign key of {table} failed and is left NOT VALID (or missing): {err}")
+
+    def run_per_table(self, statements_by_table, stop_on_error=True):
+        '''Runs the statements of every table in order, tables concurrently. Returns table -> errors of the failed statements'''
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bulk-load") as executor:
+            futures = {table: executor.submit(self.run_statements, statements, stop_on_error) for table, statements in statements_by_table.items()}
+        return {table: future.result() for table, future in futures.items() if len(future.result()) > 0}
+
+    def run_statements(self, statements, stop_on_error):
+        errors = []
+        for statement in statements:
+            # Own transaction per statement, holding the locks of one statement at a time and keeping those that succeeded
+            try:
+                with self.engine.connect() as connection:
+                    with connection.begin():
+                        connection.execute(text(f"SET LOCAL search_path TO {self.schema}"))
+                        connection.execute(text(statement))
+            except Exception as err:
+                if stop_on_error:
+                    raise err
+                errors.append(err)
+        return errors
@@ -0,0 +1,198 @@
+import io
+import os
+import struct
+import time
+from decimal import Decimal
+from itertools import chain, repeat
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from dotenv import load_dotenv
+
+# Load environment variables from the .env file
+load_dotenv()
+
+INTEGER_TYPES = ("smallint", "integer", "bigint")
+FLOAT_TYPES = ("double precision", "real")
+TIMESTAMP_TYPES = ("timestamp without time zone", "timestamp with time zone")
+
+# Postgres binary COPY counts dates and timestamps from 2000-01-01
+PG_EPOCH_DATE = np.datetime64("2000-01-01", "D")
+PG_EPOCH_TIMESTAMP = np.datetime64("2000-01-01T00:00:00", "us")
+BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+BINARY_TRAILER = struct.pack("!h", -1)
+BINARY_NULL = struct.pack("!i", -1)
+
+
+class copy_writer:
+    '''
+    Bulk loads pandas DataFrames into an OMOP table over COPY ... FROM STDIN.
+    Columns are converted according to the target column types, so nullable integer
+    columns holding NaN / None are written as NULL instead of failing as floats.
+    Categorical, nullable (Int64 / Float64) and datetime64 columns are accepted as is.
+    copy_format is either "text" (CSV) or "binary", defaults to COPY_FORMAT env.
+    '''
+
+    def __init__(self, engine, table, schema=None, copy_format=None):
+        self.engine = engine
+        self.table = table.lower()
+        self.schema = os.getenv("POSTGRES_OMOP_SCHEMA") if schema is None else schema
+        self.copy_format = os.getenv("COPY_FORMAT", "text") if copy_format is None else copy_format
+        if self.copy_format not in ("text", "binary"):
+            raise ValueError(f"COPY format must be text or binary, got {self.copy_format}")
+        self.column_types = None
+
+    def write(self, df, connection=None):
+        '''Copies df into the table, in the transaction of connection if given. Returns the number of rows written'''
+        if connection is None:
+            with self.engine.connect() as connection:
+                with connection.begin():
+                    return self.write(df, connection)
+
+        start = time.monotonic()
+        column_types = self.get_column_types(connection)
+        unknown_columns = [col for col in df.columns if col not in column_types]
+        if len(unknown_columns) > 0:
+            raise ValueError(f"Columns {unknown_columns} do not exist in {self.schema}.{self.table}")
+
+        columns = list(df.columns)
+        if self.copy_format == "binary":
+            buffer = self.to_binary(df, column_types)
+            copy_options = "FORMAT binary"
+        else:
+            buffer = self.to_text(df, column_types)
+            copy_options = "FORMAT csv"
+
+        cursor = connection.connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY {self.schema}.{self.table} ({', '.join(columns)}) FROM STDIN WITH ({copy_options})", buffer)
+        finally:
+            cursor.close()
+
+        time_taken = time.monotonic() - start
+        print(f"{len(df)} rows copied into {self.table} in {time_taken:.3f}s ({len(df) / max(time_taken, 1e-9):.0f} rows/s)")
+        return len(df)
+
+    def get_column_types(self, connection):
+        # Target column types are looked up once per writer
+        if self.column_types is None:
+            res = connection.execute(text('''SELECT column_name, data_type FROM information_schema.columns
+                                             WHERE table_schema = :schema AND table_name = :table'''),
+                                     {"schema": self.schema, "table": self.table})
+            self.column_types = {row[0]: row[1] for row in res}
+            if len(self.column_types) == 0:
+                raise ValueError(f"Table {self.schema}.{self.table} not found")
+        return self.column_types
+
+    def to_text(self, df, column_types):
+        fields = []
+        for col in df.columns:
+            series = df[col]
+            data_type = column_types[col]
+            if data_type in INTEGER_TYPES:
+                series = series.astype("Int64") # 1.0 / NaN -> 1 / NULL
+            elif data_type == "date" and pd.api.types.is_datetime64_any_dtype(series):
+                series = pd.Series(np.datetime_as_string(series.to_numpy(dtype="datetime64[D]")), index=df.index).where(series.notna())
+            # Values are always quoted and NULL is an unquoted empty field (the CSV default of COPY),
+            # so no string, '' or '\N' included, can be read back as NULL
+            quoted = '"' + series.astype(str).str.replace('"', '""', regex=False) + '"'
+            fields.append(quoted.where(series.notna().to_numpy(), ""))
+
+        buffer = io.StringIO()
+        if len(df) > 0:
+            lines = fields[0].str.cat(fields[1:], sep=",") if len(fields) > 1 else fields[0]
+            buffer.write("\n".join(lines.tolist()))
+            buffer.write("\n")
+        buffer.seek(0)
+        return buffer
+
+    def to_binary(self, df, column_types):
+        encoded_columns = [self.encode_column(df[col], column_types[col]) for col in df.columns]
+        field_count = struct.pack("!h", len(encoded_columns))
+        buffer = io.BytesIO()
+        buffer.write(BINARY_HEADER)
+        # Each tuple is the field count followed by its length prefixed fields
+        buffer.write(b"".join(chain.from_iterable(zip(repeat(field_count), *encoded_columns))))
+        buffer.write(BINARY_TRAILER)
+        buffer.seek(0)
+        return buffer
+
+    def encode_column(self, series, data_type):
+        notna = series.notna().to_numpy()
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            if data_type not in INTEGER_TYPES + FLOAT_TYPES + TIMESTAMP_TYPES + ("numeric", "date"):
+                # Each distinct value is encoded once and picked by code
+                encoded_categories = [encode_text(value) for value in series.cat.categories]
+                return [encoded_categories[code] if code >= 0 else BINARY_NULL for code in series.cat.codes.tolist()]
+            series = series.astype(object)
+        if data_type in INTEGER_TYPES:
+            fmt = {"smallint": "!ih", "integer": "!ii", "bigint": "!iq"}[data_type]
+            size = struct.calcsize(fmt) - 4
+            values = series.astype("Int64").to_numpy(dtype="int64", na_value=0).tolist()
+            encode = lambda value: struct.pack(fmt, size, value)
+        elif data_type in FLOAT_TYPES:
+            fmt, size = ("!id", 8) if data_type == "double precision" else ("!if", 4)
+            values = series.to_numpy(dtype="float64", na_value=np.nan).tolist()
+            encode = lambda value: struct.pack(fmt, size, value)
+        elif data_type == "numeric":
+            values = series.astype(object).tolist()
+            encode = encode_numeric
+        elif data_type == "date":
+            days = (self.to_datetime64(series).to_numpy(dtype="datetime64[D]") - PG_EPOCH_DATE).astype("int64")
+            values = days.tolist()
+            encode = lambda value: struct.pack("!ii", 4, value)
+        elif data_type in TIMESTAMP_TYPES:
+            micros = (self.to_datetime64(series).to_numpy(dtype="datetime64[us]") - PG_EPOCH_TIMESTAMP).astype("int64")
+            values = micros.tolist()
+            encode = lambda value: struct.pack("!iq", 8, value)
+        else: # character varying, text and anything else Postgres can parse from its text representation
+            values = series.astype(object).tolist()
+            encode = encode_text
+        return [encode(value) if is_value else BINARY_NULL for value, is_value in zip(values, notna)]
+
+    def to_datetime64(self, series):
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return series
+        # date objects or YYYYMMDD like values
+        return pd.to_datetime(series.astype("string"))
+
+
+def encode_text(value):
+    data = str(value).encode("utf-8")
+    return struct.pack("!i", len(data)) + data
+
+
+def encode_numeric(value):
+    '''Encodes a number in the Postgres NUMERIC binary format: base 10000 digits with weight, sign and display scale'''
+    number = value if isinstance(value, Decimal) else Decimal(str(value))
+    if number.is_nan():
+        return struct.pack("!ihhhh", 8, 0, 0, 0xC000 - 0x10000, 0)
+    if not number.is_finite():
+        raise ValueError(f"Cannot encode {value} as numeric")
+
+    sign, digits, exponent = number.as_tuple()
+    digit_str = "".join(map(str, digits))
+    if exponent > 0:
+        digit_str += "0" * exponent
+        exponent = 0
+    dscale = -exponent
+    digit_str = digit_str.rjust(dscale + 1, "0") # At least one digit before the decimal point
+    integer_part = digit_str[:len(digit_str) - dscale]
+    fraction_part = digit_str[len(digit_str) - dscale:]
+    integer_part = integer_part.rjust(-(-len(integer_part) // 4) * 4, "0")
+    fraction_part = fraction_part.ljust(-(-len(fraction_part) // 4) * 4, "0")
+
+    groups = [int(integer_part[i:i + 4]) for i in range(0, len(integer_part), 4)]
+    weight = len(groups) - 1
+    groups += [int(fraction_part[i:i + 4]) for i in range(0, len(fraction_part), 4)]
+    # Leading and trailing zero groups are implied by weight and ndigits
+    while len(groups) > 0 and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while len(groups) > 0 and groups[-1] == 0:
+        groups.pop()
+    if len(groups) == 0:
+        weight = 0
+
+    data = struct.pack(f"!hhhh{len(groups)}h", len(groups), weight, 0x4000 if sign else 0, dscale, *groups)
+    return struct.pack("!i", len(data)) + data
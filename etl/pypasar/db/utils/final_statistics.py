@@ -1,6 +1,7 @@
 import traceback
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 # Load environment variables from the .env file
@@ -9,9 +10,18 @@ load_dotenv()
 
 
 class final_statistics:
+    '''
+    Records count, table size, index size and dead tuples of the OMOP tables.
+    records_count is estimated from pg_stat_user_tables/pg_class.reltuples, unless exact (STATISTICS_EXACT_COUNTS env or --exact)
+    where the tables are counted in parallel, one count(*) per table on workers connections (STATISTICS_WORKERS env).
+    '''
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    def __init__(self, engine=None, exact=None, workers=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
+        self.exact = os.getenv("STATISTICS_EXACT_COUNTS", "0") == "1" if exact is None else exact
+        self.workers = int(os.getenv("STATISTICS_WORKERS", 4)) if workers is None else workers
+        self.omop_schema = os.getenv("POSTGRES_OMOP_SCHEMA")
 
     def execute(self, omop_entities):
         try:
@@ -23,36 +33,49 @@ class final_statistics:
             raise err
 
     def process(self, omop_entities):
-        unionSql = ""
-        for idx, entity in enumerate(omop_entities):
-            if idx < len(omop_entities) - 1:
-                unionSql += f"""SELECT '{entity}' as table_name, count(1) as table_count 
-                                    FROM {entity} UNION """
-            else:
-                unionSql += f"""SELECT '{entity}' as table_name, count(1) as table_count FROM {entity}
-                                ORDER BY table_name"""
-
-        # print(unionSql)
+        table_stats = self.fetch_table_stats(omop_entities)
+        missing = [entity for entity in omop_entities if entity not in table_stats]
+        if len(missing) > 0:
+            raise ValueError(f"Tables {missing} not found in schema {self.omop_schema}")
+
+        if self.exact:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="statistics") as executor:
+                counts = dict(zip(omop_entities, executor.map(self.count_rows, omop_entities)))
+            for entity, count in counts.items():
+                table_stats[entity]["records_count"] = count
+
+        table_dict = {}
+        for entity in sorted(omop_entities):
+            table_dict[entity] = table_stats[entity] | {"records_count_estimated": not self.exact}
+        table_dict["total"] = {key: sum(table_stats[entity][key] for entity in omop_entities)
+                               for key in ("records_count", "table_size_bytes", "index_size_bytes", "dead_tuples")}
+        table_dict["total"]["records_count_estimated"] = not self.exact
+        return table_dict
+
+    def fetch_table_stats(self, omop_entities):
+        # Catalog reads only, no table is scanned. n_live_tup follows every insert and delete, reltuples only the last
+        # VACUUM / ANALYZE (-1 if never analyzed), so it is only the fallback when the table has no activity statistics
         with self.engine.connect() as connection:
             with connection.begin():
-                # Set schema
-                connection.execute(
-                    text(f'SET search_path TO {os.getenv("POSTGRES_OMOP_SCHEMA")}'))
-                # Select count, name for all tables
-                res = connection.execute(text(unionSql))
-                rows = res.fetchall()
-                # print(rows)
-                table_dict = {}
-                total_rows = 0
-                for row in rows:
-                    total_rows += int(row[1])
-                    table_dict[row[0]] = {"records_count": row[1]}
-                table_dict["total"] = {"records_count": total_rows}
-                # print(table_dict)
-                return table_dict
-
-
-    
+                res = connection.execute(text('''SELECT c.relname,
+                                                     COALESCE(s.n_live_tup, GREATEST(c.reltuples, 0)::BIGINT) AS records_count,
+                                                     pg_table_size(c.oid) AS table_size_bytes,
+                                                     pg_indexes_size(c.oid) AS index_size_bytes,
+                                                     COALESCE(s.n_dead_tup, 0) AS dead_tuples
+                                              FROM pg_class c
+                                              JOIN pg_namespace n ON n.oid = c.relnamespace
+                                              LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+                                              WHERE n.nspname = :schema AND c.relkind IN ('r', 'p') AND c.relname = ANY(:tables)'''),
+                                         {"schema": self.omop_schema, "tables": list(omop_entities)})
+                return {row[0]: {"records_count": int(row[1]), "table_size_bytes": int(row[2]),
+                                 "index_size_bytes": int(row[3]), "dead_tuples": int(row[4])} for row in res}
+
+    def count_rows(self, entity):
+        with self.engine.connect() as connection:
+            with connection.begin():
+                return connection.execute(text(f"SELECT count(*) FROM {self.omop_schema}.{entity}")).scalar()
+
     def finalize(self):
         # cleanup
-        self.engine.dispose()
\ No newline at end of file
+        if self.owns_engine:
+            self.engine.dispose()
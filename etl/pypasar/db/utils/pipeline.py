@@ -0,0 +1,112 @@
+import os
+import queue
+import threading
+from dotenv import load_dotenv
+
+# Load environment variables from the .env file
+load_dotenv()
+
+END_OF_BATCHES = object() # Sentinel passed down the stages once the source batches are exhausted
+
+
+class pipeline:
+    '''
+    Overlaps retrieve -> transform -> ingest of batch entities.
+    A reader thread prefetches source batches and a transform thread prepares the next batch while the
+    caller thread ingests the previous one. Stages are connected by bounded queues of queue_depth batches,
+    so a slow stage blocks the stages feeding it and at most a few batches are held in memory.
+    Batches are transformed and ingested in retrieval order, one at a time per stage.
+    queue_depth defaults to PIPELINE_QUEUE_DEPTH env, 0 runs the stages one after another in the caller thread.
+    '''
+
+    def __init__(self, queue_depth=None):
+        self.queue_depth = int(os.getenv("PIPELINE_QUEUE_DEPTH", 2)) if queue_depth is None else queue_depth
+        if self.queue_depth < 0:
+            raise ValueError(f"Pipeline queue depth must not be negative, got {self.queue_depth}")
+
+    def run(self, batches, transform, ingest):
+        '''Ingests transform(batch) for every batch of the batches iterable. Returns the number of batches ingested'''
+        if self.queue_depth == 0:
+            batch_count = 0
+            for batch in batches:
+                ingest(transform(batch))
+                batch_count += 1
+            return batch_count
+
+        stop = threading.Event() # Set by the first failing stage, the other stages drain out
+        errors = []
+        source_queue = queue.Queue(maxsize=self.queue_depth)
+        transformed_queue = queue.Queue(maxsize=self.queue_depth)
+        threads = [threading.Thread(target=self.read, args=(batches, source_queue, stop, errors), name="pipeline-reader", daemon=True),
+                   threading.Thread(target=self.transform, args=(source_queue, transform, transformed_queue, stop, errors), name="pipeline-transform", daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        batch_count = 0
+        try:
+            while True:
+                transformed_batch = self.get(transformed_queue, stop)
+                if transformed_batch is END_OF_BATCHES:
+                    break
+                ingest(transformed_batch)
+                batch_count += 1
+                del transformed_batch
+        except BaseException as err:
+            errors.append(err)
+            stop.set()
+        finally:
+            for thread in threads:
+                thread.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+        return batch_count
+
+    def read(self, batches, output_queue, stop, errors):
+        iterator = iter(batches)
+        try:
+            for batch in iterator:
+                if not self.put(output_queue, batch, stop):
+                    break
+        except BaseException as err:
+            errors.append(err)
+            stop.set()
+        finally:
+            # Close generators in the thread that ran them, releasing their cursors and connections
+            if hasattr(iterator, "close"):
+                iterator.close()
+            self.put(output_queue, END_OF_BATCHES, stop)
+
+    def transform(self, input_queue, transform, output_queue, stop, errors):
+        try:
+            while True:
+                batch = self.get(input_queue, stop)
+                if batch is END_OF_BATCHES:
+                    break
+                transformed_batch = transform(batch)
+                del batch
+                if not self.put(output_queue, transformed_batch, stop):
+                    break
+        except BaseException as err:
+            errors.append(err)
+            stop.set()
+        finally:
+            self.put(output_queue, END_OF_BATCHES, stop)
+
+    def put(self, output_queue, item, stop):
+        # Blocks while the next stage is behind (back-pressure), gives up once the pipeline is stopped
+        while not stop.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, input_queue, stop):
+        while not stop.is_set():
+            try:
+                return input_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return END_OF_BATCHES
@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.schema import CreateSchema, DropSchema
 from dotenv import load_dotenv
 
@@ -9,11 +9,17 @@ load_dotenv()
 
 class postgres:
 
-    def __init__(self, base_path=None) -> None:
+    def __init__(self, base_path=None, pool_size=None) -> None:
         self.omop_schema = os.getenv("POSTGRES_OMOP_SCHEMA")
         self.omop_db = os.getenv("POSTGRES_DB")
+        # POSTGRES_POOL_SIZE env is a minimum, the etl runner asks for more with pool_size for the entities running at a time
         self.connectable = create_engine(
-            f'postgresql+psycopg2://{os.getenv("POSTGRES_USER")}:{os.getenv("POSTGRES_PASSWORD")}@{os.getenv("POSTGRES_HOST")}:{os.getenv("POSTGRES_PORT")}/{self.omop_db}')
+            f'postgresql+psycopg2://{os.getenv("POSTGRES_USER")}:{os.getenv("POSTGRES_PASSWORD")}@{os.getenv("POSTGRES_HOST")}:{os.getenv("POSTGRES_PORT")}/{self.omop_db}',
+            pool_size=max(int(os.getenv("POSTGRES_POOL_SIZE", 5)), 0 if pool_size is None else pool_size),
+            max_overflow=int(os.getenv("POSTGRES_MAX_OVERFLOW", 10)),
+            pool_pre_ping=True)
+        self.session_settings = [setting.strip() for setting in os.getenv("POSTGRES_SESSION_SETTINGS", "").split(",") if setting.strip() != ""]
+        event.listen(self.connectable, "connect", self.configure_session)
         self.base_path = "pypasar/db/sql/postgres" if base_path is None else base_path
         self.files = ["ddl.sql",
                       "primary_keys.sql",
@@ -49,5 +55,15 @@ class postgres:
             connection.commit()
             print(f"{self.omop_schema} dropped..")
 
+    def configure_session(self, dbapi_connection, connection_record):
+        # Runs once per new pooled connection, instead of every checkout re-issuing SET search_path
+        with dbapi_connection.cursor() as cursor:
+            if self.omop_schema is not None:
+                cursor.execute(f"SET search_path TO {self.omop_schema}")
+            for setting in self.session_settings:
+                name, value = setting.split("=", 1)
+                cursor.execute(f"SET {name.strip()} TO %s", (value.strip(),))
+        dbapi_connection.commit()
+
     def get_engine(self):
         return self.connectable
@@ -0,0 +1,88 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+
+# Load environment variables from the .env file
+load_dotenv()
+
+
+class scheduler:
+    '''
+    Runs OMOP entities as a DAG instead of one after another.
+    An entity starts once the selected entities it depends on are completed, up to parallelism entities at a time.
+    Dependencies that are not selected are expected to be loaded already and are not waited for.
+    An entity whose ETL truncates with CASCADE (care_site) is a barrier, the entities selected after it wait for it,
+    since they would be truncated if they ran before or alongside it.
+    parallelism defaults to ETL_PARALLELISM env, 1 runs the entities in the selected order.
+    '''
+
+    def __init__(self, parallelism=None):
+        self.parallelism = int(os.getenv("ETL_PARALLELISM", 4)) if parallelism is None else parallelism
+        if self.parallelism < 1:
+            raise ValueError(f"ETL parallelism must be at least 1, got {self.parallelism}")
+
+    def plan(self, entities, dependencies, truncate_cascade=()):
+        '''Returns entity -> set of selected entities it waits for, raises ValueError on a dependency cycle'''
+        graph = {}
+        for position, entity in enumerate(entities):
+            waits_for = {dependency for dependency in dependencies.get(entity, []) if dependency in entities and dependency != entity}
+            # Entities selected after a TRUNCATE CASCADE entity run after it
+            waits_for |= {earlier for earlier in entities[:position] if earlier in truncate_cascade}
+            graph[entity] = waits_for
+
+        # Kahn's algorithm, anything left over is part of a cycle
+        remaining = {entity: set(waits_for) for entity, waits_for in graph.items()}
+        while True:
+            ready = [entity for entity, waits_for in remaining.items() if len(waits_for) == 0]
+            if len(ready) == 0:
+                break
+            for entity in ready:
+                del remaining[entity]
+            for waits_for in remaining.values():
+                waits_for.difference_update(ready)
+        if len(remaining) > 0:
+            raise ValueError(f"Dependency cycle between OMOP entities {sorted(remaining)}")
+        return graph
+
+    def run(self, entities, dependencies, run_entity, truncate_cascade=()):
+        '''
+        Calls run_entity(entity) for every entity of the entities list in dependency order.
+        Returns entity -> seconds taken, in completion order. The first error stops new entities from starting
+        and is raised once the running entities are done.
+        '''
+        graph = self.plan(entities, dependencies, truncate_cascade)
+        completed, running, time_taken = set(), {}, {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.parallelism, thread_name_prefix="etl") as executor:
+            while True:
+                if error is None:
+                    # Ready entities start in the selected order, so parallelism 1 keeps the sequential order
+                    for entity in entities:
+                        if len(running) >= self.parallelism:
+                            break
+                        if entity in completed or entity in running.values() or not graph[entity] <= completed:
+                            continue
+                        running[executor.submit(self.timed, run_entity, entity)] = entity
+                if len(running) == 0:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entity = running.pop(future)
+                    try:
+                        time_taken[entity] = future.result()
+                        completed.add(entity)
+                    except Exception as err:
+                        print(f"{entity} failed, waiting for the running entities {sorted(running.values())}..")
+                        error = err if error is None else error
+
+        if error is not None:
+            raise error
+        return time_taken
+
+    def timed(self, run_entity, entity):
+        start_time = time.monotonic()
+        run_entity(entity)
+        return time.monotonic() - start_time
@@ -0,0 +1,149 @@
+import os
+import re
+import time
+from sqlalchemy import text
+from dotenv import load_dotenv
+from .bulk_load import bulk_load
+
+# Load environment variables from the .env file
+load_dotenv()
+
+PRIMARY_KEY = re.compile(r"ALTER TABLE\s+(?P<table>\w+)\s+ADD CONSTRAINT\s+\w+\s+PRIMARY KEY", re.I)
+RELATION_KINDS = {"r": "TABLE", "p": "TABLE", "v": "VIEW", "m": "MATERIALIZED VIEW", "f": "FOREIGN TABLE"}
+# Scratch tables of the pandas loads and the era scripts (SELECT INTO), dropped with DROP TABLE by their own entity
+# and never read across entities, so they get no pass-through view
+SCRATCH_PREFIXES = ("temp_", "tmp_", "cte", "condition_era_phase_")
+
+
+class shadow_load:
+    '''
+    etl --shadow: loads the OMOP tables into a shadow schema ({OMOP}__shadow) and swaps them into the OMOP schema at the end,
+    so readers of the OMOP schema keep seeing the previous load until the new one is complete.
+    prepare() creates the shadow schema with an UNLOGGED copy (no indexes or constraints) of every loaded table, a copy of
+    every view and a pass-through view to every other table. The etl runner then points POSTGRES_OMOP_SCHEMA at the shadow schema.
+    finish() sets the loaded tables LOGGED, builds their primary keys and indices.sql indexes and analyzes them, then in one
+    short transaction moves the previous tables out ({OMOP}__retired), the shadow tables in and recreates the views on them.
+    The retired tables are dropped afterwards and the foreign keys touching the loaded tables are added back NOT VALID and validated.
+    '''
+
+    def __init__(self, engine, tables, base_path=None, workers=None):
+        self.engine = engine
+        self.tables = [table.lower() for table in tables]
+        self.omop_schema = os.getenv("POSTGRES_OMOP_SCHEMA")
+        self.shadow_schema = f"{self.omop_schema}__shadow"
+        self.retired_schema = f"{self.omop_schema}__retired"
+        # Indexes are built in the shadow schema before the swap, foreign keys in the OMOP schema after it
+        self.indexer = bulk_load(engine, self.tables, base_path=base_path, workers=workers, schema=self.shadow_schema)
+        self.constraints = bulk_load(engine, self.tables, base_path=base_path, workers=workers, schema=self.omop_schema)
+        self.primary_keys = {}
+        for statement in self.indexer.read_statements("primary_keys.sql"):
+            match = PRIMARY_KEY.match(statement)
+            if match is not None and match.group("table").lower() in self.tables:
+                self.primary_keys.setdefault(match.group("table").lower(), []).append(statement)
+        self.pass_through = set()
+
+    def prepare(self):
+        start_time = time.monotonic()
+        with self.engine.connect() as connection:
+            with connection.begin():
+                connection.execute(text(f"DROP SCHEMA IF EXISTS {self.shadow_schema} CASCADE"))
+                connection.execute(text(f"DROP SCHEMA IF EXISTS {self.retired_schema} CASCADE"))
+                connection.execute(text(f"CREATE SCHEMA {self.shadow_schema}"))
+                # Empty search_path, pg_get_viewdef then qualifies every relation with its schema
+                connection.execute(text("SET LOCAL search_path TO ''"))
+                relations = self.fetch_relations(connection, self.omop_schema)
+                missing = [table for table in self.tables if table not in relations]
+                if len(missing) > 0:
+                    raise ValueError(f"Tables {missing} not found in schema {self.omop_schema}")
+
+                for name, (oid, kind, definition) in relations.items():
+                    if name in self.tables:
+                        connection.execute(text(f'''CREATE UNLOGGED TABLE {self.shadow_schema}.{name}
+                                                    (LIKE {self.omop_schema}.{name} INCLUDING DEFAULTS)'''))
+                    elif kind != "v" and not name.startswith(SCRATCH_PREFIXES):
+                        # Simple views are updatable, so checkpoints and watermarks are still written to the OMOP tables
+                        connection.execute(text(f"CREATE VIEW {self.shadow_schema}.{name} AS SELECT * FROM {self.omop_schema}.{name}"))
+                # Identified by oid, an entity may replace a pass-through view with its own relation of the same name
+                self.pass_through = {oid for name, (oid, kind, definition) in self.fetch_relations(connection, self.shadow_schema).items()}
+                # Views follow the tables they read, in creation order so a view is copied after the views it reads
+                for name, (oid, kind, definition) in relations.items():
+                    if kind == "v":
+                        connection.execute(text(f"CREATE VIEW {self.shadow_schema}.{name} AS {self.requalify(definition, self.omop_schema, self.shadow_schema)}"))
+        print(f"Shadow load prepared schema {self.shadow_schema} for {len(self.tables)} tables: {time.monotonic() - start_time}s")
+
+    def finish(self):
+        start_time = time.monotonic()
+        # SET LOGGED rewrites the table, before the indexes so they are not rewritten with it
+        statements = {table: [f"ALTER TABLE {table} SET LOGGED"] + self.primary_keys.get(table, []) +
+                             self.indexer.index_statements.get(table, []) + [f"ANALYZE {table}"]
+                      for table in self.tables}
+        self.indexer.run_per_table(statements)
+        print(f"Shadow load built indexes of {len(self.tables)} tables: {time.monotonic() - start_time}s")
+
+        start_time = time.monotonic()
+        self.swap()
+        print(f"Shadow load swapped {len(self.tables)} tables into {self.omop_schema}: {time.monotonic() - start_time}s")
+
+        start_time = time.monotonic()
+        with self.engine.connect() as connection:
+            with connection.begin():
+                # Also drops the foreign keys still referencing the retired tables
+                connection.execute(text(f"DROP SCHEMA IF EXISTS {self.retired_schema} CASCADE"))
+                connection.execute(text(f"DROP SCHEMA IF EXISTS {self.shadow_schema} CASCADE"))
+        print(f"Shadow load dropped the retired tables: {time.monotonic() - start_time}s")
+        self.constraints.add_foreign_keys()
+
+    def swap(self):
+        with self.engine.connect() as connection:
+            with connection.begin():
+                connection.execute(text("SET LOCAL search_path TO ''"))
+                connection.execute(text(f"CREATE SCHEMA {self.retired_schema}"))
+                live = self.fetch_relations(connection, self.omop_schema)
+
+                def retire(name):
+                    if name in live:
+                        connection.execute(text(f"ALTER {RELATION_KINDS[live[name][1]]} {self.omop_schema}.{name} SET SCHEMA {self.retired_schema}"))
+
+                # Loaded tables and the tables created by the run (materialised staging layers, first checkpoints..)
+                shadow = self.fetch_relations(connection, self.shadow_schema)
+                for name, (oid, kind, definition) in shadow.items():
+                    if kind in ("r", "p"):
+                        retire(name)
+                        connection.execute(text(f"ALTER TABLE {self.shadow_schema}.{name} SET SCHEMA {self.omop_schema}"))
+
+                # Views of the shadow schema, fetched again so those on the moved tables now read the OMOP schema
+                shadow = self.fetch_relations(connection, self.shadow_schema)
+                for name, (oid, kind, definition) in shadow.items():
+                    if kind == "v" and oid not in self.pass_through:
+                        retire(name)
+                        connection.execute(text(f"CREATE VIEW {self.omop_schema}.{name} AS {self.requalify(definition)}"))
+
+                # Any other view reading a retired relation or a pass-through view, e.g. views of the OHDSI tools
+                res = connection.execute(text('''SELECT quote_ident(n.nspname), quote_ident(c.relname), pg_get_viewdef(c.oid)
+                                                 FROM pg_class c
+                                                 JOIN pg_namespace n ON n.oid = c.relnamespace
+                                                 WHERE c.relkind = 'v' AND n.nspname NOT IN (:shadow, :retired, 'pg_catalog', 'information_schema')
+                                                 ORDER BY c.oid'''),
+                                         {"shadow": self.shadow_schema, "retired": self.retired_schema})
+                for schema, name, definition in res.fetchall():
+                    requalified = self.requalify(definition)
+                    if requalified != definition.rstrip().rstrip(";"):
+                        connection.execute(text(f"CREATE OR REPLACE VIEW {schema}.{name} AS {requalified}"))
+
+    def fetch_relations(self, connection, schema):
+        '''Returns name -> (oid, relkind, view definition) of the relations of schema, in creation order'''
+        res = connection.execute(text('''SELECT quote_ident(c.relname), c.oid, c.relkind,
+                                             CASE WHEN c.relkind = 'v' THEN pg_get_viewdef(c.oid) END
+                                         FROM pg_class c
+                                         JOIN pg_namespace n ON n.oid = c.relnamespace
+                                         WHERE n.nspname = :schema AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+                                         ORDER BY c.oid'''), {"schema": schema})
+        return {row[0]: (row[1], row[2], row[3]) for row in res}
+
+    def requalify(self, definition, from_schema=None, to_schema=None):
+        '''Points the relations of a view definition at to_schema, by default the shadow and retired ones at the OMOP schema'''
+        from_schemas = [self.shadow_schema, self.retired_schema] if from_schema is None else [from_schema]
+        to_schema = self.omop_schema if to_schema is None else to_schema
+        for schema in from_schemas:
+            definition = re.sub(rf"(?<![\w$\"]){re.escape(schema)}\.", f"{to_schema}.", definition)
+        return definition.rstrip().rstrip(";")
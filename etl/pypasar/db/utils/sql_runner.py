@@ -0,0 +1,157 @@
+import os
+import re
+import time
+from functools import lru_cache
+from sqlalchemy import text
+from dotenv import load_dotenv
+
+# Load environment variables from the .env file
+load_dotenv()
+
+DOLLAR_QUOTE = re.compile(r"\$[A-Za-z_0-9]*\$")
+EXPLAINABLE = ("select", "insert", "update", "delete", "with") # EXPLAIN ANALYZE runs these, DDL is executed as is
+LEADING_COMMENTS = re.compile(r"^(\s*(--[^\n]*(\n|$)|/\*.*?\*/))*\s*", re.S)
+CREATE_VIEW = re.compile(r"create\s+(or\s+replace\s+)?view\s+(?P<name>[\w.\"]+)\s+as\s+(?P<query>.*)", re.I | re.S)
+STAGING_PREFIXES = ("stg__", "int__", "temp_") # Staging layers materialised by materialize mode
+INDEX_COLUMNS = ("anon_case_no", "session_id", "visit_occurrence_id") # Join keys indexed on materialised staging layers
+
+
+def default_placeholders():
+    return {
+        "{OMOP_SCHEMA}": os.getenv("POSTGRES_OMOP_SCHEMA"),
+        "{PREOP_SCHEMA}": os.getenv("POSTGRES_SOURCE_PREOP_SCHEMA"),
+        "{INTRAOP_SCHEMA}": os.getenv("POSTGRES_SOURCE_INTRAOP_SCHEMA"),
+        "{POSTOP_SCHEMA}": os.getenv("POSTGRES_SOURCE_POSTOP_SCHEMA")
+    }
+
+
+def split_statements(sql_script):
+    '''Splits a script on the top level ";", skipping those in quotes, comments and dollar quoted bodies'''
+    statements, start, i, length = [], 0, 0, len(sql_script)
+    while i < length:
+        char = sql_script[i]
+        if char == "-" and sql_script.startswith("--", i):
+            i = sql_script.find("\n", i)
+            i = length if i == -1 else i + 1
+        elif char == "/" and sql_script.startswith("/*", i):
+            i = sql_script.find("*/", i + 2)
+            i = length if i == -1 else i + 2
+        elif char in ("'", '"'):
+            # Doubled quotes escape themselves, so a quoted run simply ends at the next closing quote
+            i = sql_script.find(char, i + 1)
+            i = length if i == -1 else i + 1
+        elif char == "$" and DOLLAR_QUOTE.match(sql_script, i):
+            tag = DOLLAR_QUOTE.match(sql_script, i).group()
+            i = sql_script.find(tag, i + len(tag))
+            i = length if i == -1 else i + len(tag)
+        elif char == ";":
+            statements.append(sql_script[start:i])
+            start = i = i + 1
+        else:
+            i += 1
+    statements.append(sql_script[start:])
+    # Drop the blank and comment only pieces, e.g. the CHANGE LOG header after the last statement
+    return [statement.strip() for statement in statements if strip_comments(statement) != ""]
+
+
+def strip_comments(statement):
+    return re.sub(r"--[^\n]*|/\*.*?\*/", "", statement, flags=re.S).strip()
+
+
+@lru_cache(maxsize=None)
+def load_statements(file_path, placeholders):
+    '''Reads, renders and splits a SQL template once per placeholder values, placeholders is a tuple of (placeholder, value)'''
+    with open(file_path, 'r') as file:
+        sql_script = file.read()
+    for placeholder, value in placeholders:
+        if placeholder not in sql_script:
+            continue
+        if value is None:
+            raise ValueError(f"Environment variable for {placeholder} not set.")
+        sql_script = sql_script.replace(placeholder, value)
+    return tuple(split_statements(sql_script))
+
+
+class sql_runner:
+    '''
+    Runs the SQL files of an entity statement by statement, timing each one and recording the rows it affected.
+    With explain (SQL_RUNNER_EXPLAIN env) the DML statements run as EXPLAIN (ANALYZE, BUFFERS) and keep the plan.
+    With materialize (OMOP_MATERIALIZE_STAGING env) the staging views (stg__, int__, temp_) are built as UNLOGGED tables instead,
+    indexed on their join keys and analyzed, so the next layer and downstream entities read them without re-evaluating the view.
+    statistics holds one entry per statement run, the etl runner adds them to the run statistics.
+    '''
+
+    def __init__(self, engine, placeholders=None, explain=None, materialize=None):
+        self.engine = engine
+        self.placeholders = default_placeholders() | ({} if placeholders is None else placeholders)
+        self.explain = os.getenv("SQL_RUNNER_EXPLAIN", "0") == "1" if explain is None else explain
+        self.materialize = os.getenv("OMOP_MATERIALIZE_STAGING", "0") == "1" if materialize is None else materialize
+        self.statistics = []
+
+    def run_files(self, file_paths):
+        '''Runs every statement of file_paths in one transaction, like the scripts were run as a whole'''
+        with self.engine.connect() as connection:
+            with connection.begin():
+                for file_path in file_paths:
+                    self.run_file(connection, file_path)
+
+    def run_file(self, connection, file_path):
+        statements = load_statements(file_path, tuple(self.placeholders.items()))
+        for index, statement in enumerate(statements):
+            self.run_statement(connection, file_path, index, statement)
+
+    def run_sql(self, connection, name, sql_script):
+        '''Runs an inline SQL script like a file, name labels its statements'''
+        for index, statement in enumerate(split_statements(sql_script)):
+            self.run_statement(connection, name, index, statement)
+
+    def drop_relation(self, connection, name, cascade=False):
+        '''Drops a staging layer whether it was created as a view or materialised as a table'''
+        relkind = connection.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"), {"name": name}).scalar()
+        if relkind is not None:
+            kind = "VIEW" if relkind == "v" else "TABLE"
+            connection.execute(text(f"DROP {kind} IF EXISTS {name}{' CASCADE' if cascade else ''}"))
+
+    def run_statement(self, connection, file_path, index, statement):
+        create_view = CREATE_VIEW.match(LEADING_COMMENTS.sub("", statement, count=1))
+        if self.materialize and create_view is not None and \
+                create_view.group("name").split(".")[-1].strip('"').lower().startswith(STAGING_PREFIXES):
+            self.materialize_view(connection, file_path, index, create_view.group("name"), create_view.group("query"))
+            return
+
+        explain = self.explain and strip_comments(statement).split(None, 1)[0].lower() in EXPLAINABLE
+        start_time = time.monotonic()
+        if explain:
+            res = connection.execute(text(f"EXPLAIN (ANALYZE, BUFFERS) {statement}"))
+            plan, rowcount = "\n".join(row[0] for row in res), None
+        else:
+            res = connection.execute(text(statement))
+            plan, rowcount = None, res.rowcount if res.rowcount >= 0 else None
+        seconds = time.monotonic() - start_time
+
+        label = strip_comments(statement).splitlines()[0][:80]
+        statistic = {"file": os.path.basename(file_path), "statement": index + 1, "sql": label,
+                     "time_taken": f"{seconds}s", "rows": rowcount}
+        if plan is not None:
+            statistic["plan"] = plan
+        self.statistics.append(statistic)
+        print(f"{statistic['file']} statement {index + 1} ({label}) {seconds:.3f}s rows {rowcount}")
+
+    def materialize_view(self, connection, file_path, index, name, query):
+        start_time = time.monotonic()
+        # Replaces the view (or the table of a previous run), the layers built on top of it are rebuilt after it
+        self.drop_relation(connection, name, cascade=True)
+        rowcount = connection.execute(text(f"CREATE UNLOGGED TABLE {name} AS {query}")).rowcount
+        columns = connection.execute(text('''SELECT attname FROM pg_attribute
+                                             WHERE attrelid = to_regclass(:name) AND attnum > 0 AND NOT attisdropped'''),
+                                     {"name": name}).scalars().all()
+        for column in INDEX_COLUMNS:
+            if column in columns:
+                connection.execute(text(f"CREATE INDEX ON {name} ({column})"))
+        connection.execute(text(f"ANALYZE {name}"))
+        seconds = time.monotonic() - start_time
+
+        statistic = {"file": os.path.basename(file_path), "statement": index + 1, "sql": f"materialized {name}",
+                     "time_taken": f"{seconds}s", "rows": rowcount if rowcount >= 0 else None}
+        self.statistics.append(statistic)
+        print(f"{statistic['file']} statement {index + 1} (materialized {name}) {seconds:.3f}s rows {statistic['rows']}")
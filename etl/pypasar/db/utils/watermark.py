@@ -0,0 +1,63 @@
+import os
+from sqlalchemy import text
+from dotenv import load_dotenv
+
+# Load environment variables from the .env file
+load_dotenv()
+
+
+class watermark:
+    '''
+    Highest source id loaded per entity and source table, the lower bound of the next incremental run.
+    A run first records target_id (the source MAX(id) it will load up to) and omop_id_start (the first OMOP id it allocates),
+    so a resumed run reuses the same bounds and ids. Completing a source table moves last_id up to its target_id,
+    in the transaction of the last batch.
+    '''
+
+    def __init__(self, engine, entity):
+        self.engine = engine
+        self.entity = entity
+        self.watermark_table = f"{os.getenv('POSTGRES_OMOP_SCHEMA')}.etl_watermark"
+
+    def create_table(self):
+        with self.engine.connect() as connection:
+            with connection.begin():
+                connection.execute(text(f'''CREATE TABLE IF NOT EXISTS {self.watermark_table} (
+                                                entity TEXT NOT NULL,
+                                                source_table TEXT NOT NULL,
+                                                last_id BIGINT,
+                                                target_id BIGINT,
+                                                omop_id_start BIGINT,
+                                                updated_at TIMESTAMP NOT NULL DEFAULT now(),
+                                                PRIMARY KEY (entity, source_table)
+                                            )'''))
+
+    def load(self):
+        '''Returns source_table -> {"last_id", "target_id", "omop_id_start"} of the entity'''
+        with self.engine.connect() as connection:
+            with connection.begin():
+                res = connection.execute(text(f'''SELECT source_table, last_id, target_id, omop_id_start FROM {self.watermark_table}
+                                                  WHERE entity = :entity'''), {"entity": self.entity})
+                return {row[0]: {"last_id": row[1], "target_id": row[2], "omop_id_start": row[3]} for row in res}
+
+    def begin_run(self, target_ids, omop_id_start, full_load=False):
+        '''Records the bounds of a new run, a full load also forgets last_id since the OMOP table is reloaded from scratch'''
+        with self.engine.connect() as connection:
+            with connection.begin():
+                for source_table, target_id in target_ids.items():
+                    connection.execute(text(f'''INSERT INTO {self.watermark_table} (entity, source_table, last_id, target_id, omop_id_start, updated_at)
+                                                 VALUES (:entity, :source_table, NULL, :target_id, :omop_id_start, now())
+                                                 ON CONFLICT (entity, source_table) DO UPDATE SET
+                                                    last_id = {"NULL" if full_load else "etl_watermark.last_id"},
+                                                    target_id = EXCLUDED.target_id,
+                                                    omop_id_start = EXCLUDED.omop_id_start,
+                                                    updated_at = EXCLUDED.updated_at'''),
+                                       {"entity": self.entity, "source_table": source_table,
+                                        "target_id": target_id, "omop_id_start": omop_id_start})
+
+    def complete(self, connection, source_table):
+        # Runs in the caller's transaction, so the watermark only moves once the loaded rows are committed
+        connection.execute(text(f'''UPDATE {self.watermark_table}
+                                     SET last_id = target_id, target_id = NULL, omop_id_start = NULL, updated_at = now()
+                                     WHERE entity = :entity AND source_table = :source_table AND target_id IS NOT NULL'''),
+                           {"entity": self.entity, "source_table": source_table})
@@ -3,14 +3,20 @@ import os
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 from ..db.utils.postgres import postgres
+from ..db.utils.sql_runner import sql_runner
 
 # Load environment variables from the .env file
 load_dotenv()
 
 class care_site:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = []
+    truncate_cascade = True # TRUNCATE care_site CASCADE empties the tables referencing it
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
+        self.sql_runner = sql_runner(self.engine)
 
     def execute(self):
         try:
@@ -28,7 +34,7 @@ class care_site:
                 connection.execute(
                     text(f'SET search_path TO {os.getenv("POSTGRES_OMOP_SCHEMA")}'))
                 # Drop the view if it exists
-                connection.execute(text("DROP VIEW IF EXISTS stg__care_site"))
+                self.sql_runner.drop_relation(connection, "stg__care_site")
                 # Clear all existing rows from the care_site table
                 connection.execute(text("TRUNCATE TABLE care_site CASCADE"))
 
@@ -38,31 +44,8 @@ class care_site:
             os.path.join(os.getenv("BASE_PATH"), "care_site", "stg__care_site.sql"),
             os.path.join(os.getenv("BASE_PATH"), "care_site", "care_site.sql")
         ]
-        self.execute_sql_files(sql_files)
-
-    def execute_sql_files(self, file_paths):
-        # Define placeholder to environment variable mappings
-        placeholder_mapping = {
-            "{OMOP_SCHEMA}": os.getenv("POSTGRES_OMOP_SCHEMA"),
-            "{PREOP_SCHEMA}": os.getenv("POSTGRES_SOURCE_PREOP_SCHEMA"),
-            "{INTRAOP_SCHEMA}": os.getenv("POSTGRES_SOURCE_INTRAOP_SCHEMA"),
-            "{POSTOP_SCHEMA}": os.getenv("POSTGRES_SOURCE_POSTOP_SCHEMA")
-        }
-        
-        with self.engine.connect() as connection:
-            with connection.begin():
-                for file_path in file_paths:
-                    with open(file_path, 'r') as file:
-                        # Read the SQL script from the file
-                        sql_script = file.read()
-                        # Replace placeholders with actual values
-                        for placeholder, value in placeholder_mapping.items():
-                            if value is not None:
-                                sql_script = sql_script.replace(placeholder, value)
-                            else:
-                                raise ValueError(f"Environment variable for {placeholder} not set.")
-                        # Execute the SQL script
-                        connection.execute(text(sql_script))
+        self.sql_runner.run_files(sql_files)
 
     def finalize(self):
-        self.engine.dispose()
+        if self.owns_engine:
+            self.engine.dispose()
@@ -9,8 +9,11 @@ load_dotenv()
 
 class cdm_source:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = []
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
 
     def execute(self):
         try:
@@ -65,4 +68,5 @@ class cdm_source:
                         )"""))
 
     def finalize(self):
-        pass
+        if self.owns_engine:
+            self.engine.dispose()
@@ -1,22 +1,24 @@
 import traceback
 import os
-import io
-import csv
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 import pandas as pd
-import psycopg2
 from ..db.utils.postgres import postgres
+from ..db.utils.copy_writer import copy_writer
 # Load environment variables from the .env file
 load_dotenv()
 
 
 class concept:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = []
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
         self.omop_schema = os.getenv("POSTGRES_OMOP_SCHEMA")
         self.source_file = os.path.join(os.getenv("BASE_PATH"), "vocab", "CONCEPT.csv")
+        self.concept_writer = copy_writer(self.engine, "concept", self.omop_schema)
 
     def execute(self):
         try:
@@ -35,7 +37,10 @@ class concept:
     def process(self):
 
         # Ingest into CONCEPT Table in batches
-        with pd.read_csv(self.source_file, header=0, sep='\t', encoding='utf-8', quotechar='"', chunksize=int(os.getenv("PROCESSING_BATCH_SIZE"))) as reader:
+        # keep_default_na=False, vocabulary values like "None", "NA" or "null" are names and codes, not missing values.
+        # Empty fields stay empty strings as well, invalid_reason is set to null below
+        with pd.read_csv(self.source_file, header=0, sep='\t', encoding='utf-8', quotechar='"', keep_default_na=False,
+                         chunksize=int(os.getenv("PROCESSING_BATCH_SIZE"))) as reader:
             for chunk in reader:
                 self.ingest(chunk)
 
@@ -46,17 +51,8 @@ class concept:
 
 
     def ingest(self, df):
-        buffer = io.StringIO()
-        df.to_csv(buffer, sep='\t', encoding='utf-8', quotechar='"', quoting=csv.QUOTE_ALL, index=False, header=True)
-        buffer.seek(0)
-        # print(df.head(1))
-        connection = self.engine.raw_connection()
-        with connection.cursor() as cursor:
-            try:
-                cursor.copy_expert(f"COPY {self.omop_schema}.CONCEPT FROM STDIN WITH DELIMITER E'\t' CSV HEADER QUOTE '\"' ESCAPE E'\\\\'" , buffer)
-                connection.commit()
-            except (Exception, psycopg2.DatabaseError) as error:
-                print("Error: %s" % error)
+        self.concept_writer.write(df)
 
     def finalize(self):
-        self.engine.dispose()
+        if self.owns_engine:
+            self.engine.dispose()
@@ -12,8 +12,11 @@ load_dotenv()
 
 class concept_ancestor:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = []
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
         self.omop_schema = os.getenv("POSTGRES_OMOP_SCHEMA")
         self.source_file = os.path.join(os.getenv("BASE_PATH"), "vocab", "CONCEPT_ANCESTOR.csv")
 
@@ -39,6 +42,8 @@ class concept_ancestor:
                 connection.commit()
             except (Exception, psycopg2.DatabaseError) as error:
                 print("Error: %s" % error)
+        connection.close() # Back to the pool, the engine may be shared with other entities
 
     def finalize(self):
-        self.engine.dispose()
\ No newline at end of file
+        if self.owns_engine:
+            self.engine.dispose()
\ No newline at end of file
@@ -5,6 +5,7 @@ import json
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 from ..db.utils.postgres import postgres
+from ..db.utils.pipeline import pipeline
 import pandas as pd
 # Load environment variables from the .env file
 load_dotenv()
@@ -12,107 +13,117 @@ load_dotenv()
 
 class condition_occurrence:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = ['person', 'visit_occurrence', 'concept', 'concept_relationship']
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
         self.omop_schema = os.getenv("POSTGRES_OMOP_SCHEMA")
         self.source_postop_schema = os.getenv("POSTGRES_SOURCE_POSTOP_SCHEMA")
         self.limit, self.offset = int(os.getenv("PROCESSING_BATCH_SIZE")), 0
         self.temp_table = f'temp_condition_occurrence_{os.urandom(15).hex()}'
         self.temp_concept_table = f'temp_concept_{os.urandom(15).hex()}'
         print(f'condition_occurrence temporary table {self.temp_table}, concept temporary table {self.temp_concept_table}')
+        self.connection = None
 
     def execute(self):
         try:
             self.initialize()
             self.process()
-            self.finalize()
         except Exception as err:
             print(f"Error occurred {self.__class__.__name__}")
             raise err
+        finally:
+            # Also after a failure, the pooled connection holding the temporary concept table must not outlive the entity
+            self.finalize()
 
     def initialize(self):
+        # Temporary concept table is only visible to the connection that created it, ingest reuses this connection
+        self.connection = self.engine.connect()
         # Truncate
         self.truncate_table(f"{self.omop_schema}.condition_occurrence")
         # Create temporary table based on concept relationship and concept tables
         self.create_temp_concept_table()
 
     def create_temp_concept_table(self):
-         with self.engine.connect() as connection:
-            with connection.begin():
-                connection.execute(text(f'SET search_path TO {self.omop_schema}'))
-                # This is used to map the non-standard source concept codes -> non-standard concept ids -> standard concept ids
-                connection.execute(text(f'''CREATE TEMPORARY TABLE {self.temp_concept_table} AS
-                                            select *
-                                                from (
-                                                        select sc.diagnosis_code as condition_source_value,
-                                                            sc.concept_id as source_concept_id,
-                                                            COALESCE(cr.concept_id_2, 0) as target_concept_id,
-                                                            cr.relationship_id,
-                                                            ROW_NUMBER() OVER(
-                                                                PARTITION BY sc.diagnosis_code
-                                                                ORDER BY sc.diagnosis_code,
-                                                                    cr.concept_id_1,
-                                                                    cr.valid_start_date asc,
-                                                                    cr.valid_end_date desc
-                                                            ) rownum
-                                                        from (
-                                                                (
-                                                                    select p.diagnosis_code, --Form query to select codes As is
-                                                                        c.concept_id
-                                                                    from {self.source_postop_schema}.discharge p
-                                                                        inner join {self.omop_schema}.concept c on p.diagnosis_code = c.concept_code
-                                                                    group by p.diagnosis_code,
-                                                                        c.concept_id
-                                                                )
-                                                                UNION
-                                                                (
-                                                                    select p.diagnosis_code, --Form query to select modified diagnosis codes as per ICD10
-                                                                        c.concept_id
-                                                                    from (
-                                                                            select concat(
-                                                                                    substring(diagnosis_code, 1, 3),
-                                                                                    '.',
-                                                                                    substring(diagnosis_code, 4)
-                                                                                ) as diagnosis_decimal_code,
-                                                                                diagnosis_code 
-                                                                            from {self.source_postop_schema}.discharge
-                                                                            where diagnosis_code SIMILAR TO '[A-Z]%' order by diagnosis_code --Choose 1st character as alphabet to exclude procedure codes starting with numeric and not part of ICD10
-                                                                        ) p
-                                                                        left join (
-                                                                            select *
-                                                                            from {self.omop_schema}.concept
-                                                                            where invalid_reason is null
-                                                                        ) c on p.diagnosis_decimal_code = c.concept_code
-                                                                    order by p.diagnosis_code
-                                                                )
-                                                            ) sc
-                                                            left join (
-                                                                select *
-                                                                from {self.omop_schema}.concept_relationship
-                                                                where relationship_id = 'Maps to'
-                                                                    and invalid_reason is null
-                                                            ) cr on sc.concept_id = cr.concept_id_1
-                                                    ) final_scm
-                                                where rownum = 1 --Pick the 1st row among duplicate coming from both ICD10 and IC10CM vocabularies for example
-                                                ''' 
+        connection = self.connection
+        with connection.begin():
+            connection.execute(text(f'SET search_path TO {self.omop_schema}'))
+            # This is used to map the non-standard source concept codes -> non-standard concept ids -> standard concept ids
+            connection.execute(text(f'''CREATE TEMPORARY TABLE {self.temp_concept_table} AS
+                                        select *
+                                            from (
+                                                    select sc.diagnosis_code as condition_source_value,
+                                                        sc.concept_id as source_concept_id,
+                                                        COALESCE(cr.concept_id_2, 0) as target_concept_id,
+                                                        cr.relationship_id,
+                                                        ROW_NUMBER() OVER(
+                                                            PARTITION BY sc.diagnosis_code
+                                                            ORDER BY sc.diagnosis_code,
+                                                                cr.concept_id_1,
+                                                                cr.valid_start_date asc,
+                                                                cr.valid_end_date desc
+                                                        ) rownum
+                                                    from (
+                                                            (
+                                                                select p.diagnosis_code, --Form query to select codes As is
+                                                                    c.concept_id
+                                                                from {self.source_postop_schema}.discharge p
+                                                                    inner join {self.omop_schema}.concept c on p.diagnosis_code = c.concept_code
+                                                                group by p.diagnosis_code,
+                                                                    c.concept_id
+                                                            )
+                                                            UNION
+                                                            (
+                                                                select p.diagnosis_code, --Form query to select modified diagnosis codes as per ICD10
+                                                                    c.concept_id
+                                                                from (
+                                                                        select concat(
+                                                                                substring(diagnosis_code, 1, 3),
+                                                                                '.',
+                                                                                substring(diagnosis_code, 4)
+                                                                            ) as diagnosis_decimal_code,
+                                                                            diagnosis_code 
+                                                                        from {self.source_postop_schema}.discharge
+                                                                        where diagnosis_code SIMILAR TO '[A-Z]%' order by diagnosis_code --Choose 1st character as alphabet to exclude procedure codes starting with numeric and not part of ICD10
+                                                                    ) p
+                                                                    left join (
+                                                                        select *
+                                                                        from {self.omop_schema}.concept
+                                                                        where invalid_reason is null
+                                                                    ) c on p.diagnosis_decimal_code = c.concept_code
+                                                                order by p.diagnosis_code
+                                                            )
+                                                        ) sc
+                                                        left join (
+                                                            select *
+                                                            from {self.omop_schema}.concept_relationship
+                                                            where relationship_id = 'Maps to'
+                                                                and invalid_reason is null
+                                                        ) cr on sc.concept_id = cr.concept_id_1
+                                                ) final_scm
+                                            where rownum = 1 --Pick the 1st row among duplicate coming from both ICD10 and IC10CM vocabularies for example
+                                            ''' 
                                     )
                                 )
 
     def process(self):
         total_count_source_postop_discharge = self.fetch_total_count_source_postop_discharge()
         print(f"Total count {total_count_source_postop_discharge}")
-        while self.offset < total_count_source_postop_discharge: # Fetch and process in batches
-            source_batch = self.retrieve()
-            transformed_batch = self.transform(source_batch)
-            del source_batch
-            self.ingest(transformed_batch)
-            self.offset += len(transformed_batch)
-            del transformed_batch
-            gc.collect()
-            self.truncate_table(f"{self.omop_schema}.{self.temp_table}") # Truncate temp table
-
-    def retrieve(self):
-        source_batch = self.fetch_in_batch_source_postop_discharge()
+        # Fetch, transform and ingest in batches, overlapped by the pipeline stages
+        pipeline().run(self.retrieve_batches(total_count_source_postop_discharge), self.transform, self.ingest)
+
+    def retrieve_batches(self, total_count_source_postop_discharge):
+        # Generator of (offset, source batch), the offset numbers condition_occurrence_id of the batch
+        while self.offset < total_count_source_postop_discharge:
+            source_batch = self.retrieve(self.offset)
+            yield self.offset, source_batch
+            if len(source_batch) == 0:
+                break
+            self.offset += len(source_batch)
+
+    def retrieve(self, offset):
+        source_batch = self.fetch_in_batch_source_postop_discharge(offset)
         source_postop_discharge_df = pd.DataFrame(source_batch.fetchall())
         source_postop_discharge_df.columns = {'anon_case_no': str, 'id': int, 
                                               'session_enddate': 'datetime64[ns]', 'diagnosis_code': str, 
@@ -122,6 +133,7 @@ class condition_occurrence:
         return source_postop_discharge_df
     
     def transform(self, source_batch):
+        offset, source_batch = source_batch
         condition_occurrence_schema = {
             'condition_occurrence_id': int,
             'person_id': int,
@@ -145,7 +157,7 @@ class condition_occurrence:
             condition_occ_df['session_id'] = source_batch['session_id'] # Visit occurrence id source value without suffix
             condition_occ_df['condition_source_value'] = source_batch['diagnosis_code']
             condition_occ_df['condition_source_description'] = source_batch['diagnosis_description']
-            condition_occ_df['condition_occurrence_id'] = range(self.offset + 1, (self.offset + 1 + len(source_batch)))
+            condition_occ_df['condition_occurrence_id'] = range(offset + 1, (offset + 1 + len(source_batch)))
             # print(f'condition_occ_df {len(condition_occ_df)}')
             # print(condition_occ_df.head(3))
         
@@ -154,53 +166,37 @@ class condition_occurrence:
 
 
     def ingest(self, transformed_batch):
-        transformed_batch.to_sql(name=self.temp_table, schema=self.omop_schema, con=self.engine, if_exists='replace', index=False)
-        with self.engine.connect() as connection:
-            with connection.begin():
-                connection.execute(text(f'SET search_path TO {self.omop_schema}'))
-                connection.execute(text(f'''INSERT INTO condition_occurrence (
-                                            condition_occurrence_id,
-                                            person_id,
-                                            condition_concept_id,
-                                            condition_source_concept_id,
-                                            condition_type_concept_id,
-                                            condition_status_concept_id,
-                                            condition_start_date,
-                                            visit_occurrence_id,
-                                            condition_source_value
-                                        )
-                                            SELECT t.condition_occurrence_id,
-                                                p.person_id,
-                                                COALESCE(c.target_concept_id, 0) AS condition_concept_id,
-                                                c.source_concept_id AS condition_source_concept_id,
-                                                t.condition_type_concept_id,
-                                                t.condition_status_concept_id,
-                                                t.condition_start_date,
-                                                v.visit_occurrence_id,
-                                                CONCAT(t.condition_source_value, '-', t.condition_source_description) AS condition_source_value
-                                            FROM { self.temp_table } t
-                                                INNER JOIN PERSON p ON t.anon_case_no = p.person_source_value
-                                                INNER JOIN ( --Reverse mapping from visit_occurrence_id to session_id. Pick only the visit_occurrence_id with suffix '00' by using window function
-                                                    SELECT visit_occurrence_id,
-                                                        row_number() over (
-                                                            partition by CAST(
-                                                                LEFT(
-                                                                    CAST(visit_occurrence_id AS TEXT),
-                                                                    LENGTH(CAST(visit_occurrence_id AS TEXT)) - 2
-                                                                ) AS INTEGER
-                                                            )
-                                                        ) rownum,
-                                                        CAST(
-                                                            LEFT(
-                                                                CAST(visit_occurrence_id AS TEXT),
-                                                                LENGTH(CAST(visit_occurrence_id AS TEXT)) - 2
-                                                            ) AS INTEGER
-                                                        ) AS truncated_visit_occurrence_id
-                                                    FROM VISIT_OCCURRENCE
-                                                ) v ON v.truncated_visit_occurrence_id = t.session_id
-                                                AND v.rownum = 1 
-                                                INNER JOIN { self.temp_concept_table } c ON t.condition_source_value = c.condition_source_value'''))
+        connection = self.connection
+        with connection.begin():
+            transformed_batch.to_sql(name=self.temp_table, schema=self.omop_schema, con=connection, if_exists='replace', index=False)
+            connection.execute(text(f'''INSERT INTO condition_occurrence (
+                                        condition_occurrence_id,
+                                        person_id,
+                                        condition_concept_id,
+                                        condition_source_concept_id,
+                                        condition_type_concept_id,
+                                        condition_status_concept_id,
+                                        condition_start_date,
+                                        visit_occurrence_id,
+                                        condition_source_value
+                                    )
+                                        SELECT t.condition_occurrence_id,
+                                            p.person_id,
+                                            COALESCE(c.target_concept_id, 0) AS condition_concept_id,
+                                            c.source_concept_id AS condition_source_concept_id,
+                                            t.condition_type_concept_id,
+                                            t.condition_status_concept_id,
+                                            t.condition_start_date,
+                                            v.visit_occurrence_id,
+                                            CONCAT(t.condition_source_value, '-', t.condition_source_description) AS condition_source_value
+                                        FROM { self.temp_table } t
+                                            INNER JOIN PERSON p ON t.anon_case_no = p.person_source_value
+                                            INNER JOIN int__session_visit_occurrence v ON v.session_id = t.session_id --Primary visit_occurrence_id of the session
+                                            INNER JOIN { self.temp_concept_table } c ON t.condition_source_value = c.condition_source_value'''))
         #print(f"offset {self.offset} limit {self.limit} batch_count {len(transformed_batch)} ingested..")
+        del transformed_batch
+        gc.collect()
+        self.truncate_table(f"{self.omop_schema}.{self.temp_table}") # Truncate temp table
 
     def fetch_total_count_source_postop_discharge(self):
         with self.engine.connect() as connection:
@@ -208,12 +204,12 @@ class condition_occurrence:
                 res = connection.execute(text(f'select count(1) from {self.source_postop_schema}.discharge'))
                 return res.first()[0]
 
-    def fetch_in_batch_source_postop_discharge(self):
+    def fetch_in_batch_source_postop_discharge(self, offset):
         # TODO: Fetch person_id from person table, visit_occurrence_id from visit_occurrence
         with self.engine.connect() as connection:
             with connection.begin():
                 res = connection.execute(
-                    text(f'select anon_case_no, id, session_enddate, diagnosis_code, diagnosis_description, session_id from {self.source_postop_schema}.discharge limit {self.limit} offset {self.offset}'))
+                    text(f'select anon_case_no, id, session_enddate, diagnosis_code, diagnosis_description, session_id from {self.source_postop_schema}.discharge limit {self.limit} offset {offset}'))
                 return res
 
     def truncate_table(self, table_name_w_schema_prefix):
@@ -224,9 +220,19 @@ class condition_occurrence:
     def drop_table(self, table_name_w_schema_prefix):
         with self.engine.connect() as connection:
             with connection.begin():
-                connection.execute(text(f"DROP table {table_name_w_schema_prefix}"))
+                connection.execute(text(f"DROP table IF EXISTS {table_name_w_schema_prefix}"))
 
     def finalize(self):
         # cleanup
+        if self.connection is not None:
+            try:
+                self.connection.rollback() # Ends the transaction of a failed batch, if any
+                with self.connection.begin():
+                    # Temporary tables live as long as the session, which goes back to the shared pool
+                    self.connection.execute(text(f"DROP TABLE IF EXISTS {self.temp_concept_table}"))
+            finally:
+                self.connection.close()
+                self.connection = None
         self.drop_table(f"{self.omop_schema}.{self.temp_table}")
-        self.engine.dispose()
+        if self.owns_engine:
+            self.engine.dispose()
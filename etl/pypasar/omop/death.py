@@ -9,8 +9,11 @@ load_dotenv()
 
 class death:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = ['person']
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
 
     def execute(self):
         try:
@@ -86,7 +89,8 @@ class death:
                      ))
 
     def finalize(self):
-        self.engine.dispose()
+        if self.owns_engine:
+            self.engine.dispose()
         # Verify if needed
         pass
 
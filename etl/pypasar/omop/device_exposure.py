@@ -3,14 +3,19 @@ import os
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 from ..db.utils.postgres import postgres
+from ..db.utils.sql_runner import sql_runner
 # Load environment variables from the .env file
 load_dotenv()
 
 
 class device_exposure:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = ['person', 'visit_occurrence']
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
+        self.sql_runner = sql_runner(self.engine)
 
     def execute(self):
         try:
@@ -29,10 +34,10 @@ class device_exposure:
                     text(f'SET search_path TO {os.getenv("POSTGRES_OMOP_SCHEMA")}'))
 
                 # Drop stg__device_exposure view if exists
-                connection.execute(text("DROP VIEW IF EXISTS stg__device_exposure CASCADE"))
+                self.sql_runner.drop_relation(connection, "stg__device_exposure", cascade=True)
 
                 # Drop int__device_exposure view if exists
-                connection.execute(text("DROP VIEW IF EXISTS int__device_exposure CASCADE"))
+                self.sql_runner.drop_relation(connection, "int__device_exposure", cascade=True)
 
                 # Delete device_exposure table
                 connection.execute(text("DELETE FROM device_exposure"))
@@ -47,8 +52,8 @@ class device_exposure:
         with self.engine.connect() as connection:
             with connection.begin():
         # Transform
-                connection.execute(
-                    text(f'''
+                self.sql_runner.run_sql(connection, "stg__device_exposure",
+                    f'''
                         -- Create or replace the staging view for the visit_detail table
                         CREATE OR REPLACE VIEW {omop_schema}.stg__device_exposure AS
                             -- Extract relevant columns from the post_op.icu table
@@ -143,19 +148,14 @@ class device_exposure:
                                 session_id                      
                             FROM final;
                         '''
-                     ))
+                     )
 
-                connection.execute(
-                    text(f'''
+                self.sql_runner.run_sql(connection, "int__device_exposure",
+                    f'''
                         -- Create intermediate view
                         CREATE OR REPLACE VIEW {omop_schema}.int__device_exposure AS
-                            -- Convert visit_occurrence_id back to session_id
-                            WITH session__id AS (
-                                SELECT CAST(LEFT(CAST(visit_occurrence_id AS TEXT), LENGTH(CAST(visit_occurrence_id AS TEXT)) - 2) AS INTEGER) AS session_id, *
-                                FROM {omop_schema}.visit_occurrence
-                            ),
                             -- Combine with other dimension tables
-                            final AS (
+                            WITH final AS (
                                 SELECT
                                     p.person_id AS person_id,
                                     stg__de.device_concept_id AS device_concept_id,
@@ -167,7 +167,8 @@ class device_exposure:
                                 FROM {omop_schema}.stg__device_exposure AS stg__de
                                 LEFT JOIN {omop_schema}.person AS p
                                     ON stg__de.anon_case_no = p.person_source_value
-                                LEFT JOIN session__id AS v
+                                -- Primary visit_occurrence_id of the session
+                                LEFT JOIN {omop_schema}.int__session_visit_occurrence AS v
                                     ON stg__de.session_id = v.session_id
                             )
 
@@ -181,7 +182,7 @@ class device_exposure:
                                 id          
                             FROM final;
                         '''
-                     ))
+                     )
 
                 # Ingest from stg__device_exposure into OMOP device_exposure Table
                 connection.execute(
@@ -233,4 +234,5 @@ class device_exposure:
 
     def finalize(self):
         # Verify if needed
-        pass
+        if self.owns_engine:
+            self.engine.dispose()
@@ -3,14 +3,19 @@ import os
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 from ..db.utils.postgres import postgres
+from ..db.utils.sql_runner import sql_runner
 
 # Load environment variables from the .env file
 load_dotenv()
 
 class drug_era:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = ['drug_exposure', 'concept', 'concept_ancestor']
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
+        self.sql_runner = sql_runner(self.engine)
 
     def execute(self):
         try:
@@ -35,28 +40,8 @@ class drug_era:
         sql_files = [
             os.path.join(os.getenv("BASE_PATH"), "drug_era", "drug_era.sql")
         ]
-        self.execute_sql_files(sql_files)
-
-    def execute_sql_files(self, file_paths):
-        # Define placeholder to environment variable mappings
-        placeholder_mapping = {
-            "{OMOP_SCHEMA}": os.getenv("POSTGRES_OMOP_SCHEMA")
-        }
-        
-        with self.engine.connect() as connection:
-            with connection.begin():
-                for file_path in file_paths:
-                    with open(file_path, 'r') as file:
-                        # Read the SQL script from the file
-                        sql_script = file.read()
-                        # Replace placeholders with actual values
-                        for placeholder, value in placeholder_mapping.items():
-                            if value is not None:
-                                sql_script = sql_script.replace(placeholder, value)
-                            else:
-                                raise ValueError(f"Environment variable for {placeholder} not set.")
-                        # Execute the SQL script
-                        connection.execute(text(sql_script))
+        self.sql_runner.run_files(sql_files)
 
     def finalize(self):
-        self.engine.dispose()
\ No newline at end of file
+        if self.owns_engine:
+            self.engine.dispose()
\ No newline at end of file
@@ -3,6 +3,7 @@ import os
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 from ..db.utils.postgres import postgres
+from ..db.utils.sql_runner import sql_runner
 
 # Load environment variables from the .env file
 load_dotenv()
@@ -10,8 +11,11 @@ load_dotenv()
 
 class drug_exposure:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = ['person', 'visit_occurrence', 'source_to_concept_map']
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
         self.drugdrug_view = "temp_drugdrug_view"
         self.drugmed_view = "temp_drugmed_view"
         self.drugfluids_view = "temp_drugfluids_view"
@@ -19,6 +23,13 @@ class drug_exposure:
         self.omop_schema = os.getenv("POSTGRES_OMOP_SCHEMA")
         self.intraop_schema = os.getenv("POSTGRES_SOURCE_INTRAOP_SCHEMA")
         self.drug_exposure_table = "drug_exposure"
+        self.sql_runner = sql_runner(self.engine, placeholders={
+            "{DRUGMED_STCM_VIEW}": self.drugmed_view,
+            "{DRUGDRUG_STCM_VIEW}": self.drugdrug_view,
+            "{DRUGFLUIDS_STCM_VIEW}": self.drugfluids_view,
+            "{DRUG_EXPOSURE_STG_VIEW}": self.drug_exposure_stg_view,
+            "{DRUG_EXPOSURE_TABLE}": self.drug_exposure_table
+        })
         #self.postop_schema = os.getenv("POSTGRES_SOURCE_POSTOP_SCHEMA")
 
     def execute(self):
@@ -39,10 +50,10 @@ class drug_exposure:
                 )
                 
                 # Drop views created
-                connection.execute(text(f"DROP VIEW IF EXISTS {self.drug_exposure_stg_view} CASCADE"))
-                connection.execute(text(f"DROP VIEW IF EXISTS {self.drugdrug_view}"))
-                connection.execute(text(f"DROP VIEW IF EXISTS {self.drugmed_view}"))
-                connection.execute(text(f"DROP VIEW IF EXISTS {self.drugfluids_view}"))
+                self.sql_runner.drop_relation(connection, self.drug_exposure_stg_view, cascade=True)
+                self.sql_runner.drop_relation(connection, self.drugdrug_view)
+                self.sql_runner.drop_relation(connection, self.drugmed_view)
+                self.sql_runner.drop_relation(connection, self.drugfluids_view)
                 # Clear all existing rows from the drug_exposure table
                 connection.execute(text(f"DELETE FROM {self.drug_exposure_table}"))
 
@@ -51,45 +62,17 @@ class drug_exposure:
         # Read from source
         # Transform
         # Ingest into OMOP Table
-        with self.engine.connect() as connection:
-            with connection.begin():
-                # List of SQL file paths
-                sql_files = [
-                    os.path.join(os.getenv("BASE_PATH"), f"{self.drug_exposure_table}/{self.drugdrug_view}.sql"),
-                    os.path.join(os.getenv("BASE_PATH"), f"{self.drug_exposure_table}/{self.drugmed_view}.sql"),
-                    os.path.join(os.getenv("BASE_PATH"), f"{self.drug_exposure_table}/{self.drugfluids_view}.sql"),
-                    os.path.join(os.getenv("BASE_PATH"), f"{self.drug_exposure_table}/{self.drug_exposure_stg_view}.sql"),
-                    os.path.join(os.getenv("BASE_PATH"), f"{self.drug_exposure_table}/{self.drug_exposure_table}.sql")
-                ]
-                self.execute_sql_files(sql_files)
-
-    def execute_sql_files(self, file_paths):
-        # Define placeholder to environment variable mappings
-        placeholder_mapping = {
-            "{OMOP_SCHEMA}": self.omop_schema,
-            "{INTRAOP_SCHEMA}": self.intraop_schema,
-            "{DRUGMED_STCM_VIEW}": self.drugmed_view,
-            "{DRUGDRUG_STCM_VIEW}": self.drugdrug_view,
-            "{DRUGFLUIDS_STCM_VIEW}": self.drugfluids_view,
-            "{DRUG_EXPOSURE_STG_VIEW}": self.drug_exposure_stg_view,
-            "{DRUG_EXPOSURE_TABLE}": self.drug_exposure_table
-        }
-        with self.engine.connect() as connection:
-                with connection.begin():
-                    for file_path in file_paths:
-                        with open(file_path, 'r') as file:
-                            # Read the SQL script from the file
-                            sql_script = file.read()
-                            # Replace placeholders with actual values
-                            for placeholder, value in placeholder_mapping.items():
-                                if value is not None:
-                                    sql_script = sql_script.replace(placeholder, value)
-                                else:
-                                    raise ValueError(f"Environment variable for {placeholder} not set.")
-                            # Execute the SQL script
-                            connection.execute(text(sql_script))
-
+        # List of SQL file paths
+        sql_files = [
+            os.path.join(os.getenv("BASE_PATH"), f"{self.drug_exposure_table}/{self.drugdrug_view}.sql"),
+            os.path.join(os.getenv("BASE_PATH"), f"{self.drug_exposure_table}/{self.drugmed_view}.sql"),
+            os.path.join(os.getenv("BASE_PATH"), f"{self.drug_exposure_table}/{self.drugfluids_view}.sql"),
+            os.path.join(os.getenv("BASE_PATH"), f"{self.drug_exposure_table}/{self.drug_exposure_stg_view}.sql"),
+            os.path.join(os.getenv("BASE_PATH"), f"{self.drug_exposure_table}/{self.drug_exposure_table}.sql")
+        ]
+        self.sql_runner.run_files(sql_files)
 
     def finalize(self):
         # Verify if needed
-        self.engine.dispose()
+        if self.owns_engine:
+            self.engine.dispose()
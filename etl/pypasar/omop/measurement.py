@@ -1,10 +1,18 @@
 import traceback
 import os
 from sqlalchemy import create_engine, text
+from sqlalchemy.exc import ProgrammingError
+from psycopg2 import errors
 from dotenv import load_dotenv
 from ..db.utils.postgres import postgres
+from ..db.utils.copy_writer import copy_writer
+from ..db.utils.pipeline import pipeline
+from ..db.utils.watermark import watermark
 import pandas as pd
+import numpy as np
 import gc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
 from datetime import datetime
 # Load environment variables from the .env file
@@ -12,7 +20,18 @@ load_dotenv()
 
 class measurement():
 
-    def __init__(self):
+    dependencies = ['person', 'visit_occurrence', 'concept', 'source_to_concept_map']
+    # Progress of every source table (or range) is committed with its batch, --resume continues from it
+    resume = False
+    # --incremental, append only: keeps measurement and loads only the source ids above the watermark of the previous run
+    incremental = False
+
+    # Unpivoted columns of the 1 to Many transforms, one measurement per column of a source row
+    preop_char_score_columns = ["height","weight","bmi", "systolic_bp", "diastolic_bp", "heart_rate", "o2_saturation", "temperature", "pain_score"]
+    preop_others_score_columns = ["efs_total_score","asa_score_aims","asa_score_eaf"]
+    preop_riskindex_score_columns = ["asa_class","cri_functional_status","cardiac_risk_index","cardiac_risk_class","osa_risk_index","act_risk"]
+
+    def __init__(self, engine=None):
         self.source = Enum(value='Source', names=[("PREOP_LAB", f"{os.getenv('POSTGRES_SOURCE_PREOP_SCHEMA')}.lab"), 
                                                   ("PREOP_CHAR", f"{os.getenv('POSTGRES_SOURCE_PREOP_SCHEMA')}.char"),
                                                   ("INTRAOP_AIMSVITALS", f"{os.getenv('POSTGRES_SOURCE_INTRAOP_SCHEMA')}.aimsvitals"),
@@ -22,17 +41,39 @@ class measurement():
                                                   ("PREOP_OTHERS", f"{os.getenv('POSTGRES_SOURCE_PREOP_SCHEMA')}.others"),
                                                   ("PREOP_RISKINDEX", f"{os.getenv('POSTGRES_SOURCE_PREOP_SCHEMA')}.riskindex"),
                                                   ("INTRAOP_NURVITALS", f"{os.getenv('POSTGRES_SOURCE_INTRAOP_SCHEMA')}.nurvitals")])
-        self.engine = postgres().get_engine()  # Get PG Connection
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
         self.omop_schema = os.getenv("POSTGRES_OMOP_SCHEMA")
         self.source_preop_schema = os.getenv("POSTGRES_SOURCE_PREOP_SCHEMA")
         self.source_intraop_schema = os.getenv("POSTGRES_SOURCE_INTRAOP_SCHEMA")
         self.source_postop_schema = os.getenv("POSTGRES_SOURCE_POSTOP_SCHEMA")
         self.temp_concept_table = f'temp_concept_measurement_{os.urandom(15).hex()}'
+        self.concept_maps = {} # source_vocabulary_id -> (source_code index, target_concept_id array), loaded once per run
+        self.unit_concept_file = os.path.join(os.getenv("BASE_PATH"), "measurement", "unit_concept_map.csv")
+        self.load_unit_concept_map()
+        self.measurement_writer = copy_writer(self.engine, "measurement", self.omop_schema)
         self.measurement_id_start = 1
         self.measurement_aimsvitals_fetch_limit = int(os.getenv("OMOP_MEASUREMENT_INTRAOP_AIMSVITALS_FETCH_LIMIT", 0))
+        # keyset: seek past the last (anon_case_no, id) of the previous batch, offset: legacy LIMIT/OFFSET paging
+        self.fetch_mode = os.getenv("OMOP_MEASUREMENT_FETCH_MODE", "keyset")
+        self.keyset_columns = ["anon_case_no", "id"] # Stable unique ordering key, must be part of every source table columns
+        # Index the keyset columns of the PASAR source tables, needs ownership of the source tables
+        self.create_source_index = os.getenv("OMOP_MEASUREMENT_SOURCE_INDEX", "0") == "1"
+        self.last_key = None
+        self.upper_key = None # Inclusive (anon_case_no, id) bound of a range split worker
+        self.checkpoint_table = f"{self.omop_schema}.etl_measurement_checkpoint"
+        self.checkpoint_key = None
+        self.watermark = watermark(self.engine, "measurement")
+        self.id_bounds = {} # Source table -> (after_id, up_to_id) loaded by this run, exclusive lower and inclusive upper id
+        # Worker processes, each source table (and each range of aimsvitals) runs in its own process when > 1
+        self.workers = int(os.getenv("OMOP_MEASUREMENT_WORKERS", 1))
+        # Maximum measurements produced per source row, sizes the measurement_id block reserved for each worker
+        self.measurements_per_row = {self.source.PREOP_CHAR.value: len(self.preop_char_score_columns),
+                                     self.source.PREOP_OTHERS.value: len(self.preop_others_score_columns),
+                                     self.source.PREOP_RISKINDEX.value: len(self.preop_riskindex_score_columns)}
         self.source_tables_cols = [{"table": self.source.PREOP_LAB.value, 
                                     "columns": {"anon_case_no": str, "id": int,
-                                              "session_id": int, "preop_lab_test_description": str,
+                                              "session_id": int, "preop_lab_test_description": "category",
                                               "preop_lab_result_value": float, 
                                               "preop_lab_collection_datetime": "datetime64[ns]", "person_id": int, "visit_occurrence_id": int}},
                                    {"table": self.source.PREOP_CHAR.value, 
@@ -43,7 +84,7 @@ class measurement():
                                               "o2_saturation": float, "o2_supplementaries": str,
                                               "temperature": float, "pain_score": float, "person_id": int, "visit_occurrence_id": int}}, 
                                    {"table": self.source.INTRAOP_OPERATION.value, 
-                                    "columns": {"anon_case_no": str, "vital_code": str,
+                                    "columns": {"anon_case_no": str, "id": int, "vital_code": "category",
                                               "vital_signs_result": float, "vital_signs_taken_datetime": "datetime64[ns]",
                                               "vital_signs_taken_date": "datetime64[ns]", 
                                               "vital_signs_taken_time": str, "person_id": int, "visit_occurrence_id": int}}, 
@@ -52,11 +93,11 @@ class measurement():
                                               "session_id": int, 
                                               "postop_lab_collection_datetime_max": "datetime64[ns]",
                                               "postop_lab_collection_datetime_min": "datetime64[ns]", 
-                                              "postop_lab_test_desc": str, "person_id": int, "visit_occurrence_id": int,
+                                              "postop_lab_test_desc": "category", "person_id": int, "visit_occurrence_id": int,
                                               "postop_result_value_max": float, "postop_result_value_min": float}}, 
                                    {"table": self.source.POSTOP_LABSALL.value, 
                                     "columns": {"anon_case_no": str, "id": int,
-                                              "session_id": int, "gen_lab_lab_test_code": str,
+                                              "session_id": int, "gen_lab_lab_test_code": "category",
                                               "gen_lab_result_value": str, "gen_lab_specimen_collection_date": "datetime64[ns]",
                                               "gen_lab_specimen_collection_time": str, "person_id": int, "visit_occurrence_id": int}},
                                    {"table": self.source.PREOP_OTHERS.value, 
@@ -72,10 +113,10 @@ class measurement():
                                               "osa_risk_index": str, "act_risk": str, "person_id": int, "visit_occurrence_id": int}}, 
                                    {"table": self.source.INTRAOP_NURVITALS.value, 
                                     "columns": {"anon_case_no": str, "id": int, "person_id": int,
-                                              "authored_datetime": "datetime64[ns]", "document_item_name": str, "value_text": str}},
+                                              "authored_datetime": "datetime64[ns]", "document_item_name": "category", "value_text": str}},
                                    {"table": self.source.INTRAOP_AIMSVITALS.value,  # 11 million records to be ingested at the end
                                     "columns": {"anon_case_no": str, "id": int,
-                                              "session_id": int, "vitalcode": str,
+                                              "session_id": int, "vitalcode": "category",
                                               "vital_num_value": float, "vitaldt": "datetime64[ns]", 
                                               "vital_date": "datetime64[ns]", "vital_time": str, "person_id": int, "visit_occurrence_id": int}} ]
 
@@ -89,14 +130,113 @@ class measurement():
             raise err
 
     def initialize(self):
-        #Truncate
-        with self.engine.connect() as connection:
-            with connection.begin():
-                connection.execute(text(f"DELETE FROM {self.omop_schema}.measurement"))
+        if (self.resume or self.incremental) and self.fetch_mode not in ("keyset", "stream"):
+            raise ValueError("Resume and incremental require OMOP_MEASUREMENT_FETCH_MODE keyset or stream")
+        if self.resume and self.measurement_aimsvitals_fetch_limit > 0:
+            # The limit would apply again from the checkpoint, loading more aimsvitals rows than configured
+            raise ValueError("Resume continues every source table to its end, OMOP_MEASUREMENT_INTRAOP_AIMSVITALS_FETCH_LIMIT must be 0")
+        if self.incremental and self.measurement_aimsvitals_fetch_limit > 0:
+            raise ValueError("Incremental loads all new source rows, OMOP_MEASUREMENT_INTRAOP_AIMSVITALS_FETCH_LIMIT must be 0")
+        self.create_checkpoint_table()
+        self.watermark.create_table()
+        #Truncate, unless resuming from the checkpoints of a previous run or loading incrementally
+        if not self.resume:
+            with self.engine.connect() as connection:
+                with connection.begin():
+                    if not self.incremental:
+                        connection.execute(text(f"DELETE FROM {self.omop_schema}.measurement"))
+                    connection.execute(text(f"DELETE FROM {self.checkpoint_table}"))
+        self.plan_id_bounds()
         # Create temporary concept table
         self.create_temp_concept_table()
 
 
+    def create_checkpoint_table(self):
+        with self.engine.connect() as connection:
+            with connection.begin():
+                connection.execute(text(f'''CREATE TABLE IF NOT EXISTS {self.checkpoint_table} (
+                                                checkpoint_key TEXT PRIMARY KEY,
+                                                last_anon_case_no TEXT,
+                                                last_id BIGINT,
+                                                measurement_id_start BIGINT NOT NULL,
+                                                completed BOOLEAN NOT NULL DEFAULT FALSE,
+                                                updated_at TIMESTAMP NOT NULL DEFAULT now()
+                                            )'''))
+
+    def load_checkpoints(self):
+        with self.engine.connect() as connection:
+            with connection.begin():
+                res = connection.execute(text(f"SELECT checkpoint_key, last_anon_case_no, last_id, measurement_id_start, completed FROM {self.checkpoint_table}"))
+                return {row[0]: {"last_key": None if row[1] is None else [row[1], row[2]],
+                                 "measurement_id_start": row[3], "completed": row[4]} for row in res}
+
+    def save_checkpoint(self, connection, checkpoint, completed=False):
+        # Upserted in the transaction of the batch COPY, so a batch and its checkpoint commit (or roll back) together
+        last_anon_case_no, last_id = (None, None) if checkpoint["last_key"] is None else checkpoint["last_key"]
+        connection.execute(text(f'''INSERT INTO {self.checkpoint_table} (checkpoint_key, last_anon_case_no, last_id, measurement_id_start, completed, updated_at)
+                                     VALUES (:checkpoint_key, :last_anon_case_no, :last_id, :measurement_id_start, :completed, now())
+                                     ON CONFLICT (checkpoint_key) DO UPDATE SET
+                                        last_anon_case_no = EXCLUDED.last_anon_case_no,
+                                        last_id = EXCLUDED.last_id,
+                                        measurement_id_start = EXCLUDED.measurement_id_start,
+                                        completed = EXCLUDED.completed,
+                                        updated_at = EXCLUDED.updated_at'''),
+                           {"checkpoint_key": self.checkpoint_key, "last_anon_case_no": last_anon_case_no, "last_id": last_id,
+                            "measurement_id_start": checkpoint["measurement_id_start"], "completed": completed})
+
+    def plan_id_bounds(self):
+        # Source ids loaded by this run, a resumed run continues with the bounds and measurement_id_start it recorded
+        source_table_names = [source_table_cols["table"] for source_table_cols in self.source_tables_cols]
+        watermarks = self.watermark.load()
+        pending = [watermarks[name] for name in source_table_names if name in watermarks and watermarks[name]["target_id"] is not None]
+        if not (self.resume and len(pending) > 0):
+            if self.incremental:
+                missing = [name for name in source_table_names if watermarks.get(name, {}).get("last_id") is None]
+                if len(missing) > 0:
+                    raise ValueError(f"No measurement watermark for {missing}, run a full measurement load first")
+            # Rows added to the source while this run is in progress are left for the next one
+            target_ids = {name: self.fetch_max_source_id(name) for name in source_table_names}
+            # New measurement_ids follow the existing ones, rows loaded by earlier runs keep theirs
+            omop_id_start = self.fetch_next_measurement_id() if self.incremental else 1
+            self.watermark.begin_run(target_ids, omop_id_start, full_load=not self.incremental)
+            watermarks = self.watermark.load()
+            pending = [watermarks[name] for name in source_table_names]
+        self.id_bounds = {name: (watermarks[name]["last_id"], watermarks[name]["target_id"])
+                          for name in source_table_names if name in watermarks}
+        self.measurement_id_start = pending[0]["omop_id_start"]
+        print(f"measurement source id bounds {self.id_bounds}, measurement_id starts at {self.measurement_id_start}")
+
+    def fetch_max_source_id(self, source_table_name):
+        with self.engine.connect() as connection:
+            with connection.begin():
+                return connection.execute(text(f"SELECT COALESCE(MAX(id), 0) FROM {source_table_name}")).first()[0]
+
+    def fetch_next_measurement_id(self):
+        with self.engine.connect() as connection:
+            with connection.begin():
+                return connection.execute(text(f"SELECT COALESCE(MAX(measurement_id), 0) + 1 FROM {self.omop_schema}.measurement")).first()[0]
+
+    def complete_watermarks(self):
+        # Every source table is loaded up to its target id, the next incremental run starts above it
+        with self.engine.connect() as connection:
+            with connection.begin():
+                for source_table_cols in self.source_tables_cols:
+                    if source_table_cols["table"] == self.source.INTRAOP_AIMSVITALS.value and self.measurement_aimsvitals_fetch_limit > 0:
+                        continue # Partially loaded, no watermark so that an incremental run asks for a full load first
+                    self.watermark.complete(connection, source_table_cols["table"])
+
+    def source_id_conditions(self, source_table_name, alias="s"):
+        # Restricts a source table to the ids of this run
+        after_id, up_to_id = self.id_bounds.get(source_table_name, (None, None))
+        conditions, params = [], {}
+        if after_id is not None:
+            conditions.append(f"{alias}.id > :after_id")
+            params["after_id"] = after_id
+        if up_to_id is not None:
+            conditions.append(f"{alias}.id <= :up_to_id")
+            params["up_to_id"] = up_to_id
+        return conditions, params
+
     def create_temp_concept_table(self):
          with self.engine.connect() as connection:
             with connection.begin():
@@ -112,8 +252,34 @@ class measurement():
                                                     and sc.target_concept_id = c.concept_id'''
                                     )
                                 )
+                # Load every source_vocabulary_id mapping once instead of querying the temp table on every batch
+                concept_df = pd.read_sql_query(text(f"select source_vocabulary_id, source_code, target_concept_id from {self.temp_concept_table}"), con=connection)
+         self.load_concept_maps(concept_df)
+
+    def load_concept_maps(self, concept_df):
+        self.concept_maps = {}
+        for source_vocabulary_id, vocabulary_df in concept_df.groupby("source_vocabulary_id"):
+            vocabulary_df = vocabulary_df.drop_duplicates(subset="source_code") # Lookup keys must be unique
+            # Trailing 0 is picked up by the -1 position of unmapped codes
+            target_concept_ids = np.append(vocabulary_df["target_concept_id"].to_numpy(dtype="int64"), 0)
+            self.concept_maps[source_vocabulary_id] = (pd.Index(vocabulary_df["source_code"]), target_concept_ids)
+            print(f"{len(vocabulary_df)} concept mappings loaded for {source_vocabulary_id}..")
+
+    def map_concept_id(self, source_values, source_vocabulary_id):
+        # Resolve target_concept_id per source value, 0 for those missing standard concept mapping
+        source_codes, target_concept_ids = self.concept_maps.get(source_vocabulary_id, (pd.Index([]), np.zeros(1, dtype="int64")))
+        source_categories = pd.Categorical(source_values)
+        # Hash lookup once per distinct source value, NULL source values (code -1) pick the trailing -1 position
+        category_positions = np.append(source_codes.get_indexer(source_categories.categories), -1)
+        return target_concept_ids.take(category_positions.take(source_categories.codes))
 
     def process(self):
+        if self.workers > 1:
+            self.process_in_parallel()
+            self.complete_watermarks()
+            return
+
+        checkpoints = self.load_checkpoints() if self.resume else {}
         for source_table_cols in self.source_tables_cols:
             # if source_table_cols["table"] not in [
             #                                     #   f"{self.source_preop_schema}.lab", 
@@ -122,33 +288,149 @@ class measurement():
             #                                     ]:
                 print(source_table_cols)
                 self.limit, self.offset = int(os.getenv("PROCESSING_BATCH_SIZE")), 0
+                self.last_key = None
+                self.checkpoint_key = source_table_cols['table']
+                checkpoint = checkpoints.get(self.checkpoint_key)
+                if checkpoint is not None:
+                    # Continue after the last committed batch, with the measurement_id_start that followed it
+                    self.last_key, self.measurement_id_start = checkpoint["last_key"], checkpoint["measurement_id_start"]
+                    if checkpoint["completed"]:
+                        print(f"{source_table_cols['table']} completed in a previous run, skipped..")
+                        continue
+                    print(f"Resuming {source_table_cols['table']} after {self.last_key}..")
+                if self.fetch_mode in ("keyset", "stream"):
+                    self.create_keyset_index(source_table_cols['table'])
                 self.process_by_source_table(source_table_cols)
                 print(f"{source_table_cols['table']} processing completed..")
-        # Update the 
-        self.update_unit_concept_id()
-
-    def process_by_source_table(self, source_table_cols):
+        self.complete_watermarks()
+
+    def process_in_parallel(self):
+        tasks = self.plan_tasks()
+        # Workers open their own engine, spawned rather than forked since the etl scheduler runs entities in threads
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {executor.submit(process_measurement_task, task): task for task in tasks}
+            for future in as_completed(futures):
+                task = futures[future]
+                future.result() # Re-raises the worker error
+                print(f"{task['source_table_cols']['table']} range {task['lower_key']} - {task['upper_key']} processing completed..")
+
+    def plan_tasks(self):
+        # Deterministic measurement_id block per task, sized from the source counts so ids stay unique and reproducible
+        # Resume expects the same OMOP_MEASUREMENT_WORKERS as the run being resumed, checkpoint keys follow the task ranges
+        checkpoints = self.load_checkpoints() if self.resume else {}
+        tasks = []
+        measurement_id_start = self.measurement_id_start
+        for source_table_cols in self.source_tables_cols:
+            source_table_name = source_table_cols["table"]
+            total_count_source_table = self.fetch_total_count_source_table(source_table_name)
+            key_ranges = [(None, None, total_count_source_table)]
+            if self.fetch_mode in ("keyset", "stream"):
+                self.create_keyset_index(source_table_name)
+                if source_table_name == self.source.INTRAOP_AIMSVITALS.value:
+                    key_ranges = self.split_key_ranges(source_table_name, total_count_source_table, self.workers)
+            for range_index, (lower_key, upper_key, row_count) in enumerate(key_ranges):
+                task = {"source_table_cols": source_table_cols, "lower_key": lower_key, "upper_key": upper_key,
+                        "row_count": row_count, "measurement_id_start": measurement_id_start,
+                        "checkpoint_key": source_table_name if len(key_ranges) == 1 else f"{source_table_name}[{range_index}]",
+                        "concept_maps": self.concept_maps, "id_bounds": self.id_bounds.get(source_table_name, (None, None))}
+                print(f"{source_table_name} range {lower_key} - {upper_key} measurement_id block starts at {measurement_id_start}")
+                measurement_id_start += row_count * self.measurements_per_row.get(source_table_name, 1)
+                checkpoint = checkpoints.get(task["checkpoint_key"])
+                if checkpoint is not None:
+                    if checkpoint["completed"]:
+                        print(f"{task['checkpoint_key']} completed in a previous run, skipped..")
+                        continue
+                    task["lower_key"] = checkpoint["last_key"] if checkpoint["last_key"] is not None else lower_key
+                    task["measurement_id_start"] = checkpoint["measurement_id_start"]
+                tasks.append(task)
+        return tasks
+
+    def split_key_ranges(self, source_table_name, total_count_source_table, parts):
+        # Splits the first total_count_source_table rows into ranges of equal row count, bounded by (anon_case_no, id)
+        range_size = max(-(-total_count_source_table // parts), 1)
+        keyset = ", ".join(self.keyset_columns)
+        conditions, params = self.source_id_conditions(source_table_name)
+        where_sql = "" if len(conditions) == 0 else " WHERE " + " AND ".join(conditions)
+        with self.engine.connect() as connection:
+            with connection.begin():
+                res = connection.execute(text(f'''SELECT {keyset} FROM (
+                                                    SELECT {keyset}, row_number() over (order by {keyset}) AS row_num
+                                                    FROM {source_table_name} s{where_sql}
+                                                ) s
+                                                WHERE row_num <= :total AND (row_num % :range_size = 0 OR row_num = :total)
+                                                ORDER BY row_num'''),
+                                         params | {"total": total_count_source_table, "range_size": range_size})
+                upper_keys = [list(row) for row in res]
+
+        key_ranges = []
+        lower_key, row_start = None, 0
+        for upper_key in upper_keys:
+            row_end = min(row_start + range_size, total_count_source_table)
+            key_ranges.append((lower_key, upper_key, row_end - row_start))
+            lower_key, row_start = upper_key, row_end
+        return key_ranges if len(key_ranges) > 0 else [(None, None, 0)]
+
+    def process_by_source_table(self, source_table_cols, total_count_source_table=None):
         print(f"Processing {source_table_cols['table']}..")
-        total_count_source_table = self.fetch_total_count_source_table(source_table_cols['table'])
+        if total_count_source_table is None:
+            total_count_source_table = self.fetch_total_count_source_table(source_table_cols['table'])
         print(f"Total count {total_count_source_table}")
-        while self.offset <= total_count_source_table: # Fetch and process in batches
-            source_batch = self.retrieve(source_table_cols)
-            # print(f"measurement id start: {self.measurement_id_start}")
-            transformed_batch = self.transform(source_table_cols, source_batch)
-            self.measurement_id_start += len(transformed_batch)
-            del source_batch
-            self.ingest(transformed_batch)
-            del transformed_batch
-            gc.collect()
-            self.offset = self.offset + self.limit
-            # break
+        # Fetch, transform and ingest in batches, overlapped by the pipeline stages
+        pipeline().run(self.retrieve(source_table_cols, total_count_source_table),
+                       lambda source_batch: self.transform_batch(source_table_cols, source_batch),
+                       self.ingest)
+        with self.engine.connect() as connection:
+            with connection.begin():
+                self.save_checkpoint(connection, {"last_key": self.last_key, "measurement_id_start": self.measurement_id_start}, completed=True)
+
+    def transform_batch(self, source_table_cols, source_batch):
+        # Runs in the transform stage, the checkpoint travels with the batch since the reader has already moved on
+        source_df, last_key = source_batch
+        # print(f"measurement id start: {self.measurement_id_start}")
+        transformed_batch = self.transform(source_table_cols, source_df)
+        transformed_batch["unit_concept_id"] = self.map_unit_concept_id(transformed_batch["measurement_concept_id"])
+        transformed_batch = self.compact(transformed_batch)
+        self.measurement_id_start += len(transformed_batch)
+        return transformed_batch, {"last_key": last_key, "measurement_id_start": self.measurement_id_start}
+
+    def compact(self, transformed_batch):
+        # Compact dtypes per batch: categoricals for repeated codes, nullable numbers, COPY writes them as is
+        for col in ["measurement_source_value", "unit_source_value"]:
+            if col in transformed_batch.columns:
+                transformed_batch[col] = transformed_batch[col].astype("category")
+        if transformed_batch["value_as_number"].dtype == object:
+            try:
+                transformed_batch["value_as_number"] = pd.to_numeric(transformed_batch["value_as_number"]).astype("Float64")
+            except (ValueError, TypeError):
+                pass # Non numeric source values are left for the database to accept or reject
+        return transformed_batch
+
+    def create_keyset_index(self, source_table_name):
+        # Lets every keyset batch start with an index seek instead of sorting the remaining source rows
+        if not self.create_source_index:
+            return
+        index_name = f"{source_table_name.split('.')[-1]}_{'_'.join(self.keyset_columns)}_idx"
+        try:
+            with self.engine.connect() as connection:
+                with connection.begin():
+                    connection.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON {source_table_name} ({', '.join(self.keyset_columns)})"))
+                    if self.incremental:
+                        # Lets the watermark bounds pick the new source rows without scanning the old ones
+                        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {source_table_name.split('.')[-1]}_id_idx ON {source_table_name} (id)"))
+                    connection.execute(text(f"ANALYZE {source_table_name}"))
+        except ProgrammingError as err:
+            if not isinstance(err.orig, errors.InsufficientPrivilege):
+                raise err
+            print(f"No privilege to index {source_table_name}, reading it without the keyset index: {err.orig}")
 
 
     def fetch_total_count_source_table(self, source_table_name):
         source_total_table_count = 0 
         with self.engine.connect() as connection:
             with connection.begin():
-                res = connection.execute(text(f"select count(1) from {source_table_name}"))
+                conditions, params = self.source_id_conditions(source_table_name)
+                where_sql = "" if len(conditions) == 0 else " WHERE " + " AND ".join(conditions)
+                res = connection.execute(text(f"select count(1) from {source_table_name} s{where_sql}"), params)
                 source_total_table_count = res.first()[0]
 
         # This is a special case to control how much source data is ingested from intraop aimsvitals table since it takes a few days to complete
@@ -158,57 +440,112 @@ class measurement():
 
         return source_total_table_count
 
-    def retrieve(self, source_table_cols):
-        source_batch = self.fetch_in_batch_source_table(source_table_cols)
-        source_df = pd.DataFrame(source_batch.fetchall())
-        source_df.columns = source_table_cols["columns"].keys()
-        # print(source_df.head(1))
-        print(f"offset {self.offset} limit {self.limit} batch_count {len(source_df)} for {source_table_cols['table']} retrieved..")
-        return source_df
+    def retrieve(self, source_table_cols, total_count_source_table):
+        # Generator of source batches as DataFrames, each with the key it ends at
+        if self.fetch_mode == "stream":
+            yield from self.stream_source_table(source_table_cols, total_count_source_table)
+            return
+
+        while self.offset <= total_count_source_table:
+            source_batch = self.fetch_in_batch_source_table(source_table_cols)
+            source_df = self.to_dataframe(source_batch.fetchall(), source_table_cols)
+            del source_batch
+            self.remember_last_key(source_df)
+            # print(source_df.head(1))
+            print(f"offset {self.offset} limit {self.limit} last_key {self.last_key} batch_count {len(source_df)} for {source_table_cols['table']} retrieved..")
+            batch_count = len(source_df)
+            yield source_df, self.last_key
+            self.offset = self.offset + self.limit
+            if self.fetch_mode == "keyset" and batch_count < self.limit: # No more rows after the last key
+                break
+
+    def stream_source_table(self, source_table_cols, total_count_source_table):
+        # One server side (named) cursor per source table, rows are pulled from the server a batch at a time
+        limit = None
+        if source_table_cols["table"] == self.source.INTRAOP_AIMSVITALS.value and self.measurement_aimsvitals_fetch_limit > 0:
+            limit = total_count_source_table
+        select_sql, params = self.source_table_query(source_table_cols, limit)
+        with self.engine.connect() as connection:
+            res = connection.execution_options(stream_results=True, yield_per=self.limit).execute(text(select_sql), params)
+            for rows in res.partitions():
+                source_df = self.to_dataframe(rows, source_table_cols)
+                del rows
+                self.remember_last_key(source_df)
+                print(f"offset {self.offset} limit {self.limit} last_key {self.last_key} batch_count {len(source_df)} for {source_table_cols['table']} streamed..")
+                self.offset = self.offset + len(source_df)
+                yield source_df, self.last_key
+
+    def to_dataframe(self, rows, source_table_cols):
+        # Decode row tuples column by column into arrays typed as declared in source_tables_cols
+        source_columns = source_table_cols["columns"]
+        values_by_column = list(zip(*rows)) if len(rows) > 0 else [()] * len(source_columns)
+        return pd.DataFrame({col: self.to_typed_array(values, dtype)
+                             for (col, dtype), values in zip(source_columns.items(), values_by_column)})
+
+    def to_typed_array(self, values, dtype):
+        if dtype is int:
+            numbers = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce")
+            if (numbers.dropna() % 1 == 0).all():
+                return pd.array(numbers, dtype="Int64") # Nullable, source integer columns may contain NULL
+            return numbers.to_numpy(dtype="float64") # Fractional NUMERIC values are kept as they are
+        if dtype is float:
+            # NULL and NUMERIC(Decimal) become float, non numeric text (e.g. '<5') becomes NaN instead of failing the batch
+            return pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy(dtype="float64")
+        if dtype is str:
+            return np.array(values, dtype=object)
+        if dtype == "category":
+            return pd.Categorical(values) # Low cardinality codes, stored once per distinct value
+        return np.array(values, dtype=dtype)
+
+    def remember_last_key(self, source_df):
+        if len(source_df) > 0:
+            # Remember where this batch ended so the next one seeks past it
+            self.last_key = [source_df[col].iloc[-1:].tolist()[0] for col in self.keyset_columns]
 
     def fetch_in_batch_source_table(self, source_table_cols):
-        # Formulate columns and table
-        select_sql = "SELECT "
+        select_sql, params = self.source_table_query(source_table_cols, self.limit)
+        with self.engine.connect() as connection:
+            with connection.begin():
+                res = connection.execute(text(select_sql), params)
+                return res
+
+    def source_table_query(self, source_table_cols, limit=None):
+        # Formulate columns and table, person_id and visit_occurrence_id come from the joined OMOP tables
+        join_columns = {"person_id": "p", "visit_occurrence_id": "v"}
         source_columns = list(source_table_cols["columns"])
-        for idx, col in enumerate(source_columns):
-            if idx < len(source_columns) - 1:
-                select_sql += f"{col},"
-            else:
-                select_sql += f"{col}"
+        select_sql = "SELECT " + ", ".join(f"{join_columns.get(col, 's')}.{col}" for col in source_columns)
         
         # Inner join with OMOP Person table
-        select_sql += f''' FROM {source_table_cols['table']}
-                           INNER JOIN {self.omop_schema}.person ON anon_case_no = person_source_value'''
+        select_sql += f''' FROM {source_table_cols['table']} s
+                           INNER JOIN {self.omop_schema}.person p ON s.anon_case_no = p.person_source_value'''
 
-        # Inner join with OMOP Visit_occurrence table
+        # Inner join with the primary visit_occurrence of the session
         if "visit_occurrence_id" in source_columns:
-            select_sql += f''' INNER JOIN (
-                                            SELECT visit_occurrence_id,
-                                                row_number() over (
-                                                    partition by CAST(
-                                                        LEFT(
-                                                            CAST(visit_occurrence_id AS TEXT),
-                                                            LENGTH(CAST(visit_occurrence_id AS TEXT)) - 2
-                                                        ) AS INTEGER
-                                                    )
-                                                ) rownum,
-                                                CAST(
-                                                    LEFT(
-                                                        CAST(visit_occurrence_id AS TEXT),
-                                                        LENGTH(CAST(visit_occurrence_id AS TEXT)) - 2
-                                                    ) AS INTEGER
-                                                ) AS truncated_visit_occurrence_id
-                                            FROM VISIT_OCCURRENCE
-                                        ) v ON v.truncated_visit_occurrence_id = session_id
-                                        AND v.rownum = 1'''
+            select_sql += f''' INNER JOIN {self.omop_schema}.int__session_visit_occurrence v ON v.session_id = s.session_id'''
         
-        select_sql += f" order by anon_case_no LIMIT {self.limit} OFFSET {self.offset}"
+        # Source ids of this run, all of them unless bounded by the watermark
+        conditions, params = self.source_id_conditions(source_table_cols['table'])
+        if self.fetch_mode in ("keyset", "stream"):
+            # Seek past the previous batch, the cost per batch no longer grows with the offset
+            keyset = ", ".join(f"s.{col}" for col in self.keyset_columns)
+            if self.last_key is not None:
+                conditions.append(f"({keyset}) > ({', '.join(f':last_{col}' for col in self.keyset_columns)})")
+                params |= {f"last_{col}": value for col, value in zip(self.keyset_columns, self.last_key)}
+            if self.upper_key is not None:
+                conditions.append(f"({keyset}) <= ({', '.join(f':upper_{col}' for col in self.keyset_columns)})")
+                params |= {f"upper_{col}": value for col, value in zip(self.keyset_columns, self.upper_key)}
+            if len(conditions) > 0:
+                select_sql += " WHERE " + " AND ".join(conditions)
+            select_sql += f" order by {keyset}"
+            if limit is not None:
+                select_sql += f" LIMIT {limit}"
+        else:
+            if len(conditions) > 0:
+                select_sql += " WHERE " + " AND ".join(conditions)
+            select_sql += f" order by s.anon_case_no LIMIT {limit} OFFSET {self.offset}"
         # select_sql += f" order by anon_case_no LIMIT 2"
         # print(select_sql)
-        with self.engine.connect() as connection:
-            with connection.begin():
-                res = connection.execute(text(select_sql))
-                return res
+        return select_sql, params
 
     def transform(self, source_table_cols, source_batch):
         measurement_schema = {
@@ -219,11 +556,11 @@ class measurement():
             "measurement_date": "datetime64[ns]",
             "measurement_datetime": "datetime64[ns]",
             "measurement_time": str,
-            "value_as_number": object,
-            "measurement_source_value": str,
+            "value_as_number": "Float64",
+            "measurement_source_value": "category",
             "value_source_value": str,
             "visit_occurrence_id": int,
-            "unit_source_value": str
+            "unit_source_value": "category"
         }
         # Initialize dataframe and display columns info
         measurement_df = pd.DataFrame(columns=measurement_schema.keys()).astype(measurement_schema)
@@ -253,61 +590,42 @@ class measurement():
     def transform_preop_lab(self, source_table_cols, source_batch, measurement_df):
         print(f"INSIDE transform_preop_lab..")
         
-        # Load specific source codes mapping into df
-        concept_df = pd.read_sql_query(f"select source_code, target_concept_id from {self.temp_concept_table} where source_vocabulary_id='SG_PASAR_PREOP_LAB'", con=self.engine)
+        source_vocabulary_id = 'SG_PASAR_PREOP_LAB'
 
         if len(source_batch) > 0:
             measurement_df["person_id"] = source_batch["person_id"]
-            measurement_df["measurement_date"] = pd.to_datetime(source_batch["preop_lab_collection_datetime"]).dt.date
+            measurement_df["measurement_date"] = pd.to_datetime(source_batch["preop_lab_collection_datetime"]).dt.normalize()
             measurement_df["measurement_datetime"] = source_batch["preop_lab_collection_datetime"]
             measurement_df["measurement_type_concept_id"] = 32879
             measurement_df["value_as_number"] = source_batch["preop_lab_result_value"]
             measurement_df["measurement_source_value"] = source_batch["preop_lab_test_description"]
             
-            # Left Join with temporary concept df
-            measurement_df = pd.merge(measurement_df, concept_df, how="left", left_on='measurement_source_value', right_on='source_code')
-            measurement_df["measurement_concept_id"] = measurement_df["target_concept_id"]
-            measurement_df.fillna({"measurement_concept_id": 0}, inplace=True) # For those missing standard concept mapping
-            measurement_df.drop(['source_code', 'target_concept_id'], axis=1, inplace=True)
+            # Lookup in the concept map loaded for the run
+            measurement_df["measurement_concept_id"] = self.map_concept_id(measurement_df["measurement_source_value"], source_vocabulary_id)
             
             measurement_df["visit_occurrence_id"] = source_batch["visit_occurrence_id"]
             measurement_df["measurement_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
 
 
         # print(measurement_df.head(3))
-        del concept_df
         return measurement_df
 
     def transform_preop_char(self, source_table_cols, source_batch, measurement_df):
         # 1 to Many
         print(f"INSIDE transform_preop_char..")
         
-        measurement_score_columns = ["height","weight","bmi", "systolic_bp", "diastolic_bp", "heart_rate", "o2_saturation", "temperature", "pain_score"]
+        measurement_score_columns = self.preop_char_score_columns
         # 1:1 mapping index between measurement_score_columns and measurement_char_concept_ids
         measurement_char_concept_ids = [607590, 4099154, 4245997, 4152194, 4154790, 3027018, 4020553, 4302666, 4022240]
         
         if len(source_batch) > 0:
             measurement_df["person_id"] = source_batch["person_id"]
-            measurement_df["measurement_date"] = pd.to_datetime(source_batch["session_startdate"]).dt.date
+            measurement_df["measurement_date"] = pd.to_datetime(source_batch["session_startdate"]).dt.normalize()
             measurement_df["measurement_type_concept_id"] = 32879
-            value_as_number_df = source_batch[measurement_score_columns] # Assumption Ignoring "o2_supplementaries" since its an additional value for the o2_saturation
-            measurement_df["value_as_number"] = value_as_number_df.apply(lambda row: row.tolist(), axis=1)
-            measurement_df["measurement_source_value"] = [measurement_score_columns]*len(measurement_df)
-            # value_as_source_df = source_batch[["o2_supplementaries"]]
-            # measurement_df["value_source_value"] = value_as_source_df.apply(lambda row: row.tolist(), axis=1)
-            measurement_df["measurement_concept_id"] = [measurement_char_concept_ids]*len(measurement_df)
-
-            # To maintain linkage between the records defined in measurement_score_columns
-            measurement_df["meas_event_field_concept_id"] = 1147330
-            measurement_df["unique_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
-            measurement_df["measurement_event_id"] = measurement_df["unique_id"].apply(lambda row: [row]*len(measurement_score_columns))
-            del measurement_df["unique_id"]
-
             measurement_df["visit_occurrence_id"] = source_batch["visit_occurrence_id"] 
 
-            # Transpose magic happens
-            measurement_df = measurement_df.explode(['value_as_number', 'measurement_source_value', 'measurement_concept_id', 'measurement_event_id'])
-            measurement_df = measurement_df.dropna(subset=['value_as_number'], thresh=1)
+            # Transpose magic happens, assumption Ignoring "o2_supplementaries" since its an additional value for the o2_saturation
+            measurement_df = self.unpivot(measurement_df, source_batch, measurement_score_columns, "value_as_number", measurement_char_concept_ids)
             measurement_df["measurement_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
             # print(measurement_df.head(3))
 
@@ -316,140 +634,109 @@ class measurement():
     def transform_intraop_aimsvitals(self, source_table_cols, source_batch, measurement_df):
         print(f"INSIDE transform_intraop_aimsvitals..")
         
-        # Load specific source codes mapping into df
-        concept_df = pd.read_sql_query(f"select source_code, target_concept_id from {self.temp_concept_table} where source_vocabulary_id='SG_PASAR_INTRAOP_AIMS_VITALS'", con=self.engine)
+        source_vocabulary_id = 'SG_PASAR_INTRAOP_AIMS_VITALS'
 
         if len(source_batch) > 0:
             measurement_df["person_id"] = source_batch["person_id"]
-            measurement_df["measurement_date"] = pd.to_datetime(source_batch["vital_date"]).dt.date
+            measurement_df["measurement_date"] = pd.to_datetime(source_batch["vital_date"]).dt.normalize()
             measurement_df["measurement_datetime"] = source_batch["vitaldt"]
             measurement_df["measurement_time"] = source_batch["vital_time"]
             measurement_df["measurement_type_concept_id"] = 32879
             measurement_df["value_as_number"] = source_batch["vital_num_value"]
             measurement_df["measurement_source_value"] = source_batch["vitalcode"]
             
-            # Left Join with temporary concept df
-            measurement_df = pd.merge(measurement_df, concept_df, how="left", left_on='measurement_source_value', right_on='source_code')
-            measurement_df["measurement_concept_id"] = measurement_df["target_concept_id"]
-            measurement_df.fillna({"measurement_concept_id": 0}, inplace=True) # For those missing standard concept mapping
-            measurement_df.drop(['source_code', 'target_concept_id'], axis=1, inplace=True)
+            # Lookup in the concept map loaded for the run
+            measurement_df["measurement_concept_id"] = self.map_concept_id(measurement_df["measurement_source_value"], source_vocabulary_id)
             
             measurement_df["visit_occurrence_id"] = source_batch["visit_occurrence_id"]
             measurement_df["measurement_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
 
-        del concept_df
         # print(measurement_df.head(1))
         return measurement_df
 
     def transform_intraop_operation(self, source_table_cols, source_batch, measurement_df):
         print(f"INSIDE transform_intraop_operation..")
 
-        # Load specific source codes mapping into df
-        concept_df = pd.read_sql_query(f"select source_code, target_concept_id from {self.temp_concept_table} where source_vocabulary_id='SG_PASAR_INTRAOP_AIMS_VITALS'", con=self.engine)
+        source_vocabulary_id = 'SG_PASAR_INTRAOP_AIMS_VITALS'
 
         if len(source_batch) > 0:
             measurement_df["person_id"] = source_batch["person_id"]
-            measurement_df["measurement_date"] = pd.to_datetime(source_batch["vital_signs_taken_date"]).dt.date
+            measurement_df["measurement_date"] = pd.to_datetime(source_batch["vital_signs_taken_date"]).dt.normalize()
             measurement_df["measurement_datetime"] = source_batch["vital_signs_taken_datetime"]
             measurement_df["measurement_time"] = source_batch["vital_signs_taken_time"]
             measurement_df["measurement_type_concept_id"] = 32879
             measurement_df["value_as_number"] = source_batch["vital_signs_result"]
             measurement_df["measurement_source_value"] = source_batch["vital_code"]
 
-            # Left Join with temporary concept df
-            measurement_df = pd.merge(measurement_df, concept_df, how="left", left_on='measurement_source_value', right_on='source_code')
-            measurement_df["measurement_concept_id"] = measurement_df["target_concept_id"]
-            measurement_df.fillna({"measurement_concept_id": 0}, inplace=True) # For those missing standard concept mapping
-            measurement_df.drop(['source_code', 'target_concept_id'], axis=1, inplace=True)            
+            # Lookup in the concept map loaded for the run
+            measurement_df["measurement_concept_id"] = self.map_concept_id(measurement_df["measurement_source_value"], source_vocabulary_id)
             
             measurement_df["visit_occurrence_id"] = source_batch["visit_occurrence_id"]
             measurement_df["measurement_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
 
         # print(measurement_df.head(1))
-        del concept_df
         return measurement_df
 
     def transform_postop_lab(self, source_table_cols, source_batch, measurement_df):
         print(f"INSIDE transform_postop_lab..")
 
-        # Load specific source codes mapping into df
-        concept_df = pd.read_sql_query(f"select source_code, target_concept_id from {self.temp_concept_table} where source_vocabulary_id='SG_PASAR_POSTOP_LAB'", con=self.engine)
+        source_vocabulary_id = 'SG_PASAR_POSTOP_LAB'
 
         # Assumption picking only max values for simplicity and ignoring the min values
         if len(source_batch) > 0:
             measurement_df["person_id"] = source_batch["person_id"]
-            measurement_df["measurement_date"] = pd.to_datetime(source_batch["postop_lab_collection_datetime_max"]).dt.date
+            measurement_df["measurement_date"] = pd.to_datetime(source_batch["postop_lab_collection_datetime_max"]).dt.normalize()
             measurement_df["measurement_datetime"] = source_batch["postop_lab_collection_datetime_max"]
             measurement_df["measurement_type_concept_id"] = 32879
             measurement_df["value_as_number"] = source_batch["postop_result_value_max"]
             measurement_df["measurement_source_value"] = source_batch["postop_lab_test_desc"]
             measurement_df["measurement_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
 
-            # Left Join with temporary concept df
-            measurement_df = pd.merge(measurement_df, concept_df, how="left", left_on='measurement_source_value', right_on='source_code')
-            measurement_df["measurement_concept_id"] = measurement_df["target_concept_id"]
-            measurement_df.fillna({"measurement_concept_id": 0}, inplace=True) # For those missing standard concept mapping
-            measurement_df.drop(['source_code', 'target_concept_id'], axis=1, inplace=True)         
+            # Lookup in the concept map loaded for the run
+            measurement_df["measurement_concept_id"] = self.map_concept_id(measurement_df["measurement_source_value"], source_vocabulary_id)
 
             measurement_df["visit_occurrence_id"] = source_batch["visit_occurrence_id"]
             measurement_df["measurement_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
 
         # print(measurement_df.head(1))
-        del concept_df
         return measurement_df
 
 
     def transform_postop_labsall(self, source_table_cols, source_batch, measurement_df):
         print(f"INSIDE transform_postop_labsall..")
 
-        # Load specific source codes mapping into df
-        concept_df = pd.read_sql_query(f"select source_code, target_concept_id from {self.temp_concept_table} where source_vocabulary_id='SG_PASAR_POSTOP_LABS_ALL'", con=self.engine)
+        source_vocabulary_id = 'SG_PASAR_POSTOP_LABS_ALL'
 
         if len(source_batch) > 0:
             measurement_df["person_id"] = source_batch["person_id"]
-            measurement_df["measurement_date"] = pd.to_datetime(source_batch["gen_lab_specimen_collection_date"]).dt.date
+            measurement_df["measurement_date"] = pd.to_datetime(source_batch["gen_lab_specimen_collection_date"]).dt.normalize()
             measurement_df["measurement_datetime"] = None
             measurement_df["measurement_time"] = source_batch["gen_lab_specimen_collection_time"]
             measurement_df["measurement_type_concept_id"] = 32879
             measurement_df["value_source_value"] = source_batch["gen_lab_result_value"]
             measurement_df["measurement_source_value"] = source_batch["gen_lab_lab_test_code"]
 
-            # Left Join with temporary concept df
-            measurement_df = pd.merge(measurement_df, concept_df, how="left", left_on='measurement_source_value', right_on='source_code')
-            measurement_df["measurement_concept_id"] = measurement_df["target_concept_id"]
-            measurement_df.fillna({"measurement_concept_id": 0}, inplace=True) # For those missing standard concept mapping
-            measurement_df.drop(['source_code', 'target_concept_id'], axis=1, inplace=True)
+            # Lookup in the concept map loaded for the run
+            measurement_df["measurement_concept_id"] = self.map_concept_id(measurement_df["measurement_source_value"], source_vocabulary_id)
             
             measurement_df["visit_occurrence_id"] = source_batch["visit_occurrence_id"]
             measurement_df["measurement_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
 
         # print(measurement_df.head(1))
-        del concept_df
         return measurement_df
 
     def transform_preop_others(self, source_table_cols, source_batch, measurement_df):
         print(f"INSIDE transform_preop_others..")
         # 1 to Many
-        measurement_score_columns = ["efs_total_score","asa_score_aims","asa_score_eaf"]
+        measurement_score_columns = self.preop_others_score_columns
         if len(source_batch) > 0:
             measurement_df["person_id"] = source_batch["person_id"]
-            measurement_df["measurement_date"] = pd.to_datetime(source_batch["session_startdate"]).dt.date
+            measurement_df["measurement_date"] = pd.to_datetime(source_batch["session_startdate"]).dt.normalize()
             measurement_df["measurement_type_concept_id"] = 32879
-            value_as_number_df = source_batch[measurement_score_columns]
-            measurement_df["value_as_number"] = value_as_number_df.apply(lambda row: row.tolist(), axis=1)
-            measurement_df["measurement_source_value"] = [measurement_score_columns]*len(measurement_df)
             measurement_df["measurement_concept_id"] = 0 # Lack of information on mapping
-            
-            # To maintain linkage between the records defined in measurement_score_columns
-            measurement_df["meas_event_field_concept_id"] = 1147330
-            measurement_df["unique_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
-            measurement_df["measurement_event_id"] = measurement_df["unique_id"].apply(lambda row: [row]*len(measurement_score_columns))
-            del measurement_df["unique_id"]
-
             measurement_df["visit_occurrence_id"] = source_batch["visit_occurrence_id"]
             
-            measurement_df = measurement_df.explode(['value_as_number', 'measurement_source_value', 'measurement_event_id'])
-            measurement_df = measurement_df.dropna(subset=['value_as_number'], thresh=1)
+            measurement_df = self.unpivot(measurement_df, source_batch, measurement_score_columns, "value_as_number")
             measurement_df["measurement_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
             # print(measurement_df.head(len(measurement_df)))
         return measurement_df
@@ -458,93 +745,101 @@ class measurement():
         print(f"INSIDE transform_preop_riskindex..")
         # 1 to Many
         # Assumption adding cardiac_risk_index as part of value_source_value instead of value_as_number for simplicity
-        measurement_score_columns = ["asa_class","cri_functional_status","cardiac_risk_index","cardiac_risk_class","osa_risk_index","act_risk"]
+        measurement_score_columns = self.preop_riskindex_score_columns
         if len(source_batch) > 0:
             measurement_df["person_id"] = source_batch["person_id"]
-            measurement_df["measurement_date"] = pd.to_datetime(source_batch["session_startdate"]).dt.date
+            measurement_df["measurement_date"] = pd.to_datetime(source_batch["session_startdate"]).dt.normalize()
             measurement_df["measurement_type_concept_id"] = 32879
-            value_as_source_df = source_batch[measurement_score_columns]
-            measurement_df["value_source_value"] = value_as_source_df.apply(lambda row: row.tolist(), axis=1)
-            measurement_df["measurement_source_value"] = [measurement_score_columns]*len(measurement_df)
             measurement_df["measurement_concept_id"] = 0 # Lack of information on mapping
-
-            # To maintain linkage between the records defined in measurement_score_columns
-            measurement_df["meas_event_field_concept_id"] = 1147330
-            measurement_df["unique_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
-            measurement_df["measurement_event_id"] = measurement_df["unique_id"].apply(lambda row: [row]*len(measurement_score_columns))
-            del measurement_df["unique_id"]
-
             measurement_df["visit_occurrence_id"] = source_batch["visit_occurrence_id"] 
             
-            measurement_df = measurement_df.explode(['value_source_value', 'measurement_source_value', 'measurement_event_id'])
-            measurement_df = measurement_df.dropna(subset=['value_source_value'], thresh=1)
+            measurement_df = self.unpivot(measurement_df, source_batch, measurement_score_columns, "value_source_value")
             measurement_df["measurement_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
             # print(measurement_df.head(len(measurement_df)))
         return measurement_df
 
+    def load_unit_concept_map(self):
+        # measurement_concept_id -> unit_concept_id, resolved per batch so rows are written once in final form
+        unit_concept_df = pd.read_csv(self.unit_concept_file, dtype="int64").drop_duplicates(subset="measurement_concept_id")
+        self.unit_concept_map = (pd.Index(unit_concept_df["measurement_concept_id"]), unit_concept_df["unit_concept_id"].to_numpy())
+
+    def map_unit_concept_id(self, measurement_concept_ids):
+        # NULL for measurement concepts without a unit mapping
+        measurement_concept_index, unit_concept_ids = self.unit_concept_map
+        positions = measurement_concept_index.get_indexer(pd.to_numeric(measurement_concept_ids))
+        return pd.arrays.IntegerArray(unit_concept_ids.take(positions, mode="clip"), positions < 0)
+
+    def unpivot(self, measurement_df, source_batch, measurement_score_columns, value_column, measurement_concept_ids=None):
+        # Wide to long for 1 to Many sources: one measurement per source row and score column, ordered by row then column.
+        # Rows without a value are dropped, measurement_concept_ids (1:1 with measurement_score_columns) is optional
+        score_count, row_count = len(measurement_score_columns), len(measurement_df)
+        score_df = source_batch[measurement_score_columns]
+        # Row major, already in row then column order. Numeric scores stay float64 instead of boxed objects
+        if all(pd.api.types.is_numeric_dtype(dtype) for dtype in score_df.dtypes):
+            values = score_df.to_numpy(dtype="float64", na_value=np.nan).ravel()
+        else:
+            values = score_df.to_numpy(dtype=object).ravel()
+        long_df = measurement_df.iloc[np.repeat(np.arange(row_count), score_count)].reset_index(drop=True)
+        long_df[value_column] = values
+        long_df["measurement_source_value"] = pd.Categorical.from_codes(np.tile(np.arange(score_count), row_count), categories=measurement_score_columns)
+        if measurement_concept_ids is not None:
+            long_df["measurement_concept_id"] = np.tile(np.array(measurement_concept_ids, dtype="int64"), row_count)
+
+        # To maintain linkage between the records defined in measurement_score_columns
+        long_df["meas_event_field_concept_id"] = 1147330
+        long_df["measurement_event_id"] = np.repeat(np.arange(self.measurement_id_start, self.measurement_id_start + row_count), score_count)
+        return long_df.loc[pd.notna(values)].reset_index(drop=True)
+
     def transform_intraop_nurvitals(self, source_table_cols, source_batch, measurement_df):
         print(f"INSIDE transform_intraop_nurvitals..")
 
-        # Load specific source codes mapping into df
-        concept_df = pd.read_sql_query(f"select source_code, target_concept_id from {self.temp_concept_table} where source_vocabulary_id='SG_PASAR_INTRAOP_NUR_VITALS'", con=self.engine)
+        source_vocabulary_id = 'SG_PASAR_INTRAOP_NUR_VITALS'
 
         if len(source_batch) > 0:
             measurement_df["person_id"] = source_batch["person_id"]
-            measurement_df["measurement_date"] = pd.to_datetime(source_batch["authored_datetime"]).dt.date
+            measurement_df["measurement_date"] = pd.to_datetime(source_batch["authored_datetime"]).dt.normalize()
             measurement_df["measurement_datetime"] = source_batch["authored_datetime"]
             measurement_df["measurement_source_value"] = source_batch["document_item_name"]
             measurement_df["measurement_type_concept_id"] = 32879
 
             measurement_df["value_source_value"] = source_batch["value_text"] # Contains mix of text and numeric. Could replicate the numeric values to othe column value_as_number based on the type of document_item_name/measurement_source_value
             
-            # Left Join with temporary concept df
-            measurement_df = pd.merge(measurement_df, concept_df, how="left", left_on='measurement_source_value', right_on='source_code')
-            measurement_df["measurement_concept_id"] = measurement_df["target_concept_id"]
-            measurement_df.fillna({"measurement_concept_id": 0}, inplace=True) # For those missing standard concept mapping
-            measurement_df.drop(['source_code', 'target_concept_id'], axis=1, inplace=True)
+            # Lookup in the concept map loaded for the run
+            measurement_df["measurement_concept_id"] = self.map_concept_id(measurement_df["measurement_source_value"], source_vocabulary_id)
             
             measurement_df["visit_occurrence_id"] = None # There's no session_id involved with source table
             measurement_df["measurement_id"] = range(self.measurement_id_start, (self.measurement_id_start + len(measurement_df)))
 
         # print(measurement_df.head(1))
-        del concept_df
         return measurement_df
 
     def ingest(self, transformed_batch):
-        transformed_batch.to_sql(name="measurement", schema=self.omop_schema, con=self.engine, if_exists="append", index=False)
-        print(f"offset {self.offset} limit {self.limit} batch_count {len(transformed_batch)} ingested..")
-
-
-    def update_unit_concept_id(self):
-        update_unit_concept_sql = f"""With unit_concept_mapping AS (
-                                        SELECT column1 as "measurement_concept_id",
-                                            column2 as "unit_concept_id"
-                                        FROM (
-                                                values (4216098, 8784),
-                                                    (4245152, 8753),
-                                                    (3024171, 8483),
-                                                    (4148615, 8848),
-                                                    (4154790, 8876),
-                                                    (4097430, 9557),
-                                                    (4152194, 8876),
-                                                    (4298431, 8848),
-                                                    (4254663, 8848),
-                                                    (4184637, 8554),
-                                                    (3012888, 8876),
-                                                    (3004249, 8876)
-                                            ) s
-                                    )
-                        UPDATE {self.omop_schema}.measurement
-                        SET unit_concept_id = unit_concept_mapping.unit_concept_id
-                        FROM unit_concept_mapping
-                        WHERE {self.omop_schema}.measurement.measurement_concept_id = unit_concept_mapping.measurement_concept_id"""
-        
+        transformed_batch, checkpoint = transformed_batch
         with self.engine.connect() as connection:
             with connection.begin():
-                connection.execute(text(update_unit_concept_sql))
-                print("Unit Concept IDs updated for measurement..")
+                self.measurement_writer.write(transformed_batch, connection)
+                self.save_checkpoint(connection, checkpoint)
+        print(f"last_key {checkpoint['last_key']} batch_count {len(transformed_batch)} ingested..")
+        del transformed_batch
+        gc.collect()
+
 
     def finalize(self):
         # cleanup
-        self.engine.dispose()
-
+        if self.owns_engine:
+            self.engine.dispose()
+
+
+def process_measurement_task(task):
+    # Runs one planned task in a worker process with its own engine and connections
+    worker = measurement()
+    try:
+        worker.concept_maps = task["concept_maps"]
+        worker.limit, worker.offset = int(os.getenv("PROCESSING_BATCH_SIZE")), 0
+        worker.measurement_id_start = task["measurement_id_start"]
+        worker.last_key, worker.upper_key = task["lower_key"], task["upper_key"]
+        worker.checkpoint_key = task["checkpoint_key"]
+        worker.id_bounds = {task["source_table_cols"]["table"]: task["id_bounds"]}
+        worker.process_by_source_table(task["source_table_cols"], task["row_count"])
+    finally:
+        worker.finalize()
@@ -3,13 +3,18 @@ import os
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 from ..db.utils.postgres import postgres
+from ..db.utils.sql_runner import sql_runner
 # Load environment variables from the .env file
 load_dotenv()
 
 class note:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = ['person', 'visit_occurrence', 'source_to_concept_map']
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
+        self.sql_runner = sql_runner(self.engine)
 
     def execute(self):
         try:
@@ -28,7 +33,7 @@ class note:
                     text(f'SET search_path TO {os.getenv("POSTGRES_OMOP_SCHEMA")}'))
 
                 # Drop stg__note view if exists
-                connection.execute(text("DROP VIEW IF EXISTS stg__note"))
+                self.sql_runner.drop_relation(connection, "stg__note")
 
                 # Delete note table
                 connection.execute(text("DELETE FROM note"))
@@ -41,8 +46,8 @@ class note:
             with connection.begin():
                 # Read from source and create a staging table (stg__note)
                 # create a staging table to perform transformation and joining other required tables
-                connection.execute(
-                    text(f'''
+                self.sql_runner.run_sql(connection, "stg__note",
+                    f'''
                         CREATE OR REPLACE VIEW {omop_schema}.stg__note AS
                             WITH postop__clindoc AS (
                                 SELECT
@@ -63,12 +68,6 @@ class note:
                             -- Filter the table to only include unique value
                             filtered AS (
                                 SELECT * from postop__clindoc WHERE ROW_NUM = 1
-                            ),
-
-                            -- revert visit occurrence id to session id
-                            sessionIDs AS (
-                                SELECT CAST(LEFT(CAST(visit_occurrence_id AS TEXT), LENGTH(CAST(visit_occurrence_id AS TEXT)) - 2) AS INTEGER) AS session_id, *
-                                    FROM {omop_schema}.visit_occurrence
                             )
 
                             SELECT
@@ -91,14 +90,15 @@ class note:
                             -- Join tables needed for person_id, visit_occurrence_id, visit_detail_id
                             JOIN {omop_schema}.person AS CDM_PER
                                 ON clindoc.anon_case_no=CDM_PER.person_source_value
-                            JOIN sessionIDs AS CDM_VisitOcc
+                            -- Primary visit_occurrence_id of the session
+                            JOIN {omop_schema}.int__session_visit_occurrence AS CDM_VisitOcc
                                 ON clindoc.session_id=CDM_VisitOcc.session_id
                             JOIN {omop_schema}.source_to_concept_map AS stcm_note
                                 ON stcm_note.source_code = clindoc.postop_clindoc_item_description
                                 AND stcm_note.source_vocabulary_id = 'SG_PASAR_POSTOP_CLIN_DOC'
 
                         '''
-                     ))
+                     )
 
                 # Read from stg__note and insert into CDM table note
                 connection.execute(
@@ -142,7 +142,8 @@ class note:
                      ))
 
     def finalize(self):
-        self.engine.dispose()
+        if self.owns_engine:
+            self.engine.dispose()
         # Verify if needed
         pass
 
@@ -1,13 +1,19 @@
 import os
 import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from sqlalchemy import text
 import pandas as pd
 from dotenv import load_dotenv
 
 from ..db.utils.postgres import postgres
+from ..db.utils.copy_writer import copy_writer
+from ..db.utils.pipeline import pipeline
+from ..db.utils.sql_runner import sql_runner
 
 from .observation_utils.mappings import ObservationMapping
-from .observation_utils.config import SOURCE_TABLE_COL_NAME, SOURCE_TABLES, CHUNK_SIZE
+from .observation_utils.plan import compile_mapping_plan
+from .observation_utils.config import SOURCE_TABLE_COL_NAME, SOURCE_TABLES, CHUNK_SIZE, ObservationMappingConfig
 
 import logging
 logger = logging.getLogger(__name__)
@@ -18,18 +24,36 @@ load_dotenv()
 
 class observation:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = ['person', 'visit_occurrence', 'concept', 'source_to_concept_map']
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
+        # Rows are staged without observation_id, generate_observation_id numbers and moves them into observation
+        self.staging_table = "stg__observation"
+        self.staging_writer = copy_writer(self.engine, self.staging_table, os.getenv("POSTGRES_OMOP_SCHEMA"))
+        self.sql_runner = sql_runner(self.engine)
+        # Source columns kept in staging to order the observation_id assignment
+        self.staging_order_columns = ObservationMappingConfig.observation_id_mapping["pasar"] + [SOURCE_TABLE_COL_NAME]
+        # stream: server side cursor over the mapped columns with person_id joined in SQL, chunked: SELECT * and person merged in pandas
+        self.fetch_mode = os.getenv("OMOP_OBSERVATION_FETCH_MODE", "stream")
+        # Worker processes, each source table (or id range of a large one) is mapped and ingested in its own process when > 1
+        self.workers = int(os.getenv("OMOP_OBSERVATION_WORKERS", 1))
+        # Compiled from ObservationMappingConfig up front so an invalid config fails before any data is touched
+        self.mapping_plan = compile_mapping_plan()
 
     def execute(self):
         try:
             self.initialize()
             self.process()
             self.generate_observation_id()
-            self.finalize()
         except Exception as err:
             logger.error(f"Error occurred {self.__class__.__name__}")
+            self.drop_staging_table()
             raise err
+        finally:
+            # Also after a failure, so the entity's connections do not outlive it
+            self.finalize()
 
     def initialize(self):
         # For now always truncate for development
@@ -41,39 +65,102 @@ class observation:
                     text(f'SET search_path TO {os.getenv("POSTGRES_OMOP_SCHEMA")}'))
                 # Truncate observation table
                 connection.execute(text("DELETE FROM observation"))
+                # Unlogged staging table, observation columns without observation_id plus the ordering source columns
+                # Left over by a failed run, possibly as the pass-through view of a shadow load
+                self.sql_runner.drop_relation(connection, self.staging_table)
+                connection.execute(text(f"CREATE UNLOGGED TABLE {self.staging_table} (LIKE observation INCLUDING DEFAULTS)"))
+                connection.execute(text(f'''ALTER TABLE {self.staging_table}
+                                                DROP COLUMN observation_id,
+                                                ADD COLUMN id BIGINT,
+                                                ADD COLUMN session_startdate TIMESTAMP,
+                                                ADD COLUMN {SOURCE_TABLE_COL_NAME} TEXT'''))
         logger.info("Truncating Done")
 
     def process(self):
         # Process PASAR to OMOP
         logger.info("Processing PASAR to OMOP...")
         start = time.process_time()
-        omop_person_df = self.get_omop_person_table()
-        allergy_concepts_df = self.get_allergy_concepts()
-        source_to_concept_map_df = self.get_source_to_concept_map()
-        rowsMapped = 0
-        with self.engine.connect() as connection:
+        # Person table is only loaded into pandas when person_id is not resolved by the source query
+        omop_person_df = self.get_omop_person_table() if self.fetch_mode != "stream" else None
+        self.mapping_plan = self.mapping_plan.with_lookups(self.get_allergy_concepts(), self.get_source_to_concept_map())
+        if self.workers > 1:
+            self.process_in_parallel(omop_person_df)
+        else:
             for source_table in SOURCE_TABLES:
-                for chunk in pd.read_sql(
-                    f"""SELECT s.*, v.visit_occurrence_id as omop_visit_occurrence_id 
-                        FROM (SELECT * FROM {source_table} order by anon_case_no, session_id) s 
-                            INNER JOIN {os.getenv("POSTGRES_OMOP_SCHEMA")}.VISIT_OCCURRENCE v
-                                ON SUBSTRING(v.visit_occurrence_id::text,
-                                             1,
-                                             LENGTH(v.visit_occurrence_id::text) - 2) = s.session_id::text;""",
-                    con=connection,
-                    chunksize=CHUNK_SIZE
-                ):
-                    mapped_df = self.mapping(
-                        chunk, omop_person_df, allergy_concepts_df, source_to_concept_map_df, source_table, rowsMapped)
-
-                    self.ingest(mapped_df)
-                    rowsMapped += len(mapped_df)
+                self.process_source_table(source_table, None, omop_person_df)
 
         logger.info(
             f"Total Time taken for observation processing: {time.process_time() - start:.3f}s")
         logger.info("Processing Done")
 
-    def mapping(self, df: pd.DataFrame, omop_person_df: pd.DataFrame, allergy_concepts_df: pd.DataFrame, source_to_concept_map_df: pd.DataFrame, source_table: str, rowsMapped: int) -> pd.DataFrame:
+    def process_source_table(self, source_table: str, id_range: tuple, omop_person_df: pd.DataFrame):
+        observation_mapping = ObservationMapping(self.mapping_plan)
+        with self.engine.connect() as connection:
+            if self.fetch_mode == "stream":
+                # Server side cursor, rows are pulled CHUNK_SIZE at a time instead of the whole result set
+                connection = connection.execution_options(stream_results=True, max_row_buffer=CHUNK_SIZE)
+            chunks = pd.read_sql(
+                self.source_table_query(source_table, id_range),
+                con=connection,
+                chunksize=CHUNK_SIZE
+            )
+
+            # Read, map and ingest chunks, overlapped by the pipeline stages
+            # An id range without rows (or only rows dropped by the visit join) yields a single empty chunk
+            pipeline().run((chunk for chunk in chunks if len(chunk) > 0),
+                           lambda chunk: self.mapping(chunk, observation_mapping, omop_person_df, source_table),
+                           self.ingest)
+
+    def process_in_parallel(self, omop_person_df: pd.DataFrame):
+        # observation_id is assigned after the load, so tasks only share the staging table
+        tasks = [(source_table, id_range) for source_table in SOURCE_TABLES
+                 for id_range in self.split_id_ranges(source_table, self.workers)]
+        # Workers open their own engine, not forked since observation may run in a thread of the etl scheduler
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {executor.submit(process_observation_task, source_table, id_range, omop_person_df, self.mapping_plan): (source_table, id_range)
+                       for source_table, id_range in tasks}
+            for future in as_completed(futures):
+                future.result() # Re-raises the worker error
+                logger.info(f"{futures[future]} processing Done")
+
+    def split_id_ranges(self, source_table: str, parts: int) -> list:
+        # Tables larger than one chunk are split into parts id ranges of about the same row count, None reads the whole table
+        with self.engine.connect() as connection:
+            min_id, max_id, count = connection.execute(
+                text(f"SELECT MIN(id), MAX(id), COUNT(1) FROM {source_table}")).first()
+            if count <= CHUNK_SIZE or parts <= 1:
+                return [None]
+            # Quantiles of id rather than equal widths, sparse ids would leave ranges with few or no rows
+            fractions = ", ".join(str(part / parts) for part in range(1, parts))
+            boundaries = connection.execute(
+                text(f"SELECT percentile_disc(ARRAY[{fractions}]) WITHIN GROUP (ORDER BY id) FROM {source_table}")).scalar()
+        upper_ids = sorted({int(upper_id) for upper_id in boundaries if upper_id < max_id}) + [max_id]
+        lower_ids = [min_id] + [upper_id + 1 for upper_id in upper_ids[:-1]]
+        return list(zip(lower_ids, upper_ids))
+
+    def source_table_query(self, source_table: str, id_range: tuple = None) -> str:
+        omop_schema = os.getenv("POSTGRES_OMOP_SCHEMA")
+        # Visit resolved in the database, integer join on the session's primary (first) visit_occurrence_id
+        visit_join = f"""INNER JOIN {omop_schema}.int__session_visit_occurrence v
+                                ON v.session_id = s.session_id"""
+        if id_range is not None:
+            visit_join += f" WHERE s.id BETWEEN {int(id_range[0])} AND {int(id_range[1])}"
+        if self.fetch_mode != "stream":
+            return f"""SELECT s.*, v.visit_occurrence_id as omop_visit_occurrence_id 
+                        FROM {source_table} s 
+                            {visit_join}
+                        ORDER BY s.anon_case_no, s.session_id;"""
+
+        # Only the columns used by the mappings, person_id left joined like map_person_id
+        select_columns = ", ".join(f"s.{column}" for column in self.mapping_plan.source_tables[source_table].source_columns)
+        return f"""SELECT {select_columns}, p.person_id, v.visit_occurrence_id as omop_visit_occurrence_id
+                    FROM {source_table} s
+                        LEFT JOIN {omop_schema}.person p
+                            ON p.person_source_value = s.{ObservationMappingConfig.person_id_mapping["pasar"]}
+                        {visit_join}
+                    ORDER BY s.anon_case_no, s.session_id;"""
+
+    def mapping(self, df: pd.DataFrame, observation_mapping: ObservationMapping, omop_person_df: pd.DataFrame, source_table: str) -> pd.DataFrame:
         '''
         # # # NO MAPPING FOR THESE COLUMNS
         # observation_datetime
@@ -88,13 +175,11 @@ class observation:
         # obs_event_field_concept_id
         '''
 
-        observation_mapping = ObservationMapping()
         mapped_columns = [
             "person_id",
             "observation_date",
             "visit_occurrence_id",
             "observation_type_concept_id",
-            "observation_id",
             "observation_concept_id",
             "observation_source_value",
             "value_source_value",
@@ -102,9 +187,10 @@ class observation:
             "value_as_string"
         ]
 
-        # # # person_id
-        res = observation_mapping.map_person_id(df, omop_person_df)
-        df = pd.concat([df, res], axis=1)
+        # # # person_id, already resolved by the source query in stream fetch mode
+        if omop_person_df is not None:
+            res = observation_mapping.map_person_id(df, omop_person_df)
+            df = pd.concat([df, res], axis=1)
 
         # # # observation_date
         res = observation_mapping.map_observation_date(df)
@@ -120,26 +206,27 @@ class observation:
 
         # # # value_as_concept_id
         # value_as_concept is only applicable for preop.char source_table.
-        if source_table == "preop.char":
-            res = observation_mapping.map_value_as_concept_id(
-                df, allergy_concepts_df)
+        if observation_mapping.plan.source_tables[source_table].maps_value_as_concept_id:
+            res = observation_mapping.map_value_as_concept_id(df)
             df = pd.concat([df, res], axis=1)
             mapped_columns.append("value_as_concept_id")
 
         # # # map_eav will map observation_concept_id, observation_source_value, value_source_value, value_as_number, value_as_string
+        # Only the omop columns and the observation_id sort keys are carried over to the unpivoted rows
+        id_columns = [column for column in mapped_columns if column in df.columns] + \
+            ObservationMappingConfig.observation_id_mapping["pasar"]
         df = observation_mapping.map_eav(
-            df, source_table, source_to_concept_map_df)
+            df, source_table, id_columns)
 
-        # # # observation_id
-        res = observation_mapping.map_observation_id(df, rowsMapped)
-        df = pd.concat([df, res], axis=1)
+        # # # observation_id is assigned after the bulk load by generate_observation_id
+        df[SOURCE_TABLE_COL_NAME] = pd.Series(source_table, index=df.index, dtype="category")
 
-        # Truncate columns that are not omop
-        df = df[mapped_columns]
+        # Truncate columns that are not omop or needed for ordering
+        df = df[mapped_columns + self.staging_order_columns]
 
         # # # log random sample from df for sanity check
         logger.info("Sample results")
-        logger.info(df.sample(15).sort_index())
+        logger.info(df.sample(min(15, len(df))).sort_index())
 
         return df
 
@@ -147,20 +234,43 @@ class observation:
         # Ingest into OMOP Table
         logger.info("Ingesting into OMOP Table...")
         start = time.process_time()
-        with self.engine.connect() as connection:
-            df.to_sql(name='observation',
-                      con=connection, if_exists='append', schema=os.getenv("POSTGRES_OMOP_SCHEMA"), index=False)
+        self.staging_writer.write(df)
         logger.info(
             f"Total Time taken for observation ingestion: {time.process_time() - start:.3f}s")
         logger.info("Ingestion Done")
 
     def generate_observation_id(self):
-        # TODO: Add generation of running number as observation_id after data mapping has been completed in previous step.
-        # Sorted by ascending order of session_startdate and id
-        pass
+        # Running number as observation_id after data mapping has been completed in previous step.
+        # Sorted by ascending order of session_startdate and id, set based so ids do not depend on chunking
+        logger.info("Generating observation_id...")
+        start = time.process_time()
+        with self.engine.connect() as connection:
+            with connection.begin():
+                connection.execute(
+                    text(f'SET search_path TO {os.getenv("POSTGRES_OMOP_SCHEMA")}'))
+                observation_columns = [column for column in self.staging_writer.get_column_types(connection)
+                                       if column not in self.staging_order_columns]
+                # Source table and source value break ties between rows unpivoted from the same source row
+                order_columns = ", ".join(["session_startdate", "id", SOURCE_TABLE_COL_NAME, "observation_source_value"])
+                connection.execute(text(f'''INSERT INTO observation (observation_id, {", ".join(observation_columns)})
+                                             SELECT ROW_NUMBER() OVER (ORDER BY {order_columns}), {", ".join(observation_columns)}
+                                             FROM {self.staging_table}'''))
+                connection.execute(text(f"DROP TABLE {self.staging_table}"))
+        logger.info(
+            f"Total Time taken for observation_id generation: {time.process_time() - start:.3f}s")
+
+    def drop_staging_table(self):
+        # The unlogged staging rows of a failed run are not kept until the next run
+        try:
+            with self.engine.connect() as connection:
+                with connection.begin():
+                    self.sql_runner.drop_relation(connection, self.staging_table)
+        except Exception as err:
+            logger.error(f"Could not drop {self.staging_table}: {err}")
 
     def finalize(self):
-        self.engine.dispose()
+        if self.owns_engine:
+            self.engine.dispose()
 
     def get_data(self) -> pd.DataFrame:
         with self.engine.connect() as connection:
@@ -207,3 +317,13 @@ class observation:
             df = df.set_index("source_code")[
                 "target_concept_id"]
             return df
+
+
+def process_observation_task(source_table: str, id_range: tuple, omop_person_df: pd.DataFrame, mapping_plan):
+    # Runs one source table (or id range) in a worker process with its own engine and connections
+    worker = observation()
+    try:
+        worker.mapping_plan = mapping_plan
+        worker.process_source_table(source_table, id_range, omop_person_df)
+    finally:
+        worker.finalize()
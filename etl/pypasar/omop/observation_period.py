@@ -3,14 +3,19 @@ import os
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
 from ..db.utils.postgres import postgres
+from ..db.utils.sql_runner import sql_runner
 
 # Load environment variables from the .env file
 load_dotenv()
 
 class observation_period:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = ['person']
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
+        self.sql_runner = sql_runner(self.engine)
 
     def execute(self):
         try:
@@ -28,7 +33,7 @@ class observation_period:
                 connection.execute(
                     text(f'SET search_path TO {os.getenv("POSTGRES_OMOP_SCHEMA")}'))
                 # Drop the view if it exists
-                connection.execute(text("DROP VIEW IF EXISTS stg__observation_period"))
+                self.sql_runner.drop_relation(connection, "stg__observation_period")
                 # Clear all existing rows from the observation_period table
                 connection.execute(text("DELETE FROM observation_period"))
 
@@ -38,30 +43,8 @@ class observation_period:
             os.path.join(os.getenv("BASE_PATH"), "observation_period/stg__observation_period.sql"),
             os.path.join(os.getenv("BASE_PATH"), "observation_period/observation_period.sql")
         ]
-        self.execute_sql_files(sql_files)
-
-    def execute_sql_files(self, file_paths):
-        # Define placeholder to environment variable mappings
-        placeholder_mapping = {
-            "{OMOP_SCHEMA}": os.getenv("POSTGRES_OMOP_SCHEMA"),
-            "{PREOP_SCHEMA}": os.getenv("POSTGRES_SOURCE_PREOP_SCHEMA"),
-            "{POSTOP_SCHEMA}": os.getenv("POSTGRES_SOURCE_POSTOP_SCHEMA")
-        }
-        
-        with self.engine.connect() as connection:
-            with connection.begin():
-                for file_path in file_paths:
-                    with open(file_path, 'r') as file:
-                        # Read the SQL script from the file
-                        sql_script = file.read()
-                        # Replace placeholders with actual values
-                        for placeholder, value in placeholder_mapping.items():
-                            if value is not None:
-                                sql_script = sql_script.replace(placeholder, value)
-                            else:
-                                raise ValueError(f"Environment variable for {placeholder} not set.")
-                        # Execute the SQL script
-                        connection.execute(text(sql_script))
+        self.sql_runner.run_files(sql_files)
 
     def finalize(self):
-        self.engine.dispose()
+        if self.owns_engine:
+            self.engine.dispose()
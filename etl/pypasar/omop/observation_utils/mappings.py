@@ -1,24 +1,20 @@
+import numpy as np
 import pandas as pd
 
 from .config import SOURCE_TABLE_COL_NAME, ObservationMappingConfig
+from .plan import ObservationMappingPlan
 from .util import mapping_wrapper
 
+# Temporary columns holding the EAV column name and value of every unpivoted row
+EAV_COLUMN_COL_NAME = "eav_column"
+EAV_VALUE_COL_NAME = "eav_value"
 
-class ObservationMapping():
-
-    @mapping_wrapper
-    def map_observation_id(self, df: pd.DataFrame, rowsMapped: int) -> pd.DataFrame:
-        observation_id_mapping = ObservationMappingConfig.observation_id_mapping
-        # Sort and reset index to set dataframe index as running index
-        df = df.sort_values(observation_id_mapping["pasar"], ascending=[
-                            False, False]).reset_index(drop=True)
 
-        # Add one to index so that id starts from 1 instead of 0
-        df.index += 1 + rowsMapped
-        # reset_index again to get id as a column
-        df = df.reset_index(names=observation_id_mapping["omop"])
+class ObservationMapping():
 
-        return df[[observation_id_mapping["omop"]]]
+    def __init__(self, plan: ObservationMappingPlan = None):
+        # Compiled once per run and shared by every chunk
+        self.plan = plan
 
     @mapping_wrapper
     def map_person_id(self, df: pd.DataFrame, omop_person_df: pd.DataFrame) -> pd.DataFrame:
@@ -47,22 +43,11 @@ class ObservationMapping():
 
     @mapping_wrapper
     def map_visit_occurrence_id(self, df: pd.DataFrame) -> pd.DataFrame:
+        '''Maps the visit_occurrence_id resolved by the source query, the primary visit of the session'''
         visit_occurrence_id_mapping = ObservationMappingConfig.visit_occurrence_id_mapping
-        session_id_df = pd.DataFrame()
-        
-        # Join source session_id and existing omop visit_occurrence_id
-        session_id_df[[visit_occurrence_id_mapping["pasar"], visit_occurrence_id_mapping["joinpasaromop"]]] = df[[visit_occurrence_id_mapping["pasar"], visit_occurrence_id_mapping["joinpasaromop"]]]
-        
-        # Rank existing omop visit_occurrence_id within each session_id
-        session_id_df["visit_occurrence_id_rank"] = session_id_df.groupby(visit_occurrence_id_mapping["pasar"])[visit_occurrence_id_mapping["joinpasaromop"]].rank(method="first", ascending=True)
-        
-        # Filter rank
-        session_id_df = session_id_df[session_id_df['visit_occurrence_id_rank'] == 1.0]
-        
+
         # Assign existing visit_occurrence_id
-        df[visit_occurrence_id_mapping["omop"]] = session_id_df.apply(
-                                                    lambda row: row[visit_occurrence_id_mapping["joinpasaromop"]], axis=1)
-        del session_id_df # cleanup
+        df[visit_occurrence_id_mapping["omop"]] = df[visit_occurrence_id_mapping["joinpasaromop"]]
         return df[[visit_occurrence_id_mapping["omop"]]]
 
     @mapping_wrapper
@@ -75,39 +60,30 @@ class ObservationMapping():
         return df[[value_as_number_mapping["omop"]]]
 
     @mapping_wrapper
-    def map_value_as_concept_id(self, df: pd.DataFrame, allergy_concepts_df: pd.DataFrame) -> pd.DataFrame:
+    def map_value_as_concept_id(self, df: pd.DataFrame) -> pd.DataFrame:
         value_as_concept_id_mapping = ObservationMappingConfig.value_as_concept_id_mapping
 
-        # Strip "Allergy to " prefix from concept_name
-        allergy_concepts_df['allergy_concept'] = allergy_concepts_df['concept_name'].str.removeprefix(
-            "Allergy to ")
-
-        # Lower case both columns used for joining
-        allergy_concepts_df['allergy_concept'] = allergy_concepts_df['allergy_concept'].str.lower(
-        )
+        # Lower case the column used for the lookup, allergy concepts are normalised in the plan
         df[value_as_concept_id_mapping["pasar"]
            ] = df[value_as_concept_id_mapping["pasar"]].str.lower()
 
-        # Left join on df
-        df = df.merge(allergy_concepts_df,
-                      left_on=value_as_concept_id_mapping["pasar"], right_on='allergy_concept', how='left')
-
-        # Rename concept_id column as value_as_concept_id and set dtype to int
-        df = df.rename(
-            columns={"concept_id": value_as_concept_id_mapping["omop"]})
-        df[value_as_concept_id_mapping["omop"]
-           ] = df[value_as_concept_id_mapping["omop"]].astype(pd.Int64Dtype())
+        # Lookup concept_id as value_as_concept_id and set dtype to int
+        value_as_concept_ids = df[value_as_concept_id_mapping["pasar"]].map(
+            self.plan.allergy_concept_ids).astype(pd.Int64Dtype())
 
-        return df[[value_as_concept_id_mapping["omop"]]]
+        return value_as_concept_ids.to_frame(value_as_concept_id_mapping["omop"])
 
     @mapping_wrapper
-    def map_eav(self, df: pd.DataFrame, source_table: str, source_to_concept_map_df: pd.DataFrame) -> pd.DataFrame:
+    def map_eav(self, df: pd.DataFrame, source_table: str, id_columns: list = None) -> pd.DataFrame:
         '''Maps
         observation_concept_id
         observation_source_value
         value_source_value
         value_as_number
         value_as_string
+
+        Unpivots the EAV columns of source_table in one melt, one row per source row and EAV column.
+        Only id_columns (defaults to all non EAV columns) are carried over from df.
         '''
 
         value_as_string_mapping = ObservationMappingConfig.value_as_string_mapping
@@ -115,78 +91,45 @@ class ObservationMapping():
         value_source_value_mapping = ObservationMappingConfig.value_source_value_mapping
         value_as_number_mapping = ObservationMappingConfig.value_as_number_mapping
         observation_concept_id_mapping = ObservationMappingConfig.observation_concept_id_mapping
-        observation_concept_id_specific_config = ObservationMappingConfig.observation_concept_id_specific_config
-
-        mapped_df = pd.DataFrame()
-        vas_table_mapping = value_as_string_mapping["pasar"].get(
-            source_table, [])
-        osb_table_mapping = observation_source_value_mapping["pasar"].get(
-            source_table, [])
-        vsv_table_mapping = value_source_value_mapping["pasar"].get(
-            source_table, [])
-        van_table_mapping = value_as_number_mapping["pasar"].get(
-            source_table, [])
-        oci_table_mapping = observation_concept_id_mapping["pasar"].get(
-            source_table, [])
-        oci_specific_config = observation_concept_id_specific_config.get(
-            source_table, [])
-
-        # Get list of all possible EAV columns
-        eav_columns = list(set(
-            vas_table_mapping + osb_table_mapping + vsv_table_mapping + van_table_mapping + oci_table_mapping))
-
-        for eav_column in eav_columns:
-            temp_df = df.copy()
-
-            # map value_as_string
-            if eav_column in vas_table_mapping:
-                # Map to value in eav_column set in pasar config
-                temp_df[value_as_string_mapping["omop"]
-                        ] = df[eav_column].astype(str)
-            else:
-                temp_df[value_as_string_mapping["omop"]] = None
-
-            # map observation_source_value
-            if eav_column in osb_table_mapping:
-                # Map to eav_column name set in pasar config
-                temp_df[observation_source_value_mapping["omop"]
-                        ] = eav_column
-            else:
-                temp_df[observation_source_value_mapping["omop"]] = None
-
-            # map value_source_value
-            if eav_column in vsv_table_mapping:
-                # Map to value in eav_column set in pasar config
-                temp_df[value_source_value_mapping["omop"]
-                        ] = df[eav_column].astype(str)
-            else:
-                temp_df[value_source_value_mapping["omop"]] = None
-
-            # map value_as_number
-            if eav_column in van_table_mapping:
-                # Map to value in eav_column set in pasar config
-                temp_df[value_as_number_mapping["omop"]] = df[eav_column]
-            else:
-                temp_df[value_as_number_mapping["omop"]] = None
-
-            # map observation_concept_id
-            if eav_column in oci_table_mapping:
-                oci_column_config = oci_specific_config.get(eav_column, {})
-                if oci_column_config.get("use_hardcoded_value", None) is not None:
-                    temp_df[observation_concept_id_mapping["omop"]
-                            ] = oci_column_config["use_hardcoded_value"]
-
-                if oci_column_config.get("use_source_to_concept_mapping", None) is not None:
-                    try:
-                        # Lower case eav column for mapping
-                        lowercase_mapping_series = df[eav_column].str.lower()
-                    except AttributeError:
-                        lowercase_mapping_series = df[eav_column]
-                    temp_df[observation_concept_id_mapping["omop"]
-                            ] = lowercase_mapping_series.map(source_to_concept_map_df).fillna(0)
-            else:
-                temp_df[observation_concept_id_mapping["omop"]] = 0
-
-            mapped_df = pd.concat([mapped_df, temp_df], ignore_index=True)
-
-        return mapped_df
+
+        table_plan = self.plan.source_tables[source_table]
+        eav_columns = list(table_plan.eav_columns)
+        if id_columns is None:
+            id_columns = [column for column in df.columns if column not in eav_columns]
+
+        # Column major, all source rows of the 1st EAV column then the 2nd...
+        # EAV columns melted as object, mixed int / float columns would otherwise be upcast (3 -> "3.0" as string)
+        mapped_df = df.astype({column: object for column in eav_columns}).melt(id_vars=id_columns, value_vars=eav_columns,
+                            var_name=EAV_COLUMN_COL_NAME, value_name=EAV_VALUE_COL_NAME)
+        row_count = len(df)
+
+        def role(column_role):
+            # Role of the EAV column of every unpivoted row
+            return np.repeat(column_role, row_count)
+
+        values = mapped_df[EAV_VALUE_COL_NAME]
+        # EAV column names repeat for every source row, held as categories instead of a string per row
+        eav_column_names = pd.Categorical(mapped_df[EAV_COLUMN_COL_NAME], categories=eav_columns)
+        string_values = values.astype(str)
+
+        # Map to value in eav_column set in pasar config
+        mapped_df[value_as_string_mapping["omop"]] = string_values.where(role(table_plan.value_as_string), None)
+        # Map to eav_column name set in pasar config
+        mapped_df[observation_source_value_mapping["omop"]] = pd.Series(eav_column_names, index=mapped_df.index).where(role(table_plan.observation_source_value))
+        mapped_df[value_source_value_mapping["omop"]] = string_values.where(role(table_plan.value_source_value), None)
+        mapped_df[value_as_number_mapping["omop"]] = values.where(role(table_plan.value_as_number), None)
+
+        # map observation_concept_id, hardcoded per EAV column unless mapped with source to concept map
+        mapped_df[observation_concept_id_mapping["omop"]] = role(table_plan.observation_concept_id)
+        use_source_to_concept_mapping = role(table_plan.use_source_to_concept_mapping)
+        if use_source_to_concept_mapping.any():
+            mapping_values = values[use_source_to_concept_mapping]
+            try:
+                # Lower case eav column for mapping
+                lowercase_mapping_series = mapping_values.str.lower()
+            except AttributeError:
+                lowercase_mapping_series = mapping_values
+            mapped_df.loc[use_source_to_concept_mapping, observation_concept_id_mapping["omop"]
+                          ] = lowercase_mapping_series.map(self.plan.source_to_concept_ids).fillna(0).astype("int64")
+
+        return mapped_df.drop(columns=[EAV_COLUMN_COL_NAME, EAV_VALUE_COL_NAME])
@@ -0,0 +1,99 @@
+from dataclasses import dataclass, field
+import numpy as np
+import pandas as pd
+
+from .config import SOURCE_TABLES, ObservationMappingConfig
+
+
+def read_only(values, dtype=None) -> np.ndarray:
+    array = np.array(values, dtype=dtype)
+    array.setflags(write=False)
+    return array
+
+
+@dataclass(frozen=True)
+class SourceTablePlan:
+    '''EAV column roles of one source table, arrays are 1:1 with eav_columns'''
+    source_table: str
+    eav_columns: tuple
+    value_as_string: np.ndarray
+    observation_source_value: np.ndarray
+    value_source_value: np.ndarray
+    value_as_number: np.ndarray
+    observation_concept_id: np.ndarray # Hardcoded concept id, ignored where use_source_to_concept_mapping
+    use_source_to_concept_mapping: np.ndarray
+    maps_value_as_concept_id: bool
+    source_columns: tuple # Source columns read by the mappings
+
+
+@dataclass(frozen=True)
+class ObservationMappingPlan:
+    '''Mapping of every source table plus the normalised concept lookups, compiled once and reused for every chunk'''
+    source_tables: dict
+    allergy_concept_ids: pd.Series = field(default=None) # Lower case allergy name -> concept_id
+    source_to_concept_ids: pd.Series = field(default=None) # Lower case source_code -> target_concept_id
+
+    def with_lookups(self, allergy_concepts_df: pd.DataFrame, source_to_concept_map_df: pd.Series) -> "ObservationMappingPlan":
+        # Strip "Allergy to " prefix from concept_name and lower case it once, instead of for every chunk
+        allergy_concepts = allergy_concepts_df['concept_name'].str.removeprefix("Allergy to ").str.lower()
+        allergy_concept_ids = pd.Series(allergy_concepts_df['concept_id'].to_numpy(), index=allergy_concepts)
+        allergy_concept_ids = allergy_concept_ids[~allergy_concept_ids.index.duplicated()] # Lookup keys must be unique
+        source_to_concept_ids = source_to_concept_map_df[~source_to_concept_map_df.index.duplicated()]
+        return ObservationMappingPlan(self.source_tables, allergy_concept_ids, source_to_concept_ids)
+
+
+def compile_source_table_plan(source_table: str, config=ObservationMappingConfig) -> SourceTablePlan:
+    vas_table_mapping = config.value_as_string_mapping["pasar"].get(source_table, [])
+    osb_table_mapping = config.observation_source_value_mapping["pasar"].get(source_table, [])
+    vsv_table_mapping = config.value_source_value_mapping["pasar"].get(source_table, [])
+    van_table_mapping = config.value_as_number_mapping["pasar"].get(source_table, [])
+    oci_table_mapping = config.observation_concept_id_mapping["pasar"].get(source_table, [])
+    oci_specific_config = config.observation_concept_id_specific_config.get(source_table, {})
+
+    unknown_columns = [column for column in oci_specific_config if column not in oci_table_mapping]
+    if len(unknown_columns) > 0:
+        raise ValueError(f"observation_concept_id config of {source_table} has columns {unknown_columns} not in observation_concept_id_mapping")
+
+    # List of all possible EAV columns, in config order
+    eav_columns = tuple(dict.fromkeys(
+        vas_table_mapping + osb_table_mapping + vsv_table_mapping + van_table_mapping + oci_table_mapping))
+
+    observation_concept_ids, use_source_to_concept_mapping = [], []
+    for eav_column in eav_columns:
+        if eav_column not in oci_table_mapping:
+            observation_concept_ids.append(0)
+            use_source_to_concept_mapping.append(False)
+            continue
+        oci_column_config = oci_specific_config.get(eav_column, {})
+        hardcoded_value = oci_column_config.get("use_hardcoded_value", None)
+        use_mapping = oci_column_config.get("use_source_to_concept_mapping", None) is not None
+        if (hardcoded_value is None) == (not use_mapping):
+            raise ValueError(f"observation_concept_id of {source_table}.{eav_column} needs exactly one of use_hardcoded_value or use_source_to_concept_mapping")
+        if hardcoded_value is not None and not isinstance(hardcoded_value, int):
+            raise ValueError(f"Hardcoded observation_concept_id of {source_table}.{eav_column} must be an integer, got {hardcoded_value!r}")
+        observation_concept_ids.append(0 if use_mapping else hardcoded_value)
+        use_source_to_concept_mapping.append(use_mapping)
+
+    source_columns = tuple(dict.fromkeys(
+        config.observation_id_mapping["pasar"] +
+        [config.observation_date_mapping["pasar"], config.visit_occurrence_id_mapping["pasar"]] +
+        list(eav_columns)))
+
+    return SourceTablePlan(
+        source_table=source_table,
+        eav_columns=eav_columns,
+        value_as_string=read_only([column in vas_table_mapping for column in eav_columns], bool),
+        observation_source_value=read_only([column in osb_table_mapping for column in eav_columns], bool),
+        value_source_value=read_only([column in vsv_table_mapping for column in eav_columns], bool),
+        value_as_number=read_only([column in van_table_mapping for column in eav_columns], bool),
+        observation_concept_id=read_only(observation_concept_ids, "int64"),
+        use_source_to_concept_mapping=read_only(use_source_to_concept_mapping, bool),
+        # value_as_concept is only applicable for preop.char source_table.
+        maps_value_as_concept_id=source_table == "preop.char",
+        source_columns=source_columns,
+    )
+
+
+def compile_mapping_plan(source_tables=SOURCE_TABLES, config=ObservationMappingConfig) -> ObservationMappingPlan:
+    '''Compiles the config of every source table, raises ValueError on invalid config'''
+    return ObservationMappingPlan({source_table: compile_source_table_plan(source_table, config) for source_table in source_tables})
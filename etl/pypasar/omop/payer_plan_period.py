@@ -9,8 +9,9 @@ load_dotenv()
 
 class payer_plan_period:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
 
     def execute(self):
         try:
@@ -33,4 +34,5 @@ class payer_plan_period:
 
     def finalize(self):
         # Verify if needed
-        pass
+        if self.owns_engine:
+            self.engine.dispose()
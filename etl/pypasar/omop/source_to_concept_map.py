@@ -10,8 +10,11 @@ load_dotenv()
 
 class source_to_concept_map:
 
-    def __init__(self):
-        self.engine = postgres().get_engine()  # Get PG Connection
+    dependencies = ['concept']
+
+    def __init__(self, engine=None):
+        self.engine = postgres().get_engine() if engine is None else engine  # Get PG Connection, unless shared by the etl runner
+        self.owns_engine = engine is None
         self.omop_schema = os.getenv("POSTGRES_OMOP_SCHEMA")
         self.source_file = os.path.join(os.getenv("BASE_PATH"), "source_to_concep_map", "v3c.csv")
         self.temp_table = f'temp_source_to_concept_map_{os.urandom(15).hex()}'
@@ -91,4 +94,5 @@ class source_to_concept_map:
         with self.engine.connect() as connection:
             with connection.begin():
                 connection.execute(text(f"Drop table {self.omop_schema}.{self.temp_table}"))
-        self.engine.dispose()
+        if self.owns_engine:
+            self.engine.dispose()
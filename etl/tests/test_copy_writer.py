@@ -0,0 +1,56 @@
+import struct
+from decimal import Decimal
+import numpy as np
+import pandas as pd
+import pytest
+
+from pypasar.db.utils.copy_writer import copy_writer, encode_numeric
+
+
+def decode_numeric(encoded):
+    length, ndigits, weight, sign, dscale = struct.unpack("!ihhhh", encoded[:12])
+    digits = struct.unpack(f"!{ndigits}h", encoded[12:])
+    assert length == len(encoded) - 4
+    return ndigits, weight, sign & 0xFFFF, dscale, list(digits)
+
+
+@pytest.mark.parametrize("value, expected", [
+    (Decimal("0"), (0, 0, 0, 0, [])),
+    (Decimal("12345.678"), (3, 1, 0, 3, [1, 2345, 6780])),
+    (Decimal("-0.0012"), (1, -1, 0x4000, 4, [12])),
+    (Decimal("1000000"), (1, 1, 0, 0, [100])),
+    (Decimal("1E+2"), (1, 0, 0, 0, [100])),
+    (Decimal("0.00010"), (1, -1, 0, 5, [1])),
+    (2.5, (2, 0, 0, 1, [2, 5000])),
+    (7, (1, 0, 0, 0, [7])),
+])
+def test_encode_numeric(value, expected):
+    assert decode_numeric(encode_numeric(value)) == expected
+
+
+def test_encode_numeric_nan():
+    assert decode_numeric(encode_numeric(Decimal("NaN"))) == (0, 0, 0xC000, 0, [])
+
+
+def test_encode_numeric_infinity():
+    with pytest.raises(ValueError):
+        encode_numeric(Decimal("Infinity"))
+
+
+def test_to_text_quotes_values_and_leaves_null_unquoted():
+    writer = copy_writer(None, "measurement", "omop", copy_format="text")
+    df = pd.DataFrame({"value_source_value": ['a"b', None, "\\N", ""],
+                       "measurement_id": [1.0, np.nan, 3.0, 4.0],
+                       "measurement_date": pd.to_datetime(["2020-01-02", None, "2020-01-03", "2020-01-04"])},
+                      index=[10, 11, 12, 13])
+    column_types = {"value_source_value": "character varying", "measurement_id": "integer", "measurement_date": "date"}
+    lines = writer.to_text(df, column_types).getvalue().splitlines()
+    assert lines == ['"a""b","1","2020-01-02"',
+                     ',,',
+                     '"\\N","3","2020-01-03"',
+                     '"","4","2020-01-04"']
+
+
+def test_to_text_empty_frame():
+    writer = copy_writer(None, "measurement", "omop", copy_format="text")
+    assert writer.to_text(pd.DataFrame({"measurement_id": []}), {"measurement_id": "integer"}).getvalue() == ""
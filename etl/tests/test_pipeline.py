@@ -0,0 +1,71 @@
+import pytest
+
+from pypasar.db.utils.pipeline import pipeline
+
+
+@pytest.mark.parametrize("queue_depth", [0, 1, 2])
+def test_run_ingests_in_retrieval_order(queue_depth):
+    ingested = []
+    batch_count = pipeline(queue_depth).run(range(20), lambda batch: batch * 10, ingested.append)
+    assert batch_count == 20
+    assert ingested == [batch * 10 for batch in range(20)]
+
+
+def test_run_without_batches():
+    assert pipeline(2).run([], lambda batch: batch, lambda batch: None) == 0
+
+
+def test_negative_queue_depth():
+    with pytest.raises(ValueError):
+        pipeline(-1)
+
+
+def fail_on(value, message):
+    def stage(batch):
+        if batch == value:
+            raise RuntimeError(message)
+        return batch
+    return stage
+
+
+@pytest.mark.parametrize("queue_depth", [0, 2])
+def test_run_raises_transform_error(queue_depth):
+    with pytest.raises(RuntimeError, match="transform failed"):
+        pipeline(queue_depth).run(range(10), fail_on(3, "transform failed"), lambda batch: None)
+
+
+@pytest.mark.parametrize("queue_depth", [0, 2])
+def test_run_raises_ingest_error(queue_depth):
+    with pytest.raises(RuntimeError, match="ingest failed"):
+        pipeline(queue_depth).run(range(10), lambda batch: batch, fail_on(3, "ingest failed"))
+
+
+def test_run_raises_reader_error_and_closes_the_generator():
+    closed = []
+
+    def batches():
+        try:
+            yield 1
+            yield 2
+            raise RuntimeError("read failed")
+        finally:
+            closed.append(True)
+
+    with pytest.raises(RuntimeError, match="read failed"):
+        pipeline(2).run(batches(), lambda batch: batch, lambda batch: None)
+    assert closed == [True]
+
+
+def test_run_closes_the_generator_after_an_ingest_error():
+    closed = []
+
+    def batches():
+        try:
+            for batch in range(100):
+                yield batch
+        finally:
+            closed.append(True)
+
+    with pytest.raises(RuntimeError):
+        pipeline(1).run(batches(), lambda batch: batch, fail_on(0, "ingest failed"))
+    assert closed == [True]
@@ -0,0 +1,62 @@
+import threading
+import time
+import pytest
+
+from pypasar.db.utils.scheduler import scheduler
+
+
+def test_plan_waits_for_selected_dependencies_only():
+    graph = scheduler(parallelism=2).plan(["person", "visit_occurrence", "measurement"],
+                                          {"visit_occurrence": ["person"], "measurement": ["person", "visit_occurrence", "concept"]})
+    assert graph == {"person": set(), "visit_occurrence": {"person"}, "measurement": {"person", "visit_occurrence"}}
+
+
+def test_plan_truncate_cascade_is_a_barrier_for_later_entities():
+    graph = scheduler(parallelism=4).plan(["concept", "care_site", "person", "provider"],
+                                          {"provider": ["care_site"]}, truncate_cascade=["care_site"])
+    assert graph["concept"] == set()
+    assert graph["care_site"] == set()
+    assert graph["person"] == {"care_site"}
+    assert graph["provider"] == {"care_site"}
+
+
+def test_plan_raises_on_cycle():
+    with pytest.raises(ValueError, match="cycle"):
+        scheduler(parallelism=1).plan(["a", "b", "c"], {"a": ["b"], "b": ["a"]})
+
+
+def test_invalid_parallelism():
+    with pytest.raises(ValueError):
+        scheduler(parallelism=0)
+
+
+def test_run_sequential_keeps_selected_order():
+    order = []
+    time_taken = scheduler(parallelism=1).run(["c", "a", "b"], {"c": ["b"]}, order.append)
+    assert order == ["a", "b", "c"]
+    assert set(time_taken) == {"a", "b", "c"}
+
+
+def test_run_starts_dependents_after_their_dependencies():
+    finished, lock = [], threading.Lock()
+
+    def run_entity(entity):
+        time.sleep(0.05 if entity == "person" else 0.01)
+        with lock:
+            finished.append(entity)
+
+    scheduler(parallelism=4).run(["person", "concept", "measurement"], {"measurement": ["person"]}, run_entity)
+    assert finished.index("person") < finished.index("measurement")
+
+
+def test_run_stops_new_entities_and_raises_the_first_error():
+    started = []
+
+    def run_entity(entity):
+        started.append(entity)
+        if entity == "person":
+            raise RuntimeError("person failed")
+
+    with pytest.raises(RuntimeError, match="person failed"):
+        scheduler(parallelism=1).run(["person", "concept", "measurement"], {"measurement": ["person"]}, run_entity)
+    assert started == ["person"]
@@ -0,0 +1,45 @@
+import pytest
+
+from pypasar.db.utils.sql_runner import split_statements, strip_comments, load_statements
+
+
+def test_split_statements_on_top_level_semicolons():
+    assert split_statements("SELECT 1; SELECT 2;\n") == ["SELECT 1", "SELECT 2"]
+
+
+def test_split_statements_skips_semicolons_in_quotes():
+    script = "SELECT 'a;b', 'it''s;'; SELECT \"odd;name\" FROM t"
+    assert split_statements(script) == ["SELECT 'a;b', 'it''s;'", 'SELECT "odd;name" FROM t']
+
+
+def test_split_statements_skips_semicolons_in_comments():
+    script = "SELECT 1 -- not here;\n; /* nor; here */ SELECT 2"
+    assert split_statements(script) == ["SELECT 1 -- not here;", "/* nor; here */ SELECT 2"]
+
+
+def test_split_statements_skips_semicolons_in_dollar_quotes():
+    script = "DO $body$ BEGIN PERFORM 1; END $body$; SELECT $$a;b$$"
+    assert split_statements(script) == ["DO $body$ BEGIN PERFORM 1; END $body$", "SELECT $$a;b$$"]
+
+
+def test_split_statements_drops_comment_only_pieces():
+    script = "SELECT 1;\n-- CHANGE LOG\n/* 2024-01-01 initial; */\n"
+    assert split_statements(script) == ["SELECT 1"]
+
+
+def test_strip_comments():
+    assert strip_comments("-- header\nSELECT 1 /* inline */ -- trailing") == "SELECT 1"
+
+
+def test_load_statements_renders_placeholders(tmp_path):
+    sql_file = tmp_path / "load.sql"
+    sql_file.write_text("TRUNCATE {OMOP_SCHEMA}.person; INSERT INTO {OMOP_SCHEMA}.person SELECT * FROM {PREOP_SCHEMA}.x;")
+    statements = load_statements(str(sql_file), (("{OMOP_SCHEMA}", "omop"), ("{PREOP_SCHEMA}", "preop"), ("{POSTOP_SCHEMA}", None)))
+    assert statements == ("TRUNCATE omop.person", "INSERT INTO omop.person SELECT * FROM preop.x")
+
+
+def test_load_statements_raises_on_unset_placeholder(tmp_path):
+    sql_file = tmp_path / "load.sql"
+    sql_file.write_text("SELECT * FROM {POSTOP_SCHEMA}.x;")
+    with pytest.raises(ValueError, match="POSTOP_SCHEMA"):
+        load_statements(str(sql_file), (("{POSTOP_SCHEMA}", None),))